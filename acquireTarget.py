@@ -4,73 +4,97 @@ import argparse, sys, os, re, json, subprocess
 import datetime, time, math
 from astropy.io import fits
 import configHelper, saftClasses, generalUtils
+import astrometryClient, localSolver, solutionCache, acquisitionEngine
 
 if __name__ == "__main__":
 	
-	parser = argparse.ArgumentParser(description='Moves the telescope to the target ra and dec by using a call to Astrometry.net to find error and then offset.')
+	parser = argparse.ArgumentParser(description='Moves the telescope to the target ra and dec, plate solving frames to measure the pointing error and correcting it until it is within the tolerance.')
 	parser.add_argument('ra', type=str, help='Right ascension.')
 	parser.add_argument('dec', type=str, help='Declination.')
-	parser.add_argument('-u', '--updateinterval', type=float, help='Time in seconds to keep checking the folder for new data. ')
 	parser.add_argument('-o', '--outputpath', type=str, help='Path for the JSON output file that is going to be used in the web page.')
 	parser.add_argument('--save', action="store_true", help='Write the input parameters to the config file as default values.')
-	parser.add_argument('--telpath', type=str, help='Path to the "tel" binary.')
-	parser.add_argument('--tmppath', type=str, help='Path to FITS files created by the camera.')
+	parser.add_argument('--tel', type=str, help='The telescope control command ("tel").')
+	parser.add_argument('--setindi', type=str, help='The "setINDI" command.')
+	parser.add_argument('--getindi', type=str, help='The "getINDI" command.')
+	parser.add_argument('--camera', type=str, help='INDI name of the camera.')
+	parser.add_argument('-e', '--exptime', type=float, help='Exposure time (s) of the acquisition frames.')
+	parser.add_argument('-t', '--tolerance', type=float, help='Pointing error (arcsec) that is good enough.')
+	parser.add_argument('--corrections', type=int, help='Maximum number of pointing corrections to try.')
+	parser.add_argument('--timeout', type=float, default=600, help='Give up after this many seconds.')
+	parser.add_argument('--solver', type=str, choices=['nova', 'local'], help='Solve with nova.astrometry.net or a local solve-field install.')
+	parser.add_argument('--solvefield', type=str, help='Path to the local "solve-field" binary.')
+	parser.add_argument('--sources', type=int, help='Solve from a list of this many of the brightest stars instead of the whole image (0 to send the image).')
+	parser.add_argument('--nocache', action="store_true", help='Do not look for (or store) the solution in the plate solution cache.')
+	parser.add_argument('--radius', type=float, help='Pointing uncertainty (degrees) used as the search radius around the target.')
 	args = parser.parse_args()
 	print(args)
 	
 	config = configHelper.configClass("acquireTarget")
 	configDefaults  = {
-		"telPath": '/home/saft/src/teld/',
-		"tmpPath": '/tmp',
-		"latestFrameName": "/tmp/latestFrame.dat"
+		"TelCommand": "tel",
+		"SetINDICommand": "setINDI",
+		"GetINDICommand": "getINDI",
+		"Camera": "andor0",
+		"ExposureTime": 10,
+		"Tolerance": 10.0,
+		"MaxCorrections": 5,
+		"APIKey": "padlqljoevlogqik",
+		"Solver": "nova",
+		"SolveFieldPath": "/usr/local/astrometry/bin/solve-field",
+		"PointingUncertainty": 0.5,
+		"FieldWidth": 13.4,
+		"SourceListLength": 100,
+		"CacheMaxAge": 180,
+		"CacheMaxEntries": 5000
 	}
 	config.setDefaults(configDefaults)
 
-	telPath = config.assertProperty("telPath", args.telpath)
-	jsonPath = config.assertProperty("tmpPath", args.tmppath)	
+	telCommand = config.assertProperty("TelCommand", args.tel)
+	setINDICommand = config.assertProperty("SetINDICommand", args.setindi)
+	getINDICommand = config.assertProperty("GetINDICommand", args.getindi)
+	cameraName = config.assertProperty("Camera", args.camera)
+	exposureTime = config.assertProperty("ExposureTime", args.exptime)
+	tolerance = config.assertProperty("Tolerance", args.tolerance)
+	maxCorrections = config.assertProperty("MaxCorrections", args.corrections)
+	solver = config.assertProperty("Solver", args.solver)
+	solveFieldPath = config.assertProperty("SolveFieldPath", args.solvefield)
+	pointingUncertainty = config.assertProperty("PointingUncertainty", args.radius)
+	sourceListLength = config.assertProperty("SourceListLength", args.sources)
 	if args.save:
 		config.save()
 		
-	radec = generalUtils.sexagesimalParts(args.ra, args.dec)
 	radec = generalUtils.fromSexagesimal(args.ra, args.dec)
 	print("Your target is at %3.5f, %3.5f degrees."%(radec[0], radec[1]))
-	
-	telCommand = ["tel"]
-	telCommand.append("track")
-	telCommand.append(args.ra)
-	telCommand.append(args.dec)
-	print ("Issuing telescope tracking command: " + str(telCommand))
-	subprocess.call(telCommand)
-	
-	# Acquire an image
-	acquireCommand = ["r_acquire.sh"]
-	acquireCommand.append("andor0")
-	print ("Issuing camera acquisition command: " + str(acquireCommand))
-	subprocess.call(acquireCommand)
-	
-	frameFile = open(config.latestFrameName, "rt")
-	
-	fitsFilename = frameFile.readline().strip()
-	print (fitsFilename)
-	
-	solutionOutputFile = fitsFilename + "_wcs_solution.fits"
-	FITSSolutionOutputFile = fitsFilename + "_wcs_solved_image.fits"
-	# Run astrometryClient
-	astrometryCommand = ['astrometryClient.py']
-	astrometryCommand.append("-kpadlqljoevlogqik")
-	astrometryCommand.append("-u" + fitsFilename)
-	astrometryCommand.append("--wcs=" + solutionOutputFile)
-	astrometryCommand.append("--wcsfits=" + FITSSolutionOutputFile)
-	#astrometryCommand.append("-w")
-	#astrometryCommand.append("--ra=" + str(runInfo.ra))
-	#astrometryCommand.append("--dec=" + str(runInfo.dec))
-	#astrometryCommand.append("--radius=1")
-	
-	print("Running Astrometry.net command" + str(astrometryCommand))
-	
-	result = subprocess.call(astrometryCommand)
-	
-	print("Result:", result)
-	
 
-	
\ No newline at end of file
+	if solver == "local":
+		client = localSolver.LocalClient(solveFieldPath, verbose = False)
+	else:
+		client = astrometryClient.Client(verbose = False)
+	client.login(config.APIKey)
+	cache = None
+	if not args.nocache:
+		cache = solutionCache.solutionCache(maxAge = config.CacheMaxAge, maxEntries = config.CacheMaxEntries)
+
+	engine = acquisitionEngine.acquisitionEngine(
+		acquisitionEngine.telescope(telCommand),
+		acquisitionEngine.camera(cameraName, exposureTime, setINDI = setINDICommand, getINDI = getINDICommand),
+		acquisitionEngine.plateSolver(client, cache, sourceListLength, config.FieldWidth),
+		tolerance, maxCorrections, pointingUncertainty = pointingUncertainty)
+	outcome = engine.acquire(radec[0], radec[1], args.timeout)
+	client.close()
+
+	print(engine.timer.summary())
+	if cache is not None:
+		cache.evict()
+		print("Solution cache:", cache.statistics())
+	if outcome["success"]:
+		print("Acquired the target to within %.1f arcsec after %d corrections."%(outcome["error"], outcome["corrections"]))
+	else:
+		print("Failed to acquire the target.")
+	if args.outputpath is not None:
+		outcome["target"] = [radec[0], radec[1]]
+		outcome["timing"] = engine.timer.durations
+		outputFile = open(args.outputpath, "wt")
+		json.dump(outcome, outputFile, indent = 4)
+		outputFile.close()
+	sys.exit(0 if outcome["success"] else -1)
@@ -0,0 +1,280 @@
+""" Closed-loop target acquisition. The camera, the plate solver and the telescope each run in their own thread, so the next
+	frame is exposing while the last one is being solved. Each solution is compared with the target, and the telescope is
+	re-pointed by the error until it is within the tolerance. Frames taken before the latest correction are thrown away.
+	The time spent in each stage is recorded by a stageTimer.
+"""
+
+import time, math, threading, subprocess
+import queue
+from astropy.io import fits
+import solutionCache, sourceList, localSolver
+
+
+def sexagesimal(ra, dec):
+	""" Formats ra and dec (degrees) as 'HH:MM:SS.ss' and '+DD:MM:SS.s' """
+	def parts(value, decimals, wrap = None):
+		# Round first, so that 59.99 seconds does not come out as 60.0
+		value = round(abs(value) * 3600, decimals)
+		if wrap is not None: value%= wrap * 3600
+		return int(value // 3600), int(value % 3600 // 60), value % 60
+	raParts, decParts = parts((ra % 360.) / 15., 2, 24), parts(dec, 1)
+	return "%02d:%02d:%05.2f"%raParts, ("-" if dec < 0 else "+") + "%02d:%02d:%04.1f"%decParts
+
+def pointingError(targetRA, targetDEC, ra, dec):
+	""" The error (arcsec) of pointing at ra, dec instead of the target: (east-west, north-south, total) """
+	dRA = ((ra - targetRA + 180.) % 360. - 180.) * math.cos(math.radians(targetDEC)) * 3600.
+	dDEC = (dec - targetDEC) * 3600.
+	return dRA, dDEC, math.hypot(dRA, dDEC)
+
+
+class stageTimer(object):
+	""" Collects how long each stage (expose, solve, slew...) takes. Thread safe. """
+
+	def __init__(self):
+		self.durations = {}
+		self.started = time.time()
+		self._lock = threading.Lock()
+
+	def record(self, stage, seconds):
+		with self._lock:
+			self.durations.setdefault(stage, []).append(seconds)
+
+	def time(self, stage, function, *args):
+		""" Calls function(*args) and records how long it took under 'stage' """
+		start = time.time()
+		try:
+			return function(*args)
+		finally:
+			self.record(stage, time.time() - start)
+
+	def summary(self):
+		with self._lock:
+			lines = ["%-8s %3d x %6.2f s = %7.2f s"%(stage, len(times), sum(times) / len(times), sum(times)) for stage, times in sorted(self.durations.items())]
+		lines.append("elapsed           %7.2f s"%(time.time() - self.started))
+		return "\n".join(lines)
+
+
+class telescope(object):
+	""" Points the telescope with the 'tel' program """
+
+	def __init__(self, command = "tel"):
+		self.command = command
+
+	def track(self, ra, dec):
+		raString, decString = sexagesimal(ra, dec)
+		print("Issuing telescope tracking command: %s track %s %s"%(self.command, raString, decString))
+		return subprocess.call([self.command, "track", raString, decString], stdout = subprocess.DEVNULL) == 0
+
+
+class camera(object):
+	""" Takes single exposures with the INDI camera driver, as r_acquire.sh does """
+
+	def __init__(self, device = "andor0", exposureTime = 10, binning = 2, region = (768, 768, 512, 512), baseName = "/tmp/saft-acquire-",
+			setINDI = "setINDI", getINDI = "getINDI", pollInterval = 0.2):
+		self.device = device
+		self.exposureTime = exposureTime
+		self.binning = binning
+		self.region = region
+		self.baseName = baseName
+		self.setINDICommand = setINDI
+		self.getINDICommand = getINDI
+		self.pollInterval = pollInterval
+		self.ready = False
+
+	def setINDI(self, *assignments):
+		subprocess.check_call([self.setINDICommand] + ["%s.%s"%(self.device, a) for a in assignments])
+
+	def getINDI(self, name):
+		output = subprocess.check_output([self.getINDICommand, "%s.%s"%(self.device, name)]).decode("ascii", "replace")
+		return output.strip().split("=", 1)[1] if "=" in output else ""
+
+	def setup(self):
+		self.setINDI("shutter.auto=On")
+		self.setINDI("image_exposure.time=%s"%self.exposureTime)
+		self.setINDI("archive.base_name=%s"%self.baseName)
+		self.setINDI("acquire.single=On")
+		self.setINDI("fits_script.file=getshm && frameheader")
+		self.setINDI("fits_script.run=On")
+		self.setINDI("image_binning.x=%d"%self.binning, "image_binning.y=%d"%self.binning)
+		self.setINDI("image_region_control.option=Off")
+		self.setINDI("image_region.x=%d"%self.region[0], "image_region.y=%d"%self.region[1], "image_region.w=%d"%self.region[2], "image_region.h=%d"%self.region[3])
+		self.ready = True
+
+	def expose(self):
+		""" Takes one frame and returns its filename. Sleeps through most of the exposure before polling the driver. """
+		if not self.ready: self.setup()
+		self.setINDI("sequence.run=On")
+		time.sleep(max(0, self.exposureTime - self.pollInterval))
+		while self.getINDI("sequence.run") == "On":
+			time.sleep(self.pollInterval)
+		return self.getINDI("file.name")
+
+
+class plateSolver(object):
+	""" Solves frames with an astrometryClient.Client or localSolver.LocalClient, looking in the solution cache first """
+
+	def __init__(self, client, cache = None, sources = 100, fieldWidth = 13.4):
+		self.client = client
+		self.cache = cache
+		self.sources = sources
+		self.fieldWidth = fieldWidth
+
+	def solve(self, filename, ra, dec, radius):
+		""" Returns the calibration (centre, pixel scale...) of the frame, or None. The WCS is written next to the frame. """
+		solutionFilename = filename + "_wcs_solution.fits"
+		searchRA, searchDEC, searchRadius = ra, dec, radius
+		wcsData = None
+		if self.cache is not None:
+			header = fits.getheader(filename)
+			setup = (header.get("XBINNING", 1), header.get("YBINNING", 1), "%dx%d"%(header.get("NAXIS1", 0), header.get("NAXIS2", 0)))
+			frameHash = solutionCache.fileHash(filename)
+			x, y, flux, width, height = sourceList.sourcesFromFile(filename, 20)
+			kind, wcsData, calibration = self.cache.lookup(ra, dec, setup[0], setup[1], setup[2], radius, frameHash, (x, y))
+			if kind == "hint":
+				searchRA, searchDEC, searchRadius = calibration['ra'], calibration['dec'], min(radius, 0.1)
+		if wcsData is None:
+			wcsData = self.solveWithClient(filename, searchRA, searchDEC, searchRadius)
+			if wcsData is None and (searchRA, searchDEC, searchRadius) != (ra, dec, radius):
+				print("Could not solve %s near the cached solution, trying the whole search area"%filename)
+				wcsData = self.solveWithClient(filename, ra, dec, radius)
+			if wcsData is None: return None
+			if self.cache is not None:
+				calibration = localSolver.calibrationFromWCS(fits.Header.fromstring(wcsData.decode("ascii", "replace")))
+				self.cache.store(wcsData, calibration, ra, dec, setup[0], setup[1], setup[2], frameHash, (x, y))
+		outputFile = open(solutionFilename, "wb")
+		outputFile.write(wcsData)
+		outputFile.close()
+		return localSolver.calibrationFromWCS(fits.getheader(solutionFilename))
+
+	def solveWithClient(self, filename, ra, dec, radius):
+		kwargs = { "center_ra": ra, "center_dec": dec, "radius": radius, "scale_units": "arcminwidth", "scale_upper": self.fieldWidth, "scale_type": "ul" }
+		if self.sources > 0: result = self.client.upload_sources(filename, self.sources, **kwargs)
+		else: result = self.client.upload(filename, **kwargs)
+		if result is None or result.get("status") != "success": return None
+		jobID = self.client.wait_for_job_id(result["subid"])
+		if self.client.wait_for_job(jobID)["status"] != "success": return None
+		return self.client.wcs_file(jobID)
+
+
+class acquisitionEngine(object):
+	""" Points the telescope at a target and corrects the pointing from plate solutions until it is within 'tolerance' arcsec """
+
+	def __init__(self, telescope, camera, solver, tolerance = 10.0, maxCorrections = 5, maxFailures = 3, pointingUncertainty = 0.5, timer = None):
+		self.telescope = telescope
+		self.camera = camera
+		self.solver = solver
+		self.tolerance = tolerance
+		self.maxCorrections = maxCorrections
+		self.maxFailures = maxFailures
+		self.pointingUncertainty = pointingUncertainty
+		self.timer = stageTimer() if timer is None else timer
+		self.log = []
+
+	def _cameraLoop(self):
+		""" Keeps exposing whenever the telescope is settled, tagging each frame with the pointing it was taken at """
+		while True:
+			self._settled.wait()
+			if self._stop.is_set(): return
+			with self._lock:
+				# A slew may have started since the wait
+				if not self._settled.is_set(): continue
+				epoch, pointing = self._epoch, self._pointing
+			try:
+				filename = self.timer.time("expose", self.camera.expose)
+			except (OSError, subprocess.CalledProcessError) as e:
+				print("WARNING: Exposure failed: %s"%str(e))
+				self._results.put((epoch, pointing, None, None))
+				continue
+			if self._stop.is_set(): return
+			with self._lock:
+				stale = epoch != self._epoch
+			if stale:
+				# The telescope was moved during the exposure, so the frame is not at 'pointing'
+				print("Skipping %s, the telescope moved while it was exposing"%filename)
+				self.timer.record("stale", 0)
+				continue
+			print("Exposed %s"%filename)
+			self._frames.put((epoch, pointing, filename))
+
+	def _solverLoop(self):
+		""" Solves frames as they arrive, skipping any taken before the latest correction """
+		while True:
+			item = self._frames.get()
+			if item is None: return
+			epoch, pointing, filename = item
+			if epoch != self._epoch:
+				print("Skipping %s, it was taken before the last correction"%filename)
+				self.timer.record("stale", 0)
+				continue
+			radius = self.pointingUncertainty if epoch == 0 else min(self.pointingUncertainty, 0.1)
+			try:
+				calibration = self.timer.time("solve", self.solver.solve, filename, self._target[0], self._target[1], radius)
+			except Exception as e:
+				print("WARNING: Solving %s failed: %s"%(filename, str(e)))
+				calibration = None
+			self._results.put((epoch, pointing, filename, calibration))
+
+	def _slew(self, ra, dec):
+		with self._lock:
+			self._settled.clear()
+			self._epoch+= 1
+			self._pointing = (ra, dec)
+		if not self.timer.time("slew", self.telescope.track, ra, dec):
+			print("WARNING: The telescope did not accept the tracking command")
+		self._settled.set()
+
+	def acquire(self, ra, dec, timeout = 600):
+		""" Returns a dictionary describing the outcome: 'success', the final 'error' (arcsec), the 'corrections' made and
+			the 'frames' solved.
+		"""
+		self._target = (ra, dec)
+		self._frames = queue.Queue()
+		self._results = queue.Queue()
+		self._settled = threading.Event()
+		self._stop = threading.Event()
+		self._lock = threading.Lock()
+		self._epoch = -1
+		threads = [threading.Thread(target = self._cameraLoop), threading.Thread(target = self._solverLoop)]
+		for thread in threads:
+			thread.daemon = True
+			thread.start()
+
+		outcome = { "success": False, "error": None, "corrections": 0, "frames": [] }
+		failures = 0
+		deadline = time.time() + timeout
+		self._slew(ra, dec)
+		try:
+			while time.time() < deadline:
+				try:
+					epoch, pointing, filename, calibration = self._results.get(timeout = max(0.1, deadline - time.time()))
+				except queue.Empty:
+					break
+				if epoch != self._epoch: continue
+				if calibration is None:
+					failures+= 1
+					if failures >= self.maxFailures:
+						print("Giving up after %d frames could not be solved"%failures)
+						break
+					continue
+				failures = 0
+				dRA, dDEC, error = pointingError(ra, dec, calibration['ra'], calibration['dec'])
+				outcome["frames"].append({ "filename": filename, "ra": calibration['ra'], "dec": calibration['dec'], "error": error })
+				outcome["error"] = error
+				print("%s: pointing error %.1f\" (%.1f\" E-W, %.1f\" N-S)"%(filename, error, dRA, dDEC))
+				if error <= self.tolerance:
+					outcome["success"] = True
+					break
+				if outcome["corrections"] >= self.maxCorrections:
+					print("Giving up after %d corrections"%outcome["corrections"])
+					break
+				# Move by the error measured at the pointing the frame was taken at
+				correctedRA = pointing[0] + (ra - calibration['ra'])
+				correctedDEC = pointing[1] + (dec - calibration['dec'])
+				outcome["corrections"]+= 1
+				self._slew(correctedRA % 360., correctedDEC)
+		finally:
+			self._stop.set()
+			self._settled.set()
+			self._frames.put(None)
+		self.log.append(outcome)
+		return outcome
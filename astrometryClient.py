@@ -3,19 +3,16 @@ import os
 import sys
 import time
 import base64
+import threading
+import http.client
+from concurrent.futures import ThreadPoolExecutor
 
-from urllib.request import urlopen
-from urllib.request import Request
-from urllib.request import HTTPError
 from urllib.parse import urlencode
 from urllib.parse import quote
+from urllib.parse import urlsplit
 # from exceptions import Exception
-from email.mime.multipart import MIMEMultipart
-
-from email.mime.base import MIMEBase
-from email.mime.application  import MIMEApplication
-
-from email.encoders import encode_noop
+import io
+import uuid
 
 # from api_util import json2python, python2json
 import simplejson
@@ -35,119 +32,271 @@ class MalformedResponse(Exception):
 class RequestError(Exception):
     pass
 
+
+class MultipartBody(object):
+    '''
+    A multipart/form-data body holding the request JSON and one file, read
+    in chunks so the file goes from disk to the socket without being held
+    in memory. 'source' is a file opened in binary mode, or bytes.
+    '''
+    def __init__(self, json, filename, source):
+        self.boundary = '===============%s==' % uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary="%s"' % self.boundary
+        head = ('--%s\r\n'
+                'Content-Type: text/plain\r\n'
+                'MIME-Version: 1.0\r\n'
+                'Content-disposition: form-data; name="request-json"\r\n'
+                '\r\n'
+                '%s\r\n'
+                '--%s\r\n'
+                'Content-Type: application/octet-stream\r\n'
+                'MIME-Version: 1.0\r\n'
+                'Content-disposition: form-data; name="file"; filename="%s"\r\n'
+                '\r\n' % (self.boundary, json, self.boundary,
+                            os.path.basename(filename)))
+        tail = '\r\n--%s--\r\n' % self.boundary
+        if isinstance(source, bytes):
+            source = io.BytesIO(source)
+            size = len(source.getvalue())
+        else:
+            size = os.fstat(source.fileno()).st_size - source.tell()
+        self._file = source
+        self._file_start = source.tell()
+        self._parts = [io.BytesIO(head.encode('utf-8')), source,
+                       io.BytesIO(tail.encode('ascii'))]
+        self.length = len(head.encode('utf-8')) + size + len(tail)
+        self._current = 0
+
+    def read(self, size=-1):
+        chunks = []
+        while self._current < len(self._parts) and size != 0:
+            chunk = self._parts[self._current].read(size)
+            if not chunk:
+                self._current += 1
+                continue
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b''.join(chunks)
+
+    def rewind(self):
+        self._parts[0].seek(0)
+        self._file.seek(self._file_start)
+        self._parts[2].seek(0)
+        self._current = 0
+
+    def close(self):
+        self._file.close()
+
+
+class ConnectionPool(object):
+    '''
+    Keep-alive HTTP connections to one server, shared between threads.
+    '''
+    def __init__(self, scheme, netloc, maxsize=8, timeout=120):
+        self.scheme = scheme
+        self.netloc = netloc
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.connections_opened = 0
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _get(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+            self.connections_opened += 1
+        # Large blocks keep streamed uploads from being sent 8 kB at a time
+        if self.scheme == 'https':
+            return http.client.HTTPSConnection(self.netloc, timeout=self.timeout,
+                                               blocksize=65536), False
+        return http.client.HTTPConnection(self.netloc, timeout=self.timeout,
+                                          blocksize=65536), False
+
+    def _put(self, conn):
+        with self._lock:
+            if len(self._idle) < self.maxsize:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, method, path, body=None, headers={}):
+        '''
+        Returns (status, reason, data). A request on a reused connection
+        that the server has meanwhile closed is retried once on a new one,
+        rewinding a streamed body first (other file bodies are not retried).
+        '''
+        while True:
+            conn, reused = self._get()
+            try:
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, ConnectionError):
+                conn.close()
+                if reused and hasattr(body, 'rewind'):
+                    body.rewind()
+                    continue
+                if reused and not hasattr(body, 'read'):
+                    continue
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                self._put(conn)
+            return response.status, response.reason, data
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+class Backoff(object):
+    '''
+    Polling intervals that start short and grow by 'factor' up to 'maximum'.
+    '''
+    def __init__(self, initial=1.0, maximum=30.0, factor=1.5):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.delay = initial
+
+    def next(self):
+        delay = self.delay
+        self.delay = min(self.maximum, self.delay * self.factor)
+        return delay
+
+    def reset(self):
+        self.delay = self.initial
+
+
 class Client(object):
     default_url = 'http://nova.astrometry.net/api/'
+
+    # Endpoints fetched (concurrently) once a job has succeeded
+    job_result_services = [('calibration', 'Calibration'),
+                           ('tags', 'Tags'),
+                           ('machine_tags', 'Machine Tags'),
+                           ('objects_in_field', 'Objects in field'),
+                           ('annotations', 'Annotations'),
+                           ('info', 'Info')]
     
     def __init__(self,
-                 apiurl = default_url):
+                 apiurl = default_url, max_connections = 8, verbose = True):
         self.session = None
         self.apiurl = apiurl
+        self.max_connections = max_connections
+        self.verbose = verbose
+        self._pools = {}
+        self._pools_lock = threading.Lock()
 
     def get_url(self, service):
         return self.apiurl + service
 
+    def _log(self, *args):
+        if self.verbose:
+            print(*args)
+
+    def _pool(self, url):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        with self._pools_lock:
+            if key not in self._pools:
+                self._pools[key] = ConnectionPool(parts.scheme, parts.netloc,
+                                                  self.max_connections)
+            return self._pools[key]
+
+    def open_url(self, url, data=None, headers={}):
+        '''
+        Sends a GET (or a POST if there is data) over a pooled keep-alive
+        connection and returns (status, reason, body).
+        '''
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        method = 'GET' if data is None else 'POST'
+        return self._pool(url).request(method, path, data, headers)
+
+    def get_file(self, url):
+        status, reason, data = self.open_url(url)
+        if status >= 400:
+            raise RequestError('HTTP %d %s fetching %s' % (status, reason, url))
+        return data
+
+    def _result_file(self, kind, job_id):
+        # These are not part of the API, the URLs sit next to it
+        url = self.apiurl.replace('/api/', '/%s/%i' % (kind, int(job_id)))
+        self._log('Retrieving file from', url)
+        return self.get_file(url)
+
+    def wcs_file(self, job_id):
+        return self._result_file('wcs_file', job_id)
+
+    def new_fits_file(self, job_id):
+        return self._result_file('new_fits_file', job_id)
+
+    def kml_file(self, job_id):
+        return self._result_file('kml_file', job_id)
+
+    def close(self):
+        with self._pools_lock:
+            pools, self._pools = list(self._pools.values()), {}
+        for pool in pools:
+            pool.close()
+
     def send_request(self, service, args={}, file_args=None):
         '''
         service: string
         args: dict
         '''
+        args = dict(args)
         if self.session is not None:
             args.update({ 'session' : self.session })
-        print('Python:', args)
+        self._log('Python:', args)
         json = python2json(args)
-        print('Sending json:', json)
+        self._log('Sending json:', json)
         url = self.get_url(service)
-        print('Sending to URL:', url)
+        self._log('Sending to URL:', url)
 
         # If we're sending a file, format a multipart/form-data
         if file_args is not None:
-            print("We need to send a file.")
-            m1 = MIMEBase('text', 'plain')
-            m1.add_header('Content-disposition', 'form-data; name="request-json"')
-            m1.set_payload(json)
-
-            m2 = MIMEApplication(file_args[1],'octet-stream',encode_noop)
-            m2.add_header('Content-disposition',
-                          'form-data; name="file"; filename="%s"' % file_args[0])
-
-            #msg.add_header('Content-Disposition', 'attachment',
-            # filename='bud.gif')
-            #msg.add_header('Content-Disposition', 'attachment',
-            # filename=('iso-8859-1', '', 'FuSballer.ppt'))
-
-            mp = MIMEMultipart('form-data', None, [m1, m2])
-
-            # Make a custom generator to format it the way we need.
-            from cStringIO import StringIO
-            from email.generator import Generator
-
-            class MyGenerator(Generator):
-                def __init__(self, fp, root=True):
-                    Generator.__init__(self, fp, mangle_from_=False,
-                                       maxheaderlen=0)
-                    self.root = root
-                def _write_headers(self, msg):
-                    # We don't want to write the top-level headers;
-                    # they go into Request(headers) instead.
-                    if self.root:
-                        return                        
-                    # We need to use \r\n line-terminator, but Generator
-                    # doesn't provide the flexibility to override, so we
-                    # have to copy-n-paste-n-modify.
-                    for h, v in msg.items():
-                        print >> self._fp, ('%s: %s\r\n' % (h,v)),
-                    # A blank line always separates headers from body
-                    print >> self._fp, '\r\n',
-
-                # The _write_multipart method calls "clone" for the
-                # subparts.  We hijack that, setting root=False
-                def clone(self, fp):
-                    return MyGenerator(fp, root=False)
-
-            fp = StringIO()
-            g = MyGenerator(fp)
-            g.flatten(mp)
-            data = fp.getvalue()
-            headers = {'Content-type': mp.get('Content-type')}
-
-            if False:
-                print('Sending headers:')
-                print(' ', headers)
-                print('Sending data:')
-                print(data[:1024].replace('\n', '\\n\n').replace('\r', '\\r'))
-                if len(data) > 1024:
-                    print('...')
-                    print(data[-256:].replace('\n', '\\n\n').replace('\r', '\\r'))
-                    print()
+            data = MultipartBody(json, file_args[0], file_args[1])
+            self._log('Sending %d byte multipart body' % data.length)
+            headers = {'Content-type': data.content_type,
+                       'Content-length': str(data.length)}
 
         else:
             # Else send x-www-form-encoded
             data = {'request-json': json}
-            print('Sending form data:', data)
-            data = urlencode(data)
-            print('Sending data:', data)
-            headers = {}
-
-        request = Request(url=url, headers=headers, data=data)
+            self._log('Sending form data:', data)
+            data = urlencode(data).encode('ascii')
+            self._log('Sending data:', data)
+            headers = {'Content-type': 'application/x-www-form-urlencoded'}
 
         try:
-            print(request)
-            f = urlopen(request)
-            txt = f.read()
-            print('Got json:', txt)
-            result = json2python(txt)
-            print('Got result:', result)
-            stat = result.get('status')
-            print('Got status:', stat)
-            if stat == 'error':
-                errstr = result.get('errormessage', '(none)')
-                raise RequestError('server error message: ' + errstr)
-            return result
-        except HTTPError as e:
-            print('HTTPError', e)
-            txt = e.read()
+            status, reason, txt = self.open_url(url, data, headers)
+        finally:
+            if file_args is not None:
+                data.close()
+        if status >= 400:
+            print('HTTPError', status, reason)
             open('err.html', 'wb').write(txt)
             print('Wrote error text to err.html')
+            return None
+
+        self._log('Got json:', txt)
+        result = json2python(txt)
+        self._log('Got result:', result)
+        stat = result.get('status')
+        self._log('Got status:', stat)
+        if stat == 'error':
+            errstr = result.get('errormessage', '(none)')
+            raise RequestError('server error message: ' + errstr)
+        return result
 
     def login(self, apikey):
         args = { 'apikey' : apikey }
@@ -175,7 +324,8 @@ class Client(object):
                                 ('downsample_factor', None, int),
                                 ('tweak_order', None, int),
                                 ('crpix_center', None, bool),
-                                # image_width, image_height
+                                ('image_width', None, int),
+                                ('image_height', None, int),
                                 ]:
             if key in kwargs:
                 val = kwargs.pop(key)
@@ -196,12 +346,25 @@ class Client(object):
         args = self._get_upload_args(**kwargs)
         try:
             f = open(fn, 'rb')
-            result = self.send_request('upload', args, (fn, f.read()))
-            return result
         except IOError:
             print('File %s does not exist' % fn)
             raise
+        # The file is streamed from disk by send_request, which closes it
+        return self.send_request('upload', args, (fn, f))
     
+    def upload_sources(self, fn, max_sources=100, **kwargs):
+        '''
+        Finds the stars in a FITS image locally and uploads a table of
+        the brightest max_sources of them instead of the image.
+        '''
+        import sourceList
+        xylist, width, height = sourceList.makeSourceList(fn, max_sources)
+        self._log('Uploading %d byte source list for %s' % (len(xylist), fn))
+        kwargs.update(image_width=width, image_height=height)
+        args = self._get_upload_args(**kwargs)
+        name = os.path.splitext(os.path.basename(fn))[0] + '.xyls'
+        return self.send_request('upload', args, (name, xylist))
+
     def submission_images(self, subid):
         result = self.send_request('submission_images', {'subid':subid})
         return result.get('image_ids')
@@ -233,27 +396,63 @@ class Client(object):
         result = self.send_request('myjobs/')
         return result['jobs']
 
+    def job_results(self, job_id):
+        '''
+        Fetches the calibration, tags, annotations etc. of a solved job
+        concurrently and returns them in a dict keyed by endpoint name.
+        '''
+        services = [name for name, label in self.job_result_services]
+        with ThreadPoolExecutor(max_workers=len(services)) as executor:
+            results = executor.map(
+                lambda name: self.send_request('jobs/%s/%s' % (job_id, name)),
+                services)
+            return dict(zip(services, results))
+
     def job_status(self, job_id, justdict=False):
         result = self.send_request('jobs/%s' % job_id)
         if justdict:
             return result
         stat = result.get('status')
         if stat == 'success':
-            result = self.send_request('jobs/%s/calibration' % job_id)
-            print('Calibration:', result)
-            result = self.send_request('jobs/%s/tags' % job_id)
-            print('Tags:', result)
-            result = self.send_request('jobs/%s/machine_tags' % job_id)
-            print('Machine Tags:', result)
-            result = self.send_request('jobs/%s/objects_in_field' % job_id)
-            print('Objects in field:', result)
-            result = self.send_request('jobs/%s/annotations' % job_id)
-            print('Annotations:', result)
-            result = self.send_request('jobs/%s/info' % job_id)
-            print('Calibration:', result)
+            results = self.job_results(job_id)
+            for name, label in self.job_result_services:
+                print('%s:' % label, results[name])
 
         return stat
 
+    def wait_for_job_id(self, sub_id, timeout=None, backoff=None):
+        '''
+        Polls a submission with increasing intervals until it has a job id.
+        '''
+        backoff = backoff or Backoff()
+        start = time.time()
+        while True:
+            stat = self.sub_status(sub_id, justdict=True)
+            self._log('Got status:', stat)
+            for j in stat.get('jobs', []):
+                if j is not None:
+                    print('Selecting job id', j)
+                    return j
+            if timeout is not None and time.time() - start > timeout:
+                raise RequestError('timed out waiting for submission %s' % sub_id)
+            time.sleep(backoff.next())
+
+    def wait_for_job(self, job_id, timeout=None, backoff=None):
+        '''
+        Polls a job with increasing intervals until it succeeds or fails,
+        and returns its final status dict.
+        '''
+        backoff = backoff or Backoff()
+        start = time.time()
+        while True:
+            stat = self.job_status(job_id, justdict=True)
+            self._log('Got job status:', stat)
+            if stat.get('status', '') in ['success', 'failure']:
+                return stat
+            if timeout is not None and time.time() - start > timeout:
+                raise RequestError('timed out waiting for job %s' % job_id)
+            time.sleep(backoff.next())
+
     def sub_status(self, sub_id, justdict=False):
         result = self.send_request('submissions/%s' % sub_id)
         if justdict:
@@ -268,11 +467,105 @@ class Client(object):
         )
         return result
 
+class SubmissionTracker(object):
+    '''
+    Follows many submissions at once. Each one is polled on its own backoff
+    schedule and the polls that are due are sent concurrently, so a night of
+    acquisitions does not wait on one network round-trip after another.
+    '''
+    def __init__(self, client, max_workers=8, initial=1.0, maximum=30.0,
+                 factor=1.5, fetch_results=True):
+        self.client = client
+        self.max_workers = max_workers
+        self.backoff_args = (initial, maximum, factor)
+        self.fetch_results = fetch_results
+        self.submissions = {}
+        self._lock = threading.Lock()
+
+    def add(self, sub_id, tag=None):
+        with self._lock:
+            self.submissions[sub_id] = dict(sub_id=sub_id, tag=tag,
+                                            job_id=None, status='submitted',
+                                            results=None, added=time.time(),
+                                            finished=None,
+                                            backoff=Backoff(*self.backoff_args),
+                                            next_poll=time.time())
+
+    def pending(self):
+        with self._lock:
+            return [e for e in self.submissions.values()
+                    if e['status'] not in ('success', 'failure')]
+
+    def _check(self, entry):
+        if entry['job_id'] is None:
+            stat = self.client.sub_status(entry['sub_id'], justdict=True)
+            jobs = [j for j in stat.get('jobs', []) if j is not None]
+            if not jobs:
+                return False
+            entry['job_id'] = jobs[0]
+            entry['status'] = 'solving'
+            return True
+        stat = self.client.job_status(entry['job_id'], justdict=True)
+        status = stat.get('status', '')
+        if status not in ('success', 'failure'):
+            return False
+        if status == 'success' and self.fetch_results:
+            entry['results'] = self.client.job_results(entry['job_id'])
+        entry['status'] = status
+        entry['finished'] = time.time()
+        return True
+
+    def poll(self):
+        '''
+        Polls every submission that is due and returns the ones that finished.
+        '''
+        now = time.time()
+        due = [e for e in self.pending() if e['next_poll'] <= now]
+        if not due:
+            return []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            changed = list(executor.map(self._check, due))
+        finished = []
+        for entry, advanced in zip(due, changed):
+            # Poll again soon after a step forward, back off while nothing changes
+            if advanced:
+                entry['backoff'].reset()
+            entry['next_poll'] = time.time() + entry['backoff'].next()
+            if entry['status'] in ('success', 'failure'):
+                finished.append(entry)
+        return finished
+
+    def run(self, timeout=None, callback=None):
+        '''
+        Polls until every submission has finished (or 'timeout' seconds pass),
+        calling callback(entry) for each one as it finishes.
+        '''
+        start = time.time()
+        while True:
+            for entry in self.poll():
+                if callback is not None:
+                    callback(entry)
+            pending = self.pending()
+            if not pending:
+                return self.submissions
+            if timeout is not None and time.time() - start > timeout:
+                raise RequestError('timed out with %d submissions pending' % len(pending))
+            wait = min(e['next_poll'] for e in pending) - time.time()
+            if wait > 0:
+                time.sleep(wait)
+
+
 if __name__ == '__main__':
     import optparse
     parser = optparse.OptionParser()
     parser.add_option('--server', dest='server', default=Client.default_url,
                       help='Set server base URL (eg, %default)')
+    parser.add_option('--local', '-L', dest='local', action='store_true',
+                      help='Solve with a local solve-field install instead of the web service')
+    parser.add_option('--solve-field', dest='solve_field', default='solve-field',
+                      help='Path to the solve-field binary used by --local (default %default)')
+    parser.add_option('--solver-config', dest='solver_config',
+                      help='astrometry.net backend config (index locations) for --local')
     parser.add_option('--apikey', '-k', dest='apikey',
                       help='API key for Astrometry.net web service; if not given will check AN_API_KEY environment variable')
     parser.add_option('--upload', '-u', dest='upload', help='Upload a file')
@@ -280,6 +573,8 @@ if __name__ == '__main__':
     parser.add_option('--wcs', dest='wcs', help='Download resulting wcs.fits file, saving to given filename; implies --wait if --urlupload or --upload')
     parser.add_option('--wcsfits', dest='wcsfits', help='Download new_wcs.fits file, saving to given filename; implies --wait if --urlupload or --upload')
     parser.add_option('--kmz', dest='kmz', help='Download resulting kmz file, saving to given filename; implies --wait if --urlupload or --upload')
+    parser.add_option('--sources', dest='sources', type=int,
+                      help='With --upload, find the stars locally and send only the brightest SOURCES of them')
     parser.add_option('--urlupload', '-U', dest='upload_url', help='Upload a file at specified url')
     parser.add_option('--scale-units', dest='scale_units',
                       choices=('arcsecperpix', 'arcminwidth', 'degwidth', 'focalmm'), help='Units for scale estimate')
@@ -332,19 +627,23 @@ if __name__ == '__main__':
     if opt.apikey is None:
         # try the environment
         opt.apikey = os.environ.get('AN_API_KEY', None)
-    if opt.apikey is None:
+    if opt.apikey is None and not opt.local:
         parser.print_help()
         print
         print('You must either specify --apikey or set AN_API_KEY')
         sys.exit(-1)
 
-    args = {}
-    args['apiurl'] = opt.server
-    c = Client(**args)
+    if opt.local:
+        import localSolver
+        c = localSolver.LocalClient(opt.solve_field, opt.solver_config)
+    else:
+        args = {}
+        args['apiurl'] = opt.server
+        c = Client(**args)
     c.login(opt.apikey)
 
     if opt.upload or opt.upload_url:
-        if opt.wcs or opt.kmz:
+        if opt.wcs or opt.kmz or opt.local:
             opt.wait = True
 
         kwargs = dict(
@@ -373,7 +672,9 @@ if __name__ == '__main__':
         if opt.parity is not None:
             kwargs.update(parity=int(opt.parity))
             
-        if opt.upload:
+        if opt.upload and opt.sources:
+            upres = c.upload_sources(opt.upload, opt.sources, **kwargs)
+        elif opt.upload:
             upres = c.upload(opt.upload, **kwargs)
         if opt.upload_url:
             upres = c.url_upload(opt.upload_url, **kwargs)
@@ -392,31 +693,13 @@ if __name__ == '__main__':
                 print("Can't --wait without a submission id or job id!")
                 sys.exit(-1)
 
-            while True:
-                stat = c.sub_status(opt.sub_id, justdict=True)
-                print('Got status:', stat)
-                jobs = stat.get('jobs', [])
-                if len(jobs):
-                    for j in jobs:
-                        if j is not None:
-                            break
-                    if j is not None:
-                        print('Selecting job id', j)
-                        opt.job_id = j
-                        break
-                time.sleep(5)
-
-        success = False
-        while True:
-            stat = c.job_status(opt.job_id, justdict=True)
-            print('Got job status:', stat)
-            if stat.get('status','') in ['success']:
-                success = (stat['status'] == 'success')
-                break
-            if stat['status'] == "failure":
-                print("Oh no! We failed")
-                sys.exit(-1)
-            time.sleep(5)
+            opt.job_id = c.wait_for_job_id(opt.sub_id)
+
+        stat = c.wait_for_job(opt.job_id)
+        if stat['status'] == "failure":
+            print("Oh no! We failed")
+            sys.exit(-1)
+        success = (stat['status'] == 'success')
 
         if success:
             print("status: ", stat)
@@ -432,23 +715,16 @@ if __name__ == '__main__':
             #result = c.send_request('jobs/%s/annotations' % opt.job_id)
             #print 'Annotations:', result
 
-            retrieveurls = []
+            retrievefiles = []
             if opt.wcs:
-                # We don't need the API for this, just construct URL
-                url = opt.server.replace('/api/', '/wcs_file/%i' % opt.job_id)
-                retrieveurls.append((url, opt.wcs))
+                retrievefiles.append((c.wcs_file, opt.wcs))
             if opt.wcsfits:
-                # We don't need the API for this, just construct URL
-                url = opt.server.replace('/api/', '/new_fits_file/%i' % opt.job_id)
-                retrieveurls.append((url, opt.wcsfits))
+                retrievefiles.append((c.new_fits_file, opt.wcsfits))
             if opt.kmz:
-                url = opt.server.replace('/api/', '/kml_file/%i/' % opt.job_id)
-                retrieveurls.append((url, opt.kmz))
+                retrievefiles.append((c.kml_file, opt.kmz))
 
-            for url,fn in retrieveurls:
-                print('Retrieving file from', url, 'to', fn)
-                f = urlopen(url)
-                txt = f.read()
+            for fetch,fn in retrievefiles:
+                txt = fetch(opt.job_id)
                 w = open(fn, 'wb')
                 w.write(txt)
                 w.close()
@@ -482,4 +758,6 @@ if __name__ == '__main__':
         jobs = c.myjobs()
         print(jobs)
 
+    c.close()
+
     #print c.submission_images(1)
@@ -0,0 +1,149 @@
+""" Catches up with the frames already on disk when the live reducer is started part way through a run. The backlog is cut
+	into runs of consecutive frames and each run is read, calibrated, registered, measured and summed by a worker process.
+	The partial sums are added pairwise (a tree sum) as they arrive and merged into the stacker in one go, and the drift and
+	photometry of each frame are recorded in frame order. Nothing is drawn for the backlog frames.
+"""
+
+import multiprocessing, collections, time
+import numpy
+import registration, photometry, columnStore, frameWorker
+
+
+class treeSum(object):
+	""" Adds arrays pairwise, in place, as they are added, like a binary counter: a partial sum is only added to another of
+		the same number of arrays. At most log2(n) partial sums are held at once.
+	"""
+
+	def __init__(self):
+		self._pending = []      # (number of arrays, partial sum), the largest first
+
+	def add(self, array):
+		size = 1
+		while len(self._pending) > 0 and self._pending[-1][0] == size:
+			other = self._pending.pop()[1]
+			numpy.add(other, array, out=other)
+			array, size = other, 2 * size
+		self._pending.append((size, array))
+
+	def total(self):
+		""" The sum of all the arrays added so far, or None if there were none """
+		if len(self._pending) == 0: return None
+		total = self._pending.pop()[1]
+		while len(self._pending) > 0:
+			numpy.add(total, self._pending.pop()[1], out=total)
+		return total
+
+
+def _reduceRun(run):
+	""" Reduces a list of (index, filename). Returns the sum of the frames, the number summed, a record for each frame and
+		the last 'windowSize' frames (for the stacker's window).
+	"""
+	worker = frameWorker.state
+	calibrator, registrar, sources = worker["calibrator"], worker["registrar"], worker["sources"]
+	total, count, records, lastFrames = None, 0, [], []
+	shifted = None
+	for index, filename in run:
+		frame = frameWorker.loadFrame(index, filename)
+		if (frame.xBinning, frame.yBinning) != worker["binning"] or numpy.shape(frame.imageData) != worker["shape"] or not calibrator.apply(frame):
+			records.append({ "index": index, "filename": filename, "skipped": True, "reason": "the binning or size does not match" })
+			continue
+		data = frame.imageData
+		record = { "index": index, "filename": filename, "skipped": False, "MJD": frame.MJD, "drift": (0, 0) }
+		if registrar is not None:
+			dx, dy, significance = registrar.measureShift(data)
+			if not registrar.acceptable(significance):
+				records.append({ "index": index, "filename": filename, "skipped": True, "reason": "it does not match the reference",
+					"MJD": frame.MJD, "drift": (dx, dy), "significance": significance })
+				continue
+			record["drift"], record["significance"] = (dx, dy), significance
+			shifted = registration.shiftImage(data, -dx, -dy, out=shifted)
+			data = shifted
+		if total is None: total = numpy.zeros(numpy.shape(data), dtype=numpy.float64)
+		numpy.add(total, data, out=total)
+		count+= 1
+		if sources is not None:
+			result = photometry.aperturePhotometry(frame.imageData, sources[0] + record["drift"][0], sources[1] + record["drift"][1], worker["radii"], worker["annulus"])
+			record["flux"], record["sky"] = result["flux"], result["sky"]
+		if worker["target"] is not None: record["row"] = columnStore.frameRow(worker["target"], frame, record["drift"])
+		if worker["windowSize"] > 0:
+			lastFrames = (lastFrames + [numpy.array(data, dtype=numpy.float32)])[-worker["windowSize"]:]
+		records.append(record)
+	return total, count, records, lastFrames
+
+
+class backlogReducer(object):
+	""" Reduces a backlog of frame files in a pool of 'processes' worker processes (one per CPU by default) and merges them
+		into 'stacker'. 'registrar' and 'photometer' are optional, as in the live reduction. If a 'frameStore' (a columnStore
+		with columnStore.frameColumns) is given, the statistics of each frame are added to it under the name 'target'.
+	"""
+
+	def __init__(self, stacker, calibrator, registrar = None, photometer = None, processes = None, runsPerProcess = 4, frameStore = None, target = ""):
+		self.stacker = stacker
+		self.frameStore = frameStore
+		self.target = target
+		self.calibrator = calibrator
+		self.registrar = registrar
+		self.photometer = photometer
+		self.processes = processes if processes is not None else multiprocessing.cpu_count()
+		self.runsPerProcess = runsPerProcess
+		self.skipped = []
+
+	def reduce(self, items):
+		""" Reduces a list of (index, filename) in frame order. Returns the number of frames added to the stack. """
+		if len(items) == 0: return 0
+		startTime = time.time()
+		runLength = max(1, -(-len(items) // (self.processes * self.runsPerProcess)))
+		runs = [items[i:i + runLength] for i in range(0, len(items), runLength)]
+		first = self.stacker.firstFrame
+		sources, radii, annulus = None, None, None
+		if self.photometer is not None:
+			sources, radii, annulus = (self.photometer.x, self.photometer.y), self.photometer.radii, self.photometer.annulus
+		processes = min(self.processes, len(runs))
+		pool = multiprocessing.Pool(processes, frameWorker.initWorker, ({ "calibrator": self.calibrator, "registrar": self.registrar,
+			"sources": sources, "radii": radii, "annulus": annulus, "binning": (first.xBinning, first.yBinning),
+			"shape": self.stacker.sum.shape, "windowSize": self.stacker.windowSize,
+			"target": self.target if self.frameStore is not None else None },))
+		sums, count = treeSum(), 0
+		try:
+			# The runs are collected in order, so the records and the window frames are merged in frame order. Only a few
+			# runs are handed out ahead of the one being collected, so that finished partial sums do not pile up.
+			pending = collections.deque()
+			for run in runs:
+				pending.append(pool.apply_async(_reduceRun, (run,)))
+				if len(pending) > 2 * processes: count+= self._merge(pending.popleft().get(), sums)
+			while len(pending) > 0:
+				count+= self._merge(pending.popleft().get(), sums)
+			pool.close()
+		except:
+			pool.terminate()
+			raise
+		finally:
+			pool.join()
+		total = sums.total()
+		if total is not None: self.stacker.addSum(total, count)
+		print("Caught up with %d frames in %.1f s using %d processes (%d skipped)"%(count, time.time() - startTime, processes, len(self.skipped)))
+		return count
+
+	def _merge(self, result, sums):
+		""" Adds a run's partial sum to 'sums' and records its frames. Returns the number of frames summed. """
+		total, count, records, lastFrames = result
+		if total is not None: sums.add(total)
+		self._record(records)
+		for data in lastFrames: self.stacker.addWindowFrame(data)
+		return count
+
+	def _record(self, records):
+		for record in records:
+			if record["skipped"]:
+				if "significance" in record:
+					self.registrar.reject(record["index"], record["MJD"], record["drift"][0], record["drift"][1], record["significance"])
+				else:
+					print("WARNING: Skipped %s (%s)"%(record["filename"], record["reason"]))
+				self.skipped.append(record["filename"])
+				continue
+			if self.registrar is not None:
+				self.registrar.driftLog.append((record["index"], record["MJD"], record["drift"][0], record["drift"][1], record["significance"]))
+			if self.photometer is not None:
+				self.photometer.record(record["index"], record["MJD"], record["drift"], record["flux"], record["sky"])
+			if self.frameStore is not None:
+				self.frameStore.append(record["row"])
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+
+""" Reduces a whole night of SAFT data offline. The frames in the night's OBS_DATA folder are grouped by target with the
+	same filename patterns as the autoLogger, and each target is one unit of work for a pool of processes: its frames are
+	calibrated, registered and stacked, the stars are found on the stack, and every frame is then measured to give a
+	differential light curve. The statistics of every frame go in a columnStore for the night. A progress file in the
+	reduction folder records each finished target, so an interrupted reduction carries on where it stopped, and a target is
+	only reduced again if it has gained frames.
+"""
+
+import argparse, sys, os, json, time
+import multiprocessing
+import numpy
+from astropy.io import fits
+import configHelper, saftClasses, calibration, frameStacker, registration, photometry, sourceList, nightCatalogue, columnStore, frameWorker
+
+
+def reduceTarget(job):
+	""" Reduces the frames of one target, given as (name, [filenames in frame order], output folder). Returns a summary and
+		a frame statistics row (see columnStore.frameRow) for each frame stacked.
+	"""
+	try:
+		return _reduceTarget(*job)
+	except Exception as e:
+		return { "name": job[0], "status": "failed", "numFrames": len(job[1]), "message": str(e) }, []
+
+def _reduceTarget(name, filenames, outputFolder):
+	calibrator, options = frameWorker.state["calibrator"], frameWorker.state["options"]
+	startTime = time.time()
+	if not os.path.exists(outputFolder): os.makedirs(outputFolder)
+
+	# First pass: register and stack
+	stacker = frameStacker.frameStacker()
+	registrar = None
+	used, drifts, skipped, rows = [], [], [], []
+	for index, filename in enumerate(filenames):
+		frame = frameWorker.loadFrame(index, filename)
+		if not stacker.canAdd(frame) or not calibrator.apply(frame):
+			skipped.append(filename)
+			continue
+		drift = (0, 0)
+		if options["register"]:
+			if registrar is None: registrar = registration.frameRegistration(frame.imageData, maxShift = options["maxDrift"], minSignificance = options["minSignificance"])
+			drift = registrar.register(frame)
+			if drift is None:
+				skipped.append(filename)
+				continue
+		if not stacker.addFrame(frame, offset = (-drift[0], -drift[1]) if registrar is not None else None):
+			skipped.append(filename)
+			continue
+		used.append((index, filename))
+		drifts.append(drift)
+		rows.append(columnStore.frameRow(name, frame, drift))
+	if stacker.count == 0:
+		return { "name": name, "status": "failed", "numFrames": len(filenames), "skipped": len(skipped), "message": "No frames could be reduced" }, rows
+
+	first = stacker.firstFrame
+	header = fits.Header()
+	for key in first.metadata.keys():
+		value = getattr(first, key)
+		if value is not None: header[first.metadata[key]] = value
+	header['NCOMBINE'] = (stacker.count, 'Number of frames stacked')
+	header['REGISTER'] = (options["register"], 'Frames were registered before stacking')
+	stackFilename = os.path.join(outputFolder, name + "-stack.fits")
+	fits.writeto(stackFilename, stacker.sum.astype(numpy.float32), header, overwrite = True)
+	summary = { "name": name, "status": "done", "numFrames": len(filenames), "stacked": stacker.count, "skipped": len(skipped), "stack": stackFilename }
+	if registrar is not None:
+		summary["driftLog"] = os.path.join(outputFolder, name + "-drift.csv")
+		registrar.writeDriftLog(summary["driftLog"])
+
+	# Second pass: find the stars on the stack and measure them in every frame
+	if options["photometry"]:
+		height, width = numpy.shape(stacker.sum)
+		x, y, flux = sourceList.findSources(stacker.sum, maxSources = options["maxSources"])
+		if len(x) < 2:
+			summary["message"] = "Too few stars on the stack for photometry"
+		else:
+			target, comparisons = photometry.chooseStars(x, y, flux, width, height)
+			lightCurveFolder = os.path.join(outputFolder, name + "-lightcurve")
+			photometer = photometry.lightCurveEngine(x, y, target, comparisons, options["apertures"], options["annulus"], lightCurveFolder)
+			for (index, filename), drift in zip(used, drifts):
+				frame = frameWorker.loadFrame(index, filename)
+				calibrator.apply(frame)
+				photometer.measure(frame, drift)
+			photometer.close()
+			summary["lightCurve"] = lightCurveFolder
+			summary["numSources"] = len(x)
+
+	summary["seconds"] = time.time() - startTime
+	return summary, rows
+
+
+def loadProgress(filename):
+	if not os.path.exists(filename): return {}
+	return json.load(open(filename, "rt"))
+
+def saveProgress(progress, filename):
+	""" Writes the progress file by renaming a temporary file over it, so it is never left half written """
+	temporaryFilename = filename + ".tmp"
+	outputFile = open(temporaryFilename, "wt")
+	json.dump(progress, outputFile, indent = 4)
+	outputFile.close()
+	os.replace(temporaryFilename, filename)
+
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser(description='Reduces all the targets observed on a night, in parallel.')
+	parser.add_argument('date', type=str, help='The night to reduce (the name of its folder in OBS_DATA).')
+	parser.add_argument('--obsdata', type=str, help='Folder where the OBS_DATA can be found.')
+	parser.add_argument('-r', '--reducedirectory', type=str, help='Reduction directory. A folder for the night is made in here.')
+	parser.add_argument('-b', '--bias', type=str, help='Use this as the bias frame')
+	parser.add_argument('-f', '--flat', type=str, help='Use this as the flat (balance) frame')
+	parser.add_argument('-t', '--targets', type=str, nargs='+', help='Only reduce these targets.')
+	parser.add_argument('-j', '--processes', type=int, help='Number of targets to reduce at once. Default is one per CPU.')
+	parser.add_argument('--noregister', action="store_true", help='Stack the frames without measuring and removing the drift.')
+	parser.add_argument('--maxdrift', type=float, help='Largest drift (pixels) to look for when registering.')
+	parser.add_argument('--minsignificance', type=float, default=20, help='Leave out frames that match the first frame less well than this when registering (0 to keep them all).')
+	parser.add_argument('--nophotometry', action="store_true", help='Only stack the frames.')
+	parser.add_argument('--apertures', type=float, nargs='+', default=[3, 5, 7], help='Aperture radii (pixels) for the photometry.')
+	parser.add_argument('--annulus', type=float, nargs=2, default=[10, 15], help='Inner and outer radius (pixels) of the sky annulus.')
+	parser.add_argument('--maxsources', type=int, default=100, help='Most stars to measure in each target.')
+	parser.add_argument('--restart', action="store_true", help='Reduce every target again, ignoring the progress file.')
+	parser.add_argument('--save', action="store_true", help='Write the input parameters to the config file as default values.')
+	args = parser.parse_args()
+	print(args)
+
+	config = configHelper.configClass("batchSAFTReduce")
+	configDefaults  = {
+		"OBSDATAPath": '/home/saft/OBS_DATA',
+		"ReductionDirectory": "/home/rashley/astro/reductions",
+		"BiasFrame": None,
+		"FlatFrame": None,
+		"Processes": None
+	}
+	config.setDefaults(configDefaults)
+	obsdataPath = config.assertProperty("OBSDATAPath", args.obsdata)
+	reductionDir = config.assertProperty("ReductionDirectory", args.reducedirectory)
+	biasFrameFilename = config.assertProperty("BiasFrame", args.bias)
+	flatFrameFilename = config.assertProperty("FlatFrame", args.flat)
+	processes = config.assertProperty("Processes", args.processes)
+	if args.save:
+		config.save()
+	if processes is None: processes = multiprocessing.cpu_count()
+
+	nightPath = os.path.join(obsdataPath, args.date)
+	if not os.path.isdir(nightPath):
+		print("Could not find the directory %s. Exiting."%nightPath)
+		sys.exit(-1)
+	outputPath = os.path.join(reductionDir, args.date)
+	if not os.path.exists(outputPath): os.makedirs(outputPath)
+
+	biasFrame, flatFrame = None, None
+	if biasFrameFilename is not None:
+		biasFrame = saftClasses.frameObject()
+		biasFrame.initFromFile(biasFrameFilename)
+		biasFrame.frameType = "bias"
+	if flatFrameFilename is not None:
+		flatFrame = saftClasses.frameObject()
+		flatFrame.initFromFile(flatFrameFilename)
+		flatFrame.frameType = "flat"
+	calibrator = calibration.calibrationStage(biasFrame, flatFrame)
+
+	catalogue = nightCatalogue.nightCatalogue(nightPath)
+	catalogue.addFiles(sorted(os.listdir(nightPath)))
+	names = catalogue.targetNames()
+	if args.targets is not None:
+		missing = [name for name in args.targets if name not in names]
+		if missing: print("WARNING: No frames found for %s"%", ".join(missing))
+		names = [name for name in names if name in args.targets]
+
+	progressFilename = os.path.join(outputPath, "progress.json")
+	progress = {} if args.restart else loadProgress(progressFilename)
+	jobs = []
+	for name in names:
+		target = catalogue.targets[name]
+		done = progress.get(name)
+		if done is not None and done["status"] == "done" and done["numFrames"] == target.numFrames:
+			print("%s: already reduced (%d frames)"%(name, target.numFrames))
+			continue
+		filenames = [os.path.join(nightPath, target.files[number]) for number in sorted(target.files.keys())]
+		jobs.append((name, filenames, os.path.join(outputPath, name)))
+	# The biggest targets go first so that a long one is not left running on its own at the end
+	jobs.sort(key = lambda job: len(job[1]), reverse = True)
+	if len(jobs) == 0:
+		print("Nothing to do.")
+		sys.exit(0)
+
+	options = { "register": not args.noregister, "maxDrift": args.maxdrift, "minSignificance": args.minsignificance or None, "photometry": not args.nophotometry,
+		"apertures": args.apertures, "annulus": args.annulus, "maxSources": args.maxsources }
+	processes = max(1, min(processes, len(jobs)))
+	print("Reducing %d targets (%d frames) with %d processes"%(len(jobs), sum(len(job[1]) for job in jobs), processes))
+	startTime = time.time()
+	frameStore = columnStore.columnStore(os.path.join(outputPath, "frames"), columnStore.frameColumns())
+	pool = multiprocessing.Pool(processes, frameWorker.initWorker, ({ "calibrator": calibrator, "options": options },))
+	try:
+		for summary, rows in pool.imap_unordered(reduceTarget, jobs):
+			# Each target's frames go in row groups of their own, so a target reduced again can replace its old rows
+			frameStore.dropGroups("target", summary["name"])
+			for row in rows: frameStore.append(row)
+			frameStore.flush()
+			progress[summary["name"]] = summary
+			saveProgress(progress, progressFilename)
+			print("%s: %s, %d of %d frames stacked in %.1f s"%(summary["name"], summary["status"], summary.get("stacked", 0), summary["numFrames"], summary.get("seconds", 0)))
+		pool.close()
+	except KeyboardInterrupt:
+		print("Interrupted. The targets finished so far are recorded in %s"%progressFilename)
+		pool.terminate()
+		sys.exit(-1)
+	except:
+		pool.terminate()
+		raise
+	finally:
+		pool.join()
+	print("Reduced %d targets in %.1f s"%(len(jobs), time.time() - startTime))
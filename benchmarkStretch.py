@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+""" Times the display stretch in saftClasses: the exact 'percentiles' function against the histogram and subsample
+	estimates of fastStretch, and reports how far the estimated cut levels are from the exact ones.
+"""
+
+import argparse, sys, time
+import numpy
+import saftClasses
+
+
+def syntheticFrame(width, height, seed = 0):
+	""" A star field: Poisson sky, some Gaussian stars and a few saturated pixels """
+	random = numpy.random.RandomState(seed)
+	data = random.poisson(400, (height, width)).astype(numpy.float32)
+	y, x = numpy.mgrid[0:height, 0:width]
+	for i in range(50):
+		x0, y0, flux = random.uniform(0, width), random.uniform(0, height), random.uniform(1e3, 1e5)
+		cutout = (slice(max(0, int(y0) - 10), int(y0) + 10), slice(max(0, int(x0) - 10), int(x0) + 10))
+		data[cutout]+= flux / (2 * numpy.pi * 4) * numpy.exp(-((x[cutout] - x0)**2 + (y[cutout] - y0)**2) / 8.)
+	data[random.randint(0, height, 20), random.randint(0, width, 20)] = 65535
+	return data
+
+def timeIt(function, repeats):
+	times = []
+	for i in range(repeats):
+		start = time.time()
+		result = function()
+		times.append(time.time() - start)
+	return min(times), result
+
+def percentileOf(data, value):
+	return 100. * numpy.count_nonzero(data < value) / data.size
+
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser(description='Benchmarks the fast display stretch against the exact percentiles.')
+	parser.add_argument('files', type=str, nargs='*', help='FITS files to use. A synthetic frame is used if none are given.')
+	parser.add_argument('-s', '--size', type=int, nargs=2, default=[512, 512], help='Width and height of the synthetic frame.')
+	parser.add_argument('-t', '--tolerance', type=float, default=0.5, help='Tolerance (in percent) for the fast estimates.')
+	parser.add_argument('-n', '--repeats', type=int, default=5, help='Number of timing repeats (the fastest is reported).')
+	parser.add_argument('--lower', type=float, default=20, help='Lower percentile.')
+	parser.add_argument('--upper', type=float, default=99, help='Upper percentile.')
+	args = parser.parse_args()
+
+	images = []
+	for filename in args.files:
+		frame = saftClasses.frameObject(lazy = True)
+		frame.initFromFile(filename)
+		images.append((filename, numpy.array(frame.imageData, dtype=numpy.float32)))
+	if len(images) == 0:
+		images.append(("synthetic %dx%d"%tuple(args.size), syntheticFrame(args.size[0], args.size[1])))
+
+	for name, data in images:
+		print("%s:"%name)
+		exactTime, exact = timeIt(lambda: saftClasses.percentiles(data.copy(), args.lower, args.upper), args.repeats)
+		exactCuts = numpy.percentile(data, [args.lower, args.upper])
+		print("   %-10s %8.2f ms   cuts: %10.2f %10.2f"%("exact", exactTime * 1000, exactCuts[0], exactCuts[1]))
+		for method in ["histogram", "subsample"]:
+			stretcher = saftClasses.fastStretch(method, args.tolerance)
+			stretcher.stretch(data, args.lower, args.upper)    # Allocate the output buffer before timing
+			fastTime, result = timeIt(lambda: stretcher.stretch(data, args.lower, args.upper), args.repeats)
+			cuts = stretcher.cutLevels(data, args.lower, args.upper)
+			errors = (percentileOf(data, cuts[0]) - percentileOf(data, exactCuts[0]), percentileOf(data, cuts[1]) - percentileOf(data, exactCuts[1]))
+			difference = numpy.abs(result.astype(numpy.float32) - exact).max()
+			print("   %-10s %8.2f ms   cuts: %10.2f %10.2f   percentile error: %+.3f %+.3f   max pixel difference: %.1f   speed up: %.1fx"%(method, fastTime * 1000, cuts[0], cuts[1], errors[0], errors[1], difference, exactTime / fastTime))
@@ -0,0 +1,60 @@
+""" Bias and flat field calibration of science frames. The master frames are prepared once, and each science frame is then
+	calibrated in a single pass over its rows: convert to float32, subtract the bias and multiply by the reciprocal flat.
+"""
+
+import numpy
+
+tileRows = 64     # Rows per tile; small enough that a tile of a full frame stays in the CPU cache between the two operations
+
+
+class calibrationStage(object):
+	""" Holds the float32 master bias and the reciprocal of the normalised flat, and applies them to frameObjects """
+
+	def __init__(self, biasFrame = None, flatFrame = None):
+		self.bias = None
+		self.reciprocalFlat = None
+		self.xBinning = None
+		self.yBinning = None
+		self.shape = None
+		if biasFrame is not None:
+			self.bias = numpy.array(biasFrame.imageData, dtype=numpy.float32)
+			self.shape = self.bias.shape
+			self.xBinning, self.yBinning = biasFrame.xBinning, biasFrame.yBinning
+		if flatFrame is not None:
+			flat = numpy.array(flatFrame.imageData, dtype=numpy.float32)
+			if self.shape is not None and self.shape != flat.shape:
+				print("WARNING: The bias and flat frames are not the same size!")
+			self.shape = flat.shape
+			flat/= numpy.median(flat)
+			with numpy.errstate(divide='ignore'):
+				self.reciprocalFlat = numpy.where(flat > 0, 1.0 / flat, 0).astype(numpy.float32)
+			if self.xBinning is not None and (self.xBinning != flatFrame.xBinning or self.yBinning != flatFrame.yBinning):
+				print("WARNING: The bias and flat frames have different binning!")
+			self.xBinning, self.yBinning = flatFrame.xBinning, flatFrame.yBinning
+
+	@property
+	def active(self):
+		return self.bias is not None or self.reciprocalFlat is not None
+
+	def apply(self, frame, computeStatistics = False):
+		""" Calibrates 'frame' and replaces its imageData with a new float32 array. Returns False if the binning or the size
+			does not match the master frames.
+		"""
+		if not self.active: return True
+		if (self.xBinning != frame.xBinning) or (self.yBinning != frame.yBinning):
+			print("WARNING: Unable to calibrate a frame with different binning!")
+			return False
+		raw = frame.imageData
+		if numpy.shape(raw) != self.shape:
+			print("WARNING: Unable to calibrate a frame of a different size!")
+			return False
+		data = numpy.empty(numpy.shape(raw), dtype=numpy.float32)
+		for start in range(0, data.shape[0], tileRows):
+			tile = slice(start, start + tileRows)
+			out = data[tile]
+			if self.bias is not None: numpy.subtract(raw[tile], self.bias[tile], out=out, casting='unsafe')
+			else: out[...] = raw[tile]
+			if self.reciprocalFlat is not None: numpy.multiply(out, self.reciprocalFlat[tile], out=out)
+		frame.imageData = data
+		if computeStatistics: frame.computeMedian()
+		return True
@@ -0,0 +1,172 @@
+""" An append-only columnar store for per-frame results (frame statistics, drift, photometry). Rows are collected in memory
+	and written out as row groups: a folder per group with one .npy file per column. A JSON index lists the groups with the
+	minimum and maximum of every scalar column in each, so a query for a target or an MJD range only opens the groups that
+	can hold matching rows, and the columns are read as memory maps so long runs can be plotted without loading them.
+"""
+
+import os, json
+import numpy
+
+
+class columnStore(object):
+	""" A table of named columns, each with a numpy dtype ('f8', 'i8', 'U32' ...) and a shape per row (() for a scalar) """
+
+	def __init__(self, folder, columns = None, rowGroupSize = 256, replace = False):
+		""" 'columns' is a list of (name, dtype, shape). It can be left out to open an existing store. If 'replace' is set, a
+			store already in the folder is deleted and a new one started.
+		"""
+		self.folder = folder
+		self.rowGroupSize = rowGroupSize
+		if not os.path.exists(folder): os.makedirs(folder)
+		self.indexFilename = os.path.join(folder, "index.json")
+		if replace and os.path.exists(self.indexFilename): self._delete()
+		if columns is not None: columns = [[name, numpy.dtype(dtype).str, list(shape)] for name, dtype, shape in columns]
+		if os.path.exists(self.indexFilename):
+			self.index = json.load(open(self.indexFilename, "rt"))
+			if columns is not None and columns != self.index["columns"]:
+				raise ValueError("%s already holds a store with different columns"%folder)
+		else:
+			if columns is None: raise ValueError("No store in %s and no columns were given"%folder)
+			self.index = { "columns": columns, "rowGroups": [], "nextGroup": 0 }
+			self._writeIndex()
+		self.columns = [name for name, dtype, shape in self.index["columns"]]
+		self.dtypes = dict((name, numpy.dtype(dtype)) for name, dtype, shape in self.index["columns"])
+		self.shapes = dict((name, tuple(shape)) for name, dtype, shape in self.index["columns"])
+		self._pending = []
+
+	def _delete(self):
+		""" Deletes the row groups and the index, leaving anything else in the folder """
+		for name in os.listdir(self.folder):
+			groupFolder = os.path.join(self.folder, name)
+			if name.startswith("group-") and os.path.isdir(groupFolder):
+				for filename in os.listdir(groupFolder): os.remove(os.path.join(groupFolder, filename))
+				os.rmdir(groupFolder)
+		os.remove(self.indexFilename)
+
+	def _writeIndex(self):
+		""" Replaces the index in one rename, so a reader never sees a half written one """
+		temporaryFilename = self.indexFilename + ".tmp"
+		outputFile = open(temporaryFilename, "wt")
+		json.dump(self.index, outputFile, indent = 1)
+		outputFile.close()
+		os.rename(temporaryFilename, self.indexFilename)
+
+	def _missing(self, name):
+		""" The value stored for a column that is left out of a row """
+		kind = self.dtypes[name].kind
+		if kind == "f": return numpy.nan
+		if kind in "US": return ""
+		return -1
+
+	def append(self, row):
+		""" Adds a row given as a dictionary of column: value. It is written out with the rest of its row group. """
+		self._pending.append(row)
+		if len(self._pending) >= self.rowGroupSize: self.flush()
+
+	def flush(self):
+		""" Writes the rows appended so far as a new row group """
+		if len(self._pending) == 0: return
+		groupName = "group-%06d"%self.index["nextGroup"]
+		groupFolder = os.path.join(self.folder, groupName)
+		if os.path.exists(groupFolder):
+			# Left over from a flush that was interrupted before the index was written
+			for filename in os.listdir(groupFolder): os.remove(os.path.join(groupFolder, filename))
+		else:
+			os.makedirs(groupFolder)
+		group = { "name": groupName, "rows": len(self._pending), "min": {}, "max": {} }
+		for name in self.columns:
+			values = numpy.empty((len(self._pending),) + self.shapes[name], dtype=self.dtypes[name])
+			for i, row in enumerate(self._pending):
+				values[i] = row.get(name, self._missing(name))
+			numpy.save(os.path.join(groupFolder, name + ".npy"), values)
+			if self.shapes[name] == () and self.dtypes[name].kind in "fiuUS":
+				finite = values[values == values].tolist()      # Leaves out NaNs
+				if len(finite) > 0:
+					group["min"][name], group["max"][name] = min(finite), max(finite)
+		self.index["rowGroups"].append(group)
+		self.index["nextGroup"]+= 1
+		self._writeIndex()
+		self._pending = []
+
+	def __len__(self):
+		return sum(group["rows"] for group in self.index["rowGroups"]) + len(self._pending)
+
+	def _groupMightMatch(self, group, where):
+		""" Whether a row group can hold rows matching 'where', judging by its minimum and maximum values """
+		for name, condition in where.items():
+			if name not in group["min"]: continue
+			low, high = condition if isinstance(condition, tuple) else (condition, condition)
+			if low is not None and group["max"][name] < low: return False
+			if high is not None and group["min"][name] > high: return False
+		return True
+
+	def groups(self, columns = None, where = None):
+		""" Yields a dictionary of memory-mapped column arrays for each row group that might match 'where', and the row mask
+			of the rows that do. 'where' is a dictionary of column: value or column: (low, high) with None for an open end.
+		"""
+		columns = self.columns if columns is None else columns
+		where = {} if where is None else where
+		self.flush()
+		for group in self.index["rowGroups"]:
+			if not self._groupMightMatch(group, where): continue
+			groupFolder = os.path.join(self.folder, group["name"])
+			data = dict((name, numpy.load(os.path.join(groupFolder, name + ".npy"), mmap_mode='r')) for name in set(columns) | set(where.keys()))
+			mask = numpy.ones(group["rows"], dtype=bool)
+			for name, condition in where.items():
+				if isinstance(condition, tuple):
+					if condition[0] is not None: mask&= data[name] >= condition[0]
+					if condition[1] is not None: mask&= data[name] <= condition[1]
+				else:
+					mask&= data[name] == condition
+			if mask.any(): yield dict((name, data[name]) for name in columns), mask
+
+	def read(self, columns = None, where = None):
+		""" Returns a dictionary of column: array of the rows matching 'where' (see groups) """
+		columns = self.columns if columns is None else columns
+		pieces = dict((name, []) for name in columns)
+		for data, mask in self.groups(columns, where):
+			for name in columns:
+				pieces[name].append(data[name][mask])
+		result = {}
+		for name in columns:
+			if pieces[name]: result[name] = numpy.concatenate(pieces[name])
+			else: result[name] = numpy.empty((0,) + self.shapes[name], dtype=self.dtypes[name])
+		return result
+
+	def dropGroups(self, name, value):
+		""" Deletes the row groups holding only rows where column 'name' is 'value' (such as a target that is being reduced
+			again). Returns the number of rows removed.
+		"""
+		self.flush()
+		keep, removed = [], 0
+		for group in self.index["rowGroups"]:
+			if group["min"].get(name) == value and group["max"].get(name) == value:
+				groupFolder = os.path.join(self.folder, group["name"])
+				for filename in os.listdir(groupFolder): os.remove(os.path.join(groupFolder, filename))
+				os.rmdir(groupFolder)
+				removed+= group["rows"]
+			else:
+				keep.append(group)
+		self.index["rowGroups"] = keep
+		self._writeIndex()
+		return removed
+
+	def close(self):
+		self.flush()
+
+
+def frameColumns(stringLength = 32):
+	""" The columns of the per-frame statistics store written by the reducers """
+	return [("target", "U%d"%stringLength, ()), ("frame", "i8", ()), ("MJD", "f8", ()), ("exposureTime", "f8", ()),
+		("CCDtemperature", "f8", ()), ("median", "f8", ()), ("min", "f8", ()), ("max", "f8", ()), ("dx", "f8", ()), ("dy", "f8", ())]
+
+def frameRow(target, frame, drift = (0, 0)):
+	""" The frame statistics row for a (calibrated) frameObject """
+	def number(value):
+		try:
+			return float(value)
+		except (TypeError, ValueError):
+			return numpy.nan
+	return { "target": target, "frame": frame.index, "MJD": number(frame.MJD), "exposureTime": number(frame.exposureTime),
+		"CCDtemperature": number(frame.CCDtemperature), "median": float(frame.median), "min": float(frame.min),
+		"max": float(frame.max), "dx": drift[0], "dy": drift[1] }
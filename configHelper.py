@@ -6,9 +6,9 @@ class configClass:
 	def __init__(self, name="unknownapp", debug=False):
 		self._appName = name
 		self._filename = getUserHome() +"/.config/" + self._appName + "/" + self._appName + ".conf"
+		self._debug = debug
 		self.createConfigFolder(self._appName)
 		self._alreadyExists = False
-		self._debug = debug
 		if self._debug: print("DEBUG: config file is at:", self._filename)
 		self.load()
 	
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+import argparse, sys, os, re, json, threading
+import datetime, time, math, itertools
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def parseRequestJSON(contentType, body):
+	""" Pulls the 'request-json' field out of a form-encoded or multipart request body """
+	if contentType.startswith("multipart/form-data"):
+		boundary = contentType.split("boundary=")[1].strip('"').encode('ascii')
+		for part in body.split(b"--" + boundary):
+			if b'name="request-json"' in part:
+				return json.loads(part.split(b"\r\n\r\n", 1)[1].rsplit(b"\r\n", 1)[0].decode('utf-8'))
+		return {}
+	fields = parse_qs(body.decode('utf-8'))
+	if "request-json" not in fields: return {}
+	return json.loads(fields["request-json"][0])
+
+def wcsHeader(ra, dec, pixelScale, width, height):
+	""" A header-only FITS file holding a simple TAN projection centred on ra, dec """
+	cards = [
+		("SIMPLE", "T"), ("BITPIX", "8"), ("NAXIS", "0"),
+		("WCSAXES", "2"), ("CTYPE1", "'RA---TAN'"), ("CTYPE2", "'DEC--TAN'"),
+		("CRVAL1", "%.8f"%ra), ("CRVAL2", "%.8f"%dec),
+		("CRPIX1", "%.2f"%(width / 2. + 0.5)), ("CRPIX2", "%.2f"%(height / 2. + 0.5)),
+		("CD1_1", "%.10E"%(-pixelScale / 3600.)), ("CD1_2", "0.0"), ("CD2_1", "0.0"), ("CD2_2", "%.10E"%(pixelScale / 3600.)),
+		("IMAGEW", "%d"%width), ("IMAGEH", "%d"%height)
+	]
+	text = "".join("%-8s= %20s"%(key, value) + " " * 50 for key, value in cards) + "END".ljust(80)
+	text+= " " * (-len(text) % 2880)
+	return text.encode('ascii')
+
+
+class fakeNova:
+	""" The state of the pretend Astrometry.net server """
+
+	def __init__(self, queueTime, solveTime, pixelScale, offset, failEvery):
+		self.queueTime = queueTime
+		self.solveTime = solveTime
+		self.pixelScale = pixelScale
+		self.offset = offset
+		self.failEvery = failEvery
+		self.submissions = {}
+		self.jobs = {}
+		self.ids = itertools.count(1)
+		self.lock = threading.Lock()
+		self.connections = 0
+		self.requests = 0
+		self.uploadBytes = 0
+
+	def submit(self, requestJSON, bodyLength):
+		with self.lock:
+			subid = next(self.ids)
+			self.uploadBytes+= bodyLength
+			self.submissions[subid] = { "created": time.time(), "job": None, "request": requestJSON }
+		return subid
+
+	def submissionStatus(self, subid):
+		with self.lock:
+			submission = self.submissions.get(subid)
+			if submission is None: return None
+			if submission["job"] is None and time.time() - submission["created"] >= self.queueTime:
+				jobid = next(self.ids)
+				request = submission["request"]
+				ra = request.get("center_ra", 180.0) + self.offset[0] / 60. / max(math.cos(math.radians(request.get("center_dec", 0.0))), 1e-6)
+				dec = request.get("center_dec", 0.0) + self.offset[1] / 60.
+				failed = self.failEvery > 0 and jobid % self.failEvery == 0
+				self.jobs[jobid] = { "started": time.time(), "ra": ra, "dec": dec, "failed": failed,
+					"width": int(request.get("image_width", 512)), "height": int(request.get("image_height", 512)) }
+				submission["job"] = jobid
+			return { "processing_started": "", "jobs": [submission["job"]] if submission["job"] is not None else [] }
+
+	def job(self, jobid):
+		with self.lock:
+			job = self.jobs.get(jobid)
+		if job is None: return None, None
+		if time.time() - job["started"] < self.solveTime: return job, "solving"
+		if job["failed"]: return job, "failure"
+		return job, "success"
+
+
+class fakeNovaHandler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"      # Keep-alive, so clients can reuse connections
+
+	def setup(self):
+		BaseHTTPRequestHandler.setup(self)
+		with self.server.nova.lock:
+			self.server.nova.connections+= 1
+			self.connectionNumber = self.server.nova.connections
+
+	def log_message(self, format, *args):
+		if self.server.verbose: sys.stdout.write("[connection %d] %s\n"%(self.connectionNumber, format%args))
+
+	def reply(self, status, body, contentType = "application/json"):
+		if not isinstance(body, bytes): body = json.dumps(body).encode('utf-8')
+		self.send_response(status)
+		self.send_header("Content-Type", contentType)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_POST(self):
+		length = int(self.headers.get("Content-Length", 0))
+		body = self.rfile.read(length)
+		self.handle_api(parseRequestJSON(self.headers.get("Content-Type", ""), body), length)
+
+	def do_GET(self):
+		self.handle_api({}, 0)
+
+	def handle_api(self, requestJSON, bodyLength):
+		nova = self.server.nova
+		with nova.lock: nova.requests+= 1
+		path = self.path.split("?")[0]
+		if path == "/api/login":
+			return self.reply(200, { "status": "success", "message": "authenticated user", "session": "fakesession" })
+		if path in ["/api/upload", "/api/url_upload"]:
+			return self.reply(200, { "status": "success", "subid": nova.submit(requestJSON, bodyLength), "hash": "0" * 40 })
+		if path == "/api/stats":
+			return self.reply(200, { "status": "success", "connections": nova.connections, "requests": nova.requests, "uploadBytes": nova.uploadBytes })
+		r = re.match(r"/api/submissions/([0-9]+)$", path)
+		if r:
+			status = nova.submissionStatus(int(r.group(1)))
+			if status is None: return self.reply(404, { "status": "error", "errormessage": "no such submission" })
+			return self.reply(200, status)
+		r = re.match(r"/api/jobs/([0-9]+)(/[a-z_]+)?$", path)
+		if r:
+			job, status = nova.job(int(r.group(1)))
+			if job is None: return self.reply(404, { "status": "error", "errormessage": "no such job" })
+			endpoint = r.group(2)
+			if endpoint is None: return self.reply(200, { "status": status })
+			if endpoint in ["/calibration", "/info"]:
+				calibration = { "ra": job["ra"], "dec": job["dec"], "radius": nova.pixelScale * job["width"] / 3600. / math.sqrt(2),
+					"pixscale": nova.pixelScale, "orientation": 180.0, "parity": 1.0 }
+				if endpoint == "/info": return self.reply(200, { "status": status, "calibration": calibration, "tags": [], "machine_tags": [], "objects_in_field": [] })
+				return self.reply(200, calibration)
+			return self.reply(200, { endpoint[1:]: [] })
+		r = re.match(r"/(wcs_file|new_fits_file|kml_file)/([0-9]+)/?$", path)
+		if r:
+			job, status = nova.job(int(r.group(2)))
+			if job is None or status != "success": return self.reply(404, b"not solved", "text/plain")
+			return self.reply(200, wcsHeader(job["ra"], job["dec"], nova.pixelScale, job["width"], job["height"]), "application/fits")
+		self.reply(404, { "status": "error", "errormessage": "unknown endpoint %s"%path })
+
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser(description='Pretends to be the nova.astrometry.net API so astrometryClient can be tested without a network.')
+	parser.add_argument('-p', '--port', type=int, default=8090, help='Port to listen on. Point the client at http://localhost:PORT/api/')
+	parser.add_argument('--queue', type=float, default=2.0, help='Seconds before a submission is given a job.')
+	parser.add_argument('--solve', type=float, default=3.0, help='Seconds a job takes to solve.')
+	parser.add_argument('--pixelscale', type=float, default=1.2, help='Pixel scale (arcsec) reported in the solutions.')
+	parser.add_argument('--offset', type=float, nargs=2, default=[0.0, 0.0], help='Pointing error (arcmin in RA and Dec) added to the requested centre.')
+	parser.add_argument('--failevery', type=int, default=0, help='Make every n-th job fail.')
+	parser.add_argument('-v', '--verbose', action="store_true", help='Log every request.')
+	args = parser.parse_args()
+
+	server = ThreadingHTTPServer(("localhost", args.port), fakeNovaHandler)
+	server.nova = fakeNova(args.queue, args.solve, args.pixelscale, args.offset, args.failevery)
+	server.verbose = args.verbose
+	server.daemon_threads = True
+	print("Fake Astrometry.net listening on http://localhost:%d/api/"%args.port)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		print("Served %d requests on %d connections"%(server.nova.requests, server.nova.connections))
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+""" Stands in for INDI's 'getINDI' for the pretend camera. Prints device.property.element=value for each name given, in
+	the same form as getINDI. When an exposure has finished, the first call to notice writes the frame: a star field at the
+	telescope's real position with its true WCS in the header, which fakeSolveField.py reads back as the 'solution'.
+"""
+
+import sys, os, time
+import fakeHardware
+
+
+def sexagesimal(value, hours = False):
+	if hours: value/= 15.
+	sign = "-" if value < 0 else "+"
+	value = abs(value)
+	degrees = int(value)
+	minutes = int((value - degrees) * 60)
+	seconds = (value - degrees - minutes / 60.) * 3600
+	return ("" if hours else sign) + "%02d:%02d:%05.2f"%(degrees, minutes, seconds)
+
+def writeFrame(state):
+	from astropy.io import fits
+	exposure = state["exposure"]
+	camera = state["camera"]
+	device = exposure["device"]
+	xBinning = int(camera.get(device + ".image_binning.x", 1))
+	yBinning = int(camera.get(device + ".image_binning.y", 1))
+	width = int(camera.get(device + ".image_region.w", 1024)) // xBinning
+	height = int(camera.get(device + ".image_region.h", 1024)) // yBinning
+	state["frameNumber"]+= 1
+	data, header, stars = fakeHardware.starField(exposure["ra"], exposure["dec"], width, height, state["pixelScale"] * xBinning, state["frameNumber"])
+	header['RA'] = (sexagesimal(exposure["commanded"][0], hours = True), 'Telescope RA')
+	header['DEC'] = (sexagesimal(exposure["commanded"][1]), 'Telescope Dec')
+	header['EXPTIME'] = exposure["exposureTime"]
+	header['XBINNING'], header['YBINNING'] = xBinning, yBinning
+	header['MJD-OBS'] = exposure["start"] / 86400. + 40587.0
+	if not os.path.exists(state["outputFolder"]): os.makedirs(state["outputFolder"])
+	baseName = os.path.basename(camera.get(device + ".archive.base_name", "fake-"))
+	filename = os.path.join(state["outputFolder"], "%s%06d.fits"%(baseName, state["frameNumber"]))
+	fits.writeto(filename, data, header, overwrite = True)
+	# So that fakeSolveField.py can tell which frame a source list was made from
+	state["frames"] = (state["frames"] + [{ "filename": filename, "x": stars[0], "y": stars[1] }])[-fakeHardware.framesKept:]
+	camera[device + ".file.name"] = filename
+	camera[device + ".sequence.run"] = "Off"
+	state["exposure"] = None
+
+
+if __name__ == "__main__":
+
+	with fakeHardware.lockedState() as state:
+		if state["exposure"] is not None and time.time() >= state["exposure"]["end"]:
+			writeFrame(state)
+		for name in sys.argv[1:]:
+			print("%s=%s"%(name, state["camera"].get(name, "")))
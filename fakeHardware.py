@@ -0,0 +1,88 @@
+""" Shared state for the stand-in 'tel', 'setINDI' and 'getINDI' scripts (fakeTel.py, fakeSetINDI.py and fakeGetINDI.py),
+	so the acquisition code can be run with no telescope or camera. Each script is a separate process, like the real tools,
+	so the state of the pretend telescope and camera is kept in a JSON file (FAKESAFT_STATE, or /tmp/fakeSAFT.json).
+"""
+
+import os, json, time, math, fcntl
+
+stateFilename = os.environ.get("FAKESAFT_STATE", "/tmp/fakeSAFT.json")
+framesKept = 50
+
+defaultState = {
+	"telescope": {
+		"ra": 0.0, "dec": 0.0,                 # Commanded position (degrees)
+		"slewEnd": 0.0,
+		"slewRate": 2.0,                       # Degrees per second
+		"settleTime": 1.0,
+		"pointingError": [3.0, -2.0],          # Systematic error in RA and Dec (arcmin) between commanded and real
+		"jitter": 2.0                          # Random error (arcsec) added to each slew
+	},
+	"camera": {},                              # Properties set with setINDI
+	"exposure": None,
+	"frameNumber": 0,
+	"frames": [],                              # The last frames written: their filenames and star positions
+	"outputFolder": "/tmp/fakeSAFT",
+	"pixelScale": 1.2                          # Arcsec per unbinned pixel
+}
+
+
+class lockedState(object):
+	""" Use as 'with lockedState() as state:'. The state is read with an exclusive lock held, and written back at the end. """
+
+	def __enter__(self):
+		self.lockFile = open(stateFilename + ".lock", "a")
+		fcntl.flock(self.lockFile, fcntl.LOCK_EX)
+		self.state = json.loads(json.dumps(defaultState))
+		if os.path.exists(stateFilename):
+			self.state.update(json.load(open(stateFilename, "rt")))
+		return self.state
+
+	def __exit__(self, excType, excValue, traceback):
+		if excType is None:
+			temporaryFilename = stateFilename + ".tmp"
+			json.dump(self.state, open(temporaryFilename, "wt"), indent = 4)
+			os.rename(temporaryFilename, stateFilename)
+		fcntl.flock(self.lockFile, fcntl.LOCK_UN)
+		self.lockFile.close()
+		return False
+
+def parseAngle(text, hours = False):
+	""" Reads decimal degrees or sexagesimal 'HH:MM:SS.s' / '+DD:MM:SS' (hours for RA if 'hours' is True) """
+	if ":" not in text: return float(text)
+	parts = text.strip().split(":")
+	sign = -1 if parts[0].strip().startswith("-") else 1
+	value = abs(float(parts[0])) + float(parts[1]) / 60. + (float(parts[2]) / 3600. if len(parts) > 2 else 0)
+	return sign * value * (15. if hours else 1.)
+
+def truePointing(telescope):
+	""" Where the telescope is really pointing: the commanded position plus the pointing error and the jitter of the last slew """
+	error = telescope["pointingError"]
+	jitter = telescope.get("lastJitter", [0, 0])
+	dec = telescope["dec"] + error[1] / 60. + jitter[1] / 3600.
+	ra = telescope["ra"] + (error[0] / 60. + jitter[0] / 3600.) / max(math.cos(math.radians(dec)), 1e-6)
+	return ra % 360., dec
+
+def starField(ra, dec, width, height, pixelScale, seed):
+	""" A star field image and a TAN WCS header for a frame centred on ra, dec, and the (zero-based) x and y lists of the
+		stars in it
+	"""
+	# Imported here so that the scripts that only read or set properties start quickly
+	import numpy
+	from astropy.io import fits
+	random = numpy.random.RandomState(seed)
+	data = random.normal(400, 10, (height, width)).astype(numpy.float32)
+	y, x = numpy.mgrid[0:height, 0:width]
+	stars = ([], [])
+	for i in range(25):
+		x0, y0, flux = random.uniform(5, width - 5), random.uniform(5, height - 5), random.uniform(2e3, 5e4)
+		stars[0].append(x0)
+		stars[1].append(y0)
+		cutout = (slice(max(0, int(y0) - 8), int(y0) + 8), slice(max(0, int(x0) - 8), int(x0) + 8))
+		data[cutout]+= flux / (2 * numpy.pi * 3) * numpy.exp(-((x[cutout] - x0)**2 + (y[cutout] - y0)**2) / 6.)
+	header = fits.Header()
+	header['CTYPE1'], header['CTYPE2'] = 'RA---TAN', 'DEC--TAN'
+	header['CRVAL1'], header['CRVAL2'] = ra, dec
+	header['CRPIX1'], header['CRPIX2'] = width / 2. + 0.5, height / 2. + 0.5
+	header['CD1_1'], header['CD1_2'] = -pixelScale / 3600., 0.0
+	header['CD2_1'], header['CD2_2'] = 0.0, pixelScale / 3600.
+	return numpy.clip(data, 0, 65535).astype(numpy.uint16), header, stars
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+
+""" Stands in for INDI's 'setINDI' for the pretend camera. Properties are given as device.property.element=value and are
+	stored in the shared state (see fakeHardware.py). Setting 'sequence.run=On' starts an exposure.
+"""
+
+import sys, time
+import fakeHardware
+
+
+if __name__ == "__main__":
+
+	if len(sys.argv) < 2:
+		print("usage: fakeSetINDI.py device.property.element=value ...")
+		sys.exit(-1)
+
+	with fakeHardware.lockedState() as state:
+		for assignment in sys.argv[1:]:
+			if "=" not in assignment:
+				print("Bad assignment: %s"%assignment)
+				sys.exit(-1)
+			name, value = assignment.split("=", 1)
+			state["camera"][name] = value
+			device, propertyName = name.split(".")[0], ".".join(name.split(".")[1:])
+			if propertyName == "sequence.run" and value == "On":
+				camera = state["camera"]
+				exposureTime = float(camera.get(device + ".image_exposure.time", 1))
+				ra, dec = fakeHardware.truePointing(state["telescope"])
+				state["exposure"] = { "device": device, "start": time.time(), "end": time.time() + exposureTime + 0.5,
+					"ra": ra, "dec": dec, "commanded": [state["telescope"]["ra"], state["telescope"]["dec"]],
+					"exposureTime": exposureTime }
+				state["camera"][device + ".sequence.run"] = "On"
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+""" Stands in for astrometry.net's 'solve-field' when testing with the pretend camera. The frames written by fakeGetINDI.py
+	carry their true WCS, so 'solving' is copying it to the .wcs file. A source list (.xyls) is solved from the frame whose
+	stars it matches, out of the last frames fakeGetINDI.py recorded in the shared state. Only the options
+	localSolver.LocalClient uses are read.
+"""
+
+import sys, os, time, json
+import numpy
+from astropy.io import fits
+import fakeHardware
+
+
+def frameOfSourceList(filename, tolerance = 2.0):
+	""" The filename of the recent frame whose stars match those in a source list, or None """
+	table = fits.getdata(filename, 1)
+	x, y = numpy.asarray(table['X'], dtype=numpy.float64) - 1, numpy.asarray(table['Y'], dtype=numpy.float64) - 1
+	if len(x) == 0 or not os.path.exists(fakeHardware.stateFilename): return None
+	best, bestMatches = None, 0
+	for frame in json.load(open(fakeHardware.stateFilename, "rt")).get("frames", []):
+		frameX, frameY = numpy.asarray(frame["x"]), numpy.asarray(frame["y"])
+		distances = numpy.hypot(x[:, None] - frameX[None, :], y[:, None] - frameY[None, :]).min(axis=1)
+		matches = numpy.count_nonzero(distances <= tolerance)
+		if matches > bestMatches: best, bestMatches = frame["filename"], matches
+	return best if bestMatches >= min(4, len(x)) else None
+
+
+if __name__ == "__main__":
+
+	options = {}
+	arguments = sys.argv[1:]
+	index = 0
+	while index < len(arguments) - 1:
+		if arguments[index] in ["--dir", "--out", "--new-fits", "--cpulimit"]:
+			options[arguments[index]] = arguments[index + 1]
+			index+= 1
+		index+= 1
+	filename = arguments[-1]
+	base = os.path.join(options.get("--dir", "."), options.get("--out", os.path.splitext(os.path.basename(filename))[0]))
+
+	time.sleep(0.5)
+	header = fits.getheader(filename)
+	if 'CRVAL1' not in header and filename.endswith(".xyls"):
+		imageFilename = frameOfSourceList(filename)
+		if imageFilename is not None:
+			filename = imageFilename
+			header = fits.getheader(filename)
+	if 'CRVAL1' not in header:
+		print("Did not solve (no WCS in %s)"%filename)
+		sys.exit(0)
+	wcs = fits.Header()
+	for key in ['CTYPE1', 'CTYPE2', 'CRVAL1', 'CRVAL2', 'CRPIX1', 'CRPIX2', 'CD1_1', 'CD1_2', 'CD2_1', 'CD2_2']:
+		wcs[key] = header[key]
+	wcs['IMAGEW'], wcs['IMAGEH'] = header['NAXIS1'], header['NAXIS2']
+	fits.PrimaryHDU(header = wcs).writeto(base + ".wcs", overwrite = True)
+	open(base + ".solved", "wb").close()
+	if "--new-fits" in options and options["--new-fits"] != "none":
+		fits.writeto(options["--new-fits"], fits.getdata(filename), header, overwrite = True)
+	print("Field solved: %s"%base)
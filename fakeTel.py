@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+
+""" Stands in for the 'tel' telescope control program. 'track RA DEC' slews the pretend telescope (taking as long as a real
+	slew would) and 'status' prints where it is pointing. See fakeHardware.py for the shared state.
+"""
+
+import sys, time, math, random
+import fakeHardware
+
+
+if __name__ == "__main__":
+
+	# Not argparse: a negative declination would be taken for an option
+	if len(sys.argv) < 2 or sys.argv[1] not in ["track", "status", "error"]:
+		print("usage: fakeTel.py track RA DEC | status | error DRA DDEC (arcmin)")
+		sys.exit(-1)
+	command = sys.argv[1]
+	values = sys.argv[2:4]
+
+	if command == "status":
+		with fakeHardware.lockedState() as state:
+			telescope = state["telescope"]
+		ra, dec = fakeHardware.truePointing(telescope)
+		print("commanded %.6f %.6f  actual %.6f %.6f  %s"%(telescope["ra"], telescope["dec"], ra, dec, "slewing" if time.time() < telescope["slewEnd"] else "tracking"))
+		sys.exit(0)
+
+	if len(values) != 2:
+		print("%s needs two values"%command)
+		sys.exit(-1)
+
+	if command == "error":
+		with fakeHardware.lockedState() as state:
+			state["telescope"]["pointingError"] = [float(values[0]), float(values[1])]
+		sys.exit(0)
+
+	ra, dec = fakeHardware.parseAngle(values[0], hours = True), fakeHardware.parseAngle(values[1])
+	with fakeHardware.lockedState() as state:
+		telescope = state["telescope"]
+		distance = math.hypot((ra - telescope["ra"]) * math.cos(math.radians(dec)), dec - telescope["dec"])
+		slewTime = distance / telescope["slewRate"] + telescope["settleTime"]
+		telescope["ra"], telescope["dec"] = ra, dec
+		telescope["lastJitter"] = [random.gauss(0, telescope["jitter"]), random.gauss(0, telescope["jitter"])]
+		telescope["slewEnd"] = time.time() + slewTime
+	print("Slewing to %.6f %.6f (%.1f s)"%(ra, dec, slewTime))
+	time.sleep(slewTime)
+	print("Tracking")
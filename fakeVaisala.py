@@ -46,6 +46,7 @@ def parseWeatherData(data):
 if __name__ == "__main__":
 	
 	parser = argparse.ArgumentParser(description='Pretends to be the Vaisala weather station and reports some faked data.')
+	parser.add_argument('--delay', type=float, default=0, help='Wait this many seconds before answering, like a slow or hung station.')
 	parser.add_argument('--save', action="store_true", help='Write the input parameters to the config file as default values.')
 	args = parser.parse_args()
 	
@@ -59,6 +60,7 @@ if __name__ == "__main__":
 	}
 	config.setDefaults(configDefaults)
 	
+	time.sleep(args.delay)
 	now = datetime.datetime.now()
 	nowString = now.strftime("%Y-%m-%dT%H:%M:%S")
 	
@@ -0,0 +1,155 @@
+""" Watches a data directory for new frames written by the camera. Uses inotify on Linux and falls back to polling elsewhere """
+
+import os, re, sys, time, select, struct, errno
+import ctypes, ctypes.util
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+eventHeader = struct.Struct("iIII")
+
+
+def frameNumberKey(filename):
+	""" Sort key that orders files by the frame number at the end of their name, eg WD1145-000123.fits """
+	r = re.search(r"([0-9]+)\.[A-Za-z.]+$", filename)
+	if r: return (0, int(r.group(1)), filename)
+	return (1, 0, filename)
+
+
+class inotifyHandle:
+	""" A minimal ctypes wrapper around the Linux inotify API """
+
+	def __init__(self, path, mask = IN_CLOSE_WRITE | IN_MOVED_TO):
+		libcName = ctypes.util.find_library("c")
+		if libcName is None: raise OSError("Could not find libc")
+		libc = ctypes.CDLL(libcName, use_errno=True)
+		if not hasattr(libc, "inotify_init1"): raise OSError("inotify is not available")
+		self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+		if self.fd < 0: raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+		encodedPath = path.encode(sys.getfilesystemencoding()) if not isinstance(path, bytes) else path
+		self.wd = libc.inotify_add_watch(self.fd, ctypes.c_char_p(encodedPath), mask)
+		if self.wd < 0:
+			os.close(self.fd)
+			raise OSError(ctypes.get_errno(), "inotify_add_watch failed for %s"%path)
+
+	def read(self, timeout):
+		""" Waits up to 'timeout' seconds for events and returns the filenames that were closed or moved into the folder """
+		filenames = []
+		try:
+			ready, _, _ = select.select([self.fd], [], [], timeout)
+		except select.error as e:
+			if e.args[0] == errno.EINTR: return filenames
+			raise
+		if not ready: return filenames
+		while True:
+			try:
+				buffer = os.read(self.fd, 65536)
+			except OSError as e:
+				if e.errno == errno.EAGAIN: break
+				raise
+			offset = 0
+			while offset + eventHeader.size <= len(buffer):
+				wd, mask, cookie, length = eventHeader.unpack_from(buffer, offset)
+				offset+= eventHeader.size
+				name = buffer[offset:offset + length].rstrip(b"\0")
+				offset+= length
+				if name: filenames.append(name.decode(sys.getfilesystemencoding()))
+		return filenames
+
+	def close(self):
+		if self.fd is not None:
+			os.close(self.fd)
+			self.fd = None
+
+
+class directoryWatcher:
+	""" Reports each matching file in a folder exactly once, after the camera has finished writing it.
+		A file counts as finished when inotify sees it closed (or renamed into place), or, when polling, once its size
+		has not changed between two checks or it has not been modified for 'settleTime' seconds.
+	"""
+
+	def __init__(self, path, pattern = None, usePolling = False, settleTime = 2.0, sortKey = frameNumberKey):
+		self.path = path
+		if pattern is not None and not hasattr(pattern, "search"): pattern = re.compile(pattern)
+		self.pattern = pattern
+		self.settleTime = settleTime
+		self.sortKey = sortKey
+		self.seen = set()
+		self.pending = {}
+		self.backlog = []
+		self.inotify = None
+		if not os.path.isdir(path):
+			raise OSError(errno.ENOENT, "Could not find the directory %s"%path)
+		if not usePolling:
+			try:
+				self.inotify = inotifyHandle(path)
+			except (OSError, AttributeError) as e:
+				print("WARNING: inotify unavailable (%s), polling %s instead"%(str(e), path))
+				self.inotify = None
+		# Anything already in the folder is checked with the same rules as the polling mode
+		self.backlog = self._scan()
+
+	def _match(self, f):
+		if self.pattern is None: return f
+		r = self.pattern.search(f)
+		if r: return r.group(0)
+		return None
+
+	def _scan(self, candidates = None):
+		""" Looks at the folder listing (or just 'candidates') and returns the files that have settled """
+		ready = []
+		now = time.time()
+		if candidates is None: candidates = os.listdir(self.path)
+		for f in candidates:
+			if f in self.seen: continue
+			filename = self._match(f)
+			if filename is None or filename in self.seen: continue
+			try:
+				info = os.stat(os.path.join(self.path, f))
+			except OSError:
+				continue
+			previousSize = self.pending.get(filename)
+			if info.st_size > 0 and (previousSize == info.st_size or now - info.st_mtime >= self.settleTime):
+				ready.append(filename)
+			else:
+				self.pending[filename] = info.st_size
+		return ready
+
+	def _accept(self, filenames):
+		newFiles = []
+		for filename in filenames:
+			if filename in self.seen: continue
+			self.seen.add(filename)
+			self.pending.pop(filename, None)
+			newFiles.append(filename)
+		return sorted(newFiles, key=self.sortKey)
+
+	def getNewFiles(self, timeout = 0):
+		""" Returns a list of newly completed files in capture order, waiting up to 'timeout' seconds for at least one to appear """
+		if self.backlog:
+			ready, self.backlog = self.backlog, []
+			return self._accept(ready)
+		if self.inotify is None:
+			ready = self._scan()
+			if not ready and timeout > 0:
+				time.sleep(timeout)
+				ready = self._scan()
+			return self._accept(ready)
+
+		ready = []
+		for f in self.inotify.read(timeout):
+			filename = self._match(f)
+			if filename is not None: ready.append(filename)
+		# Files that were already being written when we started never generate a close event for us, so poll those
+		if self.pending: ready.extend(self._scan(list(self.pending.keys())))
+		return self._accept(ready)
+
+	def markSeen(self, filenames):
+		for filename in filenames:
+			self.seen.add(filename)
+			self.pending.pop(filename, None)
+
+	def close(self):
+		if self.inotify is not None: self.inotify.close()
+		self.inotify = None
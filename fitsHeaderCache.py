@@ -0,0 +1,132 @@
+""" Reads only the primary header of FITS files and keeps the results in a small SQLite cache, keyed by path, mtime and size,
+	so that the logger, the reducer and the summary tools can look up a night's headers without reopening every frame.
+"""
+
+import os, gzip, json, sqlite3, threading
+from astropy.io import fits
+import configHelper
+
+blockSize = 2880
+cardSize = 80
+
+
+def readPrimaryHeader(filename):
+	""" Reads the primary header of a (possibly gzipped) FITS file block by block, stopping at the END card """
+	if filename.endswith(".gz"): f = gzip.open(filename, "rb")
+	else: f = open(filename, "rb")
+	try:
+		blocks = []
+		while True:
+			block = f.read(blockSize)
+			if len(block) < blockSize: raise IOError("%s: reached end of file before the END card"%filename)
+			blocks.append(block)
+			if any(block[i:i+8] == b"END     " for i in range(0, blockSize, cardSize)): break
+	finally:
+		f.close()
+	return fits.Header.fromstring(b"".join(blocks).decode("ascii", "replace"))
+
+def headerToDict(header):
+	""" Converts an astropy header to a plain dictionary that can be stored as JSON. Commentary cards are dropped. """
+	headerDict = {}
+	for card in header.cards:
+		if card.keyword in ("", "COMMENT", "HISTORY"): continue
+		value = card.value
+		if not isinstance(value, (str, int, float, bool)): value = str(value)
+		headerDict[card.keyword] = value
+	return headerDict
+
+
+class headerCache:
+	""" A cache of FITS primary headers stored in SQLite. An entry is valid while the file's mtime and size are unchanged. """
+
+	def __init__(self, filename = None):
+		if filename is None:
+			folder = configHelper.getUserHome() + "/.config/fitsHeaderCache"
+			if not os.path.exists(folder): os.makedirs(folder)
+			filename = folder + "/fitsHeaders.db"
+		self.filename = filename
+		self.hits = 0
+		self.misses = 0
+		self._lock = threading.Lock()
+		self._db = sqlite3.connect(filename, timeout = 30, check_same_thread = False)
+		self._db.execute("PRAGMA journal_mode=WAL")
+		self._db.execute("CREATE TABLE IF NOT EXISTS headers (path TEXT PRIMARY KEY, folder TEXT, mtime REAL, size INTEGER, header TEXT)")
+		self._db.execute("CREATE INDEX IF NOT EXISTS headersByFolder ON headers (folder)")
+		self._db.commit()
+
+	def getHeader(self, filename):
+		""" Returns the primary header of 'filename' as a dictionary, reading the file only if the cached copy is stale """
+		return self.getHeaders([filename])[0]
+
+	def getHeaders(self, filenames):
+		""" Returns a list of header dictionaries for 'filenames'. Stale or missing entries are read and stored in one transaction. """
+		headers = []
+		updates = []
+		with self._lock:
+			for filename in filenames:
+				path = os.path.abspath(filename)
+				info = os.stat(path)
+				row = self._db.execute("SELECT mtime, size, header FROM headers WHERE path=?", (path,)).fetchone()
+				if row is not None and row[0] == info.st_mtime and row[1] == info.st_size:
+					self.hits+= 1
+					headers.append(json.loads(row[2]))
+					continue
+				self.misses+= 1
+				header = headerToDict(readPrimaryHeader(path))
+				updates.append((path, os.path.dirname(path), info.st_mtime, info.st_size, json.dumps(header)))
+				headers.append(header)
+			if updates:
+				self._db.executemany("INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?, ?)", updates)
+				self._db.commit()
+		return headers
+
+	def getFolderHeaders(self, folder):
+		""" Returns {filename: header} for every cached file in 'folder' without touching the files themselves """
+		folder = os.path.abspath(folder)
+		with self._lock:
+			rows = self._db.execute("SELECT path, header FROM headers WHERE folder=?", (folder,)).fetchall()
+		return dict((os.path.basename(path), json.loads(header)) for path, header in rows)
+
+	def forget(self, folder):
+		with self._lock:
+			self._db.execute("DELETE FROM headers WHERE folder=?", (os.path.abspath(folder),))
+			self._db.commit()
+
+	def close(self):
+		with self._lock:
+			self._db.close()
+
+
+_defaultCache = None
+_defaultCacheProcess = None
+_inheritedCaches = []     # Caches opened before a fork. Kept so that they are never closed (or used) in the child.
+
+def getDefaultCache():
+	""" Returns the cache that is shared by all the tools (in ~/.config/fitsHeaderCache). A process started with fork (such
+		as a multiprocessing worker) opens a connection of its own, as an SQLite connection must not be used across a fork.
+	"""
+	global _defaultCache, _defaultCacheProcess
+	if _defaultCache is None or _defaultCacheProcess != os.getpid():
+		if _defaultCache is not None: _inheritedCaches.append(_defaultCache)
+		_defaultCache = headerCache()
+		_defaultCacheProcess = os.getpid()
+	return _defaultCache
+
+def getHeader(filename):
+	return getDefaultCache().getHeader(filename)
+
+
+if __name__ == "__main__":
+	import argparse
+
+	parser = argparse.ArgumentParser(description='Reads the headers of all the FITS files in a folder into the shared header cache and lists them.')
+	parser.add_argument('folder', type=str, help='Folder containing the FITS files.')
+	parser.add_argument('-k', '--keywords', type=str, nargs='+', default=['OBJECT', 'MJD-OBS', 'EXPTIME', 'XBINNING', 'ELEVATIO'], help='Header cards to list.')
+	args = parser.parse_args()
+
+	cache = getDefaultCache()
+	filenames = sorted(f for f in os.listdir(args.folder) if f.endswith((".fits", ".fit", ".FIT", ".fits.gz", ".fit.gz")))
+	headers = cache.getHeaders([os.path.join(args.folder, f) for f in filenames])
+	for filename, header in zip(filenames, headers):
+		print(filename + "\t" + "\t".join(str(header.get(k, "--")) for k in args.keywords))
+	print("Cache hits: %d  misses: %d"%(cache.hits, cache.misses))
@@ -0,0 +1,112 @@
+""" A stacking engine for the live and batch reducers. Frames are summed in place into a float64 accumulator, and the most
+	recent frames can optionally be kept in a fixed size ring buffer for a windowed median or sigma-clipped combine.
+"""
+
+import numpy
+import saftClasses, registration
+
+
+def sigmaClippedMean(data, sigma = 3.0, iterations = 3):
+	""" Combines a (n, height, width) cube along the first axis, rejecting pixels more than 'sigma' deviations from the median """
+	mask = numpy.ones(data.shape, dtype=bool)
+	for i in range(iterations):
+		masked = numpy.where(mask, data, numpy.nan)
+		centre = numpy.nanmedian(masked, axis=0)
+		spread = numpy.nanstd(masked, axis=0)
+		newMask = numpy.abs(data - centre) <= sigma * spread
+		if numpy.array_equal(newMask, mask): break
+		mask = newMask
+	return numpy.nanmean(numpy.where(mask, data, numpy.nan), axis=0)
+
+
+class frameStacker(object):
+	""" Accumulates frames into a running sum. The cost of adding a frame does not grow with the number of frames stacked.
+		If 'windowSize' is set, the last 'windowSize' frames are also kept (as float32) for median or sigma-clipped combines.
+	"""
+
+	def __init__(self, windowSize = 0):
+		self.windowSize = windowSize
+		self.sum = None
+		self.count = 0
+		self.window = None
+		self.windowCount = 0
+		self.firstFrame = None
+		self._shifted = None
+		self._statistics = {}
+
+	def addFrame(self, frame, offset = None):
+		""" Adds a frameObject to the stack, moved by 'offset' = (dx, dy) pixels if given. Returns False if it could not be added. """
+		if self.firstFrame is None:
+			self.firstFrame = frame
+			self.sum = numpy.zeros(numpy.shape(frame.imageData), dtype=numpy.float64)
+			if self.windowSize > 0:
+				self.window = numpy.empty((self.windowSize,) + self.sum.shape, dtype=numpy.float32)
+		elif not self.canAdd(frame):
+			print("WARNING: Unable to stack a frame with different binning or size!")
+			return False
+		data = frame.imageData
+		if offset is not None:
+			self._shifted = registration.shiftImage(data, offset[0], offset[1], out=self._shifted)
+			data = self._shifted
+		numpy.add(self.sum, data, out=self.sum)
+		if self.window is not None: self.addWindowFrame(data)
+		self.count+= 1
+		self._statistics = {}
+		return True
+
+	def canAdd(self, frame):
+		""" Whether a frame has the binning and size of the first frame. Check this before registering a frame. """
+		if self.firstFrame is None: return True
+		if (self.firstFrame.xBinning, self.firstFrame.yBinning) != (frame.xBinning, frame.yBinning): return False
+		return numpy.shape(frame.imageData) == self.sum.shape
+
+	def addWindowFrame(self, data):
+		""" Puts an image in the ring buffer without adding it to the sum (for frames summed elsewhere, see addSum) """
+		self.window[self.windowCount % self.windowSize] = data
+		self.windowCount+= 1
+
+	def addSum(self, total, count):
+		""" Adds the sum of 'count' frames that were stacked elsewhere, such as by the backlogReducer's worker processes """
+		numpy.add(self.sum, total, out=self.sum)
+		self.count+= count
+		self._statistics = {}
+
+	@property
+	def windowFrames(self):
+		""" The frames currently held in the ring buffer (in no particular order) """
+		if self.window is None: return None
+		return self.window[:min(self.windowCount, self.windowSize)]
+
+	def mean(self):
+		return self.sum / self.count
+
+	def windowMedian(self):
+		return numpy.median(self.windowFrames, axis=0)
+
+	def windowSigmaClipped(self, sigma = 3.0, iterations = 3):
+		return sigmaClippedMean(self.windowFrames, sigma, iterations)
+
+	def combined(self, method = "sum"):
+		""" Returns the stacked image, combined with 'sum', 'mean', 'median' or 'sigmaclip' (the last two use the window) """
+		if method == "sum": return self.sum
+		if method == "mean": return self.mean()
+		if self.window is None:
+			raise ValueError("A '%s' combine needs a stacker created with a windowSize"%method)
+		if method == "median": return self.windowMedian()
+		if method == "sigmaclip": return self.windowSigmaClipped()
+		raise ValueError("Unknown combine method: %s"%method)
+
+	def statistics(self):
+		""" Median, min and max of the running sum. They are only computed when asked for and are cached until the next frame. """
+		if not self._statistics:
+			self._statistics = { "median": numpy.median(self.sum), "min": self.sum.min(), "max": self.sum.max() }
+		return self._statistics
+
+	def asFrame(self, method = "sum"):
+		""" Wraps the stacked image in a frameObject (without copying the running sum) so it can be displayed or searched """
+		frame = saftClasses.frameObject(index = self.count, lazy = True)
+		frame.setMetadata(dict((self.firstFrame.metadata[key], getattr(self.firstFrame, key)) for key in self.firstFrame.metadata.keys()))
+		frame.frameType = "stack"
+		frame.imageData = self.combined(method)
+		frame.xSize, frame.ySize = numpy.shape(frame.imageData)
+		return frame
@@ -0,0 +1,175 @@
+""" A compact table of frame metadata for tools that keep track of thousands of frames. Each frame is one row of a numpy
+	structured array (40 bytes) instead of a frameObject or a dictionary of header values, target names and filenames are
+	stored once and referred to by number, and queries such as 'the frames of a target between two MJDs' are numpy
+	comparisons over whole columns. Tables are built in bulk from the shared FITS header cache.
+"""
+
+import os, re
+import numpy
+import fitsHeaderCache
+
+framePattern = re.compile(".*(-|.|_)[0-9]+.(fits.gz|fit.gz|fits|fit|FIT)")
+targetFramePattern = re.compile("^([A-Z,a-z,0-9]*)-([0-9]+)")
+
+frameDtype = numpy.dtype([
+	("target", "i4"),             # Index into frameTable.targets
+	("frame", "i4"),              # Frame number from the filename
+	("file", "i4"),               # Index into frameTable.filenames
+	("MJD", "f8"),
+	("exposureTime", "f4"),
+	("xBinning", "i2"),
+	("yBinning", "i2"),
+	("CCDtemperature", "f4"),
+	("median", "f4"),             # Not in the headers, NaN until set with setMedians
+	("airmass", "f4")
+])
+
+
+def parseFrameFilename(filename):
+	""" Returns (targetName, frameNumber) for a filename like 'WD1145-000123.fits', or None if it is not a frame """
+	if not framePattern.search(filename): return None
+	r = targetFramePattern.search(filename)
+	if not r: return None
+	return r.group(1), int(r.group(2))
+
+def airmassFromElevations(elevationStrings):
+	""" The airmass for a list of 'DD:MM:SS.dd' elevation strings. Values that cannot be read give NaN. """
+	pieces = numpy.full((len(elevationStrings), 3), numpy.nan)
+	for i, elevation in enumerate(elevationStrings):
+		try:
+			pieces[i] = [float(p) for p in elevation.split(':')]
+		except (AttributeError, ValueError):
+			pass
+	elevations = numpy.radians(pieces[:, 0] + pieces[:, 1] / 60.0 + pieces[:, 2] / 3600.0)
+	with numpy.errstate(divide='ignore', invalid='ignore'):
+		return 1.0 / numpy.cos(numpy.pi / 2.0 - elevations)
+
+def headerNumber(header, key, default = numpy.nan):
+	try:
+		return float(header[key])
+	except (KeyError, TypeError, ValueError):
+		return default
+
+
+class frameTable(object):
+	""" Frame metadata held in a structured array that grows as frames are added """
+
+	def __init__(self, capacity = 1024):
+		self._data = numpy.zeros(capacity, dtype=frameDtype)
+		self.count = 0
+		self.targets = []
+		self.filenames = []
+		self._targetNumbers = {}
+
+	def __len__(self):
+		return self.count
+
+	@property
+	def rows(self):
+		""" The structured array of the frames in the table (a view, not a copy) """
+		return self._data[:self.count]
+
+	@property
+	def nbytes(self):
+		return self.rows.nbytes
+
+	def targetNumber(self, name):
+		""" The number a target's name is stored as, or -1 if the table has no frames of it """
+		return self._targetNumbers.get(name, -1)
+
+	def _addTarget(self, name):
+		if name not in self._targetNumbers:
+			self._targetNumbers[name] = len(self.targets)
+			self.targets.append(name)
+		return self._targetNumbers[name]
+
+	def _reserve(self, n):
+		if self.count + n <= len(self._data): return
+		capacity = max(2 * len(self._data), self.count + n)
+		data = numpy.zeros(capacity, dtype=frameDtype)
+		data[:self.count] = self._data[:self.count]
+		self._data = data
+
+	def addHeaders(self, filenames, headers):
+		""" Adds a frame for each filename and its header dictionary. Files whose names are not 'TARGET-NNNN.fits' frames are
+			left out. Returns the row numbers of the new frames.
+		"""
+		parsed = [parseFrameFilename(os.path.basename(f)) for f in filenames]
+		keep = [i for i, p in enumerate(parsed) if p is not None]
+		n = len(keep)
+		self._reserve(n)
+		new = self._data[self.count:self.count + n]
+		new["target"] = [self._addTarget(parsed[i][0]) for i in keep]
+		new["frame"] = [parsed[i][1] for i in keep]
+		new["file"] = numpy.arange(len(self.filenames), len(self.filenames) + n)
+		self.filenames.extend(filenames[i] for i in keep)
+		new["MJD"] = [headerNumber(headers[i], 'MJD-OBS') for i in keep]
+		new["exposureTime"] = [headerNumber(headers[i], 'EXPTIME') for i in keep]
+		new["xBinning"] = [headerNumber(headers[i], 'XBINNING', 1) for i in keep]
+		new["yBinning"] = [headerNumber(headers[i], 'YBINNING', 1) for i in keep]
+		new["CCDtemperature"] = [headerNumber(headers[i], 'CCD-TEMP') for i in keep]
+		new["median"] = numpy.nan
+		new["airmass"] = airmassFromElevations([headers[i].get('ELEVATIO') for i in keep])
+		rowNumbers = numpy.arange(self.count, self.count + n)
+		self.count+= n
+		return rowNumbers
+
+	def addFiles(self, filenames, cache = None):
+		""" Adds frames from FITS files, reading their headers through the header cache in one transaction """
+		if cache is None: cache = fitsHeaderCache.getDefaultCache()
+		filenames = list(filenames)
+		return self.addHeaders(filenames, cache.getHeaders(filenames))
+
+	@classmethod
+	def fromFolder(cls, folder, cache = None):
+		""" A table of all the frames in a folder, in filename order """
+		table = cls()
+		filenames = sorted(f for f in os.listdir(folder) if parseFrameFilename(f) is not None)
+		table.addFiles([os.path.join(folder, f) for f in filenames], cache)
+		return table
+
+	def setMedians(self, rowNumbers, medians):
+		self._data["median"][rowNumbers] = medians
+
+	def select(self, target = None, MJDRange = None, binning = None, exposureTime = None):
+		""" Returns the row numbers of the frames matching all the conditions given. 'target' is a name, 'MJDRange' is
+			(first, last) with None for an open end, and 'binning' is (xBinning, yBinning).
+		"""
+		rows = self.rows
+		mask = numpy.ones(self.count, dtype=bool)
+		if target is not None: mask&= rows["target"] == self.targetNumber(target)
+		if MJDRange is not None:
+			if MJDRange[0] is not None: mask&= rows["MJD"] >= MJDRange[0]
+			if MJDRange[1] is not None: mask&= rows["MJD"] <= MJDRange[1]
+		if binning is not None: mask&= (rows["xBinning"] == binning[0]) & (rows["yBinning"] == binning[1])
+		if exposureTime is not None: mask&= rows["exposureTime"] == exposureTime
+		return numpy.flatnonzero(mask)
+
+	def targetRows(self, target):
+		""" The row numbers of a target's frames in frame number order """
+		rowNumbers = self.select(target = target)
+		return rowNumbers[numpy.argsort(self.rows["frame"][rowNumbers], kind="mergesort")]
+
+	def filename(self, rowNumber):
+		return self.filenames[self._data["file"][rowNumber]]
+
+	def targetName(self, rowNumber):
+		return self.targets[self._data["target"][rowNumber]]
+
+
+if __name__ == "__main__":
+	import argparse, time
+
+	parser = argparse.ArgumentParser(description='Lists the frames in a folder, optionally just those of one target or MJD range.')
+	parser.add_argument('folder', type=str, help='Folder containing the FITS files.')
+	parser.add_argument('-t', '--target', type=str, help='Only list the frames of this target.')
+	parser.add_argument('--mjd', type=float, nargs=2, help='Only list the frames taken between these MJDs.')
+	args = parser.parse_args()
+
+	startTime = time.time()
+	table = frameTable.fromFolder(args.folder)
+	print("Read %d frames of %d targets in %.2f s (%d bytes)"%(len(table), len(table.targets), time.time() - startTime, table.nbytes))
+	for rowNumber in table.select(target = args.target, MJDRange = args.mjd):
+		row = table.rows[rowNumber]
+		print("%s\t%s\t%d\t%.6f\t%.1f\t%dx%d\t%.2f"%(os.path.basename(table.filename(rowNumber)), table.targetName(rowNumber), row["frame"],
+			row["MJD"], row["exposureTime"], row["xBinning"], row["yBinning"], row["airmass"]))
@@ -0,0 +1,20 @@
+""" Shared by the reducers that read frames, in the main process or in a pool of worker processes (batchSAFTReduce,
+	backlogReducer and liveSAFTReduce).
+"""
+
+import saftClasses
+
+
+state = {}    # The state of each worker process, set up once by initWorker
+
+def initWorker(values):
+	""" Pool initializer: keeps the objects every task of the worker needs (the calibrator, options, ...) in 'state' """
+	state.clear()
+	state.update(values)
+
+def loadFrame(index, filename):
+	""" Reads a science frame. The image is only read when it is first used. """
+	frame = saftClasses.frameObject(index = index, lazy = True)
+	frame.initFromFile(filename)
+	frame.frameType = 'science'
+	return frame
@@ -1,42 +1,99 @@
 #!/usr/bin/env python
 
 import argparse, sys, os, re
-import datetime, time
+import datetime, time, threading
 import numpy
-import ppgplot
+try:
+	import ppgplot
+except ImportError:
+	ppgplot = None
 import generalUtils, configHelper
-import saftClasses
-import copy
+import saftClasses, fileWatcher, frameStacker, calibration, registration, photometry, sourceCatalogue, reductionPipeline, backlogReducer, columnStore, frameWorker
 from astropy.io import fits
 
 from astropy.stats import median_absolute_deviation as mad
 from photutils import datasets
 from photutils import daofind
-from photutils import aperture_photometry, CircularAperture, psf_photometry, GaussianPSF
 
-def checkForNewFiles():
-	newFiles = []
-	try:
-		files = os.listdir(searchPath)
-	except:
-		print "Could not find the directory %s. Exiting."%searchPath
-		sys.exit(-1)
-	for f in files:
-		r = run_re.search(f)
-		if (r):
-			filename = r.group(0)
-			if filename not in fileList:
-				newFiles.append(filename)
-				print "found new file", filename
+def checkForNewFiles(timeout = 0):
+	newFiles = watcher.getNewFiles(timeout)
+	for filename in newFiles:
+		print "found new file", filename
 	return newFiles
 	
-def plotSources(sources):
+def findSources(imageData):
+	bkg_sigma = 1.48 * mad(imageData)
+	return daofind(imageData, fwhm=4.0, threshold=3*bkg_sigma)
+	
+def plotSources(catalogue, drift = (0, 0)):
 	ppgplot.pgsfs(2)   # Set fill style to 'outline'
 	ppgplot.pgsci(3)   # Set the colour to 'green'
-	for s in sources:
-		x, y = s['xcentroid'], s['ycentroid']
-		radius = s['sharpness']* 40.
-		ppgplot.pgcirc(x,y, radius)
+	x, y, flux, sharpness, version = catalogue.snapshot()
+	for i in range(len(x)):
+		ppgplot.pgcirc(x[i] + drift[0], y[i] + drift[1], sharpness[i] * 40.)
+	
+def stackFrame(frame):
+	""" Adds a frame to the stack, moving it onto the first frame first if registration is on. Returns the frame's drift, or
+		None if the frame does not have the binning and size of the first frame or could not be registered. """
+	if not stacker.canAdd(frame):
+		print "WARNING: Skipped frame %d (the binning or size does not match the first frame)"%frame.index
+		return None
+	if registrar is None:
+		stacker.addFrame(frame)
+		return (0, 0)
+	drift = registrar.register(frame)
+	if drift is None: return None
+	stacker.addFrame(frame, offset = (-drift[0], -drift[1]))
+	print "drift: %.2f, %.2f pixels"%drift
+	return drift
+	
+def updateSources():
+	""" Starts a search of the stack in the background if one is due, and gives the photometry any sources found since the last frame """
+	global sourcesVersion
+	if redetector is not None and redetector.due(stacker.count):
+		redetector.frameAdded(stacker.combined(args.combine), stacker.count)
+	if photometer is not None and catalogue.version != sourcesVersion:
+		x, y, flux, sharpness, sourcesVersion = catalogue.snapshot()
+		photometer.setSources(x, y)
+	
+def loadFrame(item):
+	""" Pipeline stage: reads the frame file """
+	return frameWorker.loadFrame(*item)
+	
+def calibrateFrame(frame):
+	""" Pipeline stage: applies the bias and flat. Frames that cannot be calibrated are dropped. """
+	if not calibrator.apply(frame):
+		print "WARNING: Skipped frame %d (it does not match the bias and flat frames)"%frame.index
+		return None
+	return frame
+	
+def reduceFrame(frame):
+	""" Pipeline stage: stacks and measures the frame. Returns (frame, drift) for the display, or None if it was skipped. """
+	drift = stackFrame(frame)
+	if drift is None: return None
+	updateSources()
+	print frame.__str__(long=args.stats)
+	if photometer is not None: print "differential flux:", photometer.measure(frame, drift)
+	if frameStore is not None: frameStore.append(columnStore.frameRow(targetString, frame, drift))
+	return (frame, drift)
+	
+def renderFrame(frame, drift):
+	""" Draws the latest frame and the sources. Runs in the main thread, on whichever frame is newest when it gets to it. """
+	ppgplot.pgslct(imagePlot['pgplotHandle'])
+	ppgplot.pggray(frame.boostedImage(stretcher = stretcher), 0, width-1, 0, height-1, 0, 255, imagePlot['pgPlotTransform'])
+	plotSources(catalogue, drift)
+	
+def feedFiles(filenames, index):
+	""" Puts the files found so far and then any new ones into the pipeline, until 'stopping' is set """
+	for filename in filenames:
+		if stopping.is_set(): return
+		reducer.put((index, filename))
+		index+= 1
+	while not stopping.is_set():
+		for filename in checkForNewFiles(timeout = updateInterval):
+			fileList.append(filename)
+			reducer.put((index, filename))
+			index+= 1
 	
 
 
@@ -50,9 +107,36 @@ if __name__ == "__main__":
 	parser.add_argument('-r', '--reducedirectory', type=str, help='Reduction directory. Where to place all the output files produced during the reduction.')
 	parser.add_argument('-b', '--bias', type=str, help='Use this as the bias frame')
 	parser.add_argument('-f', '--flat', type=str, help='Use this as the flat (balance) frame')
+	parser.add_argument('-w', '--window', type=int, default=0, help='Keep the last "w" frames for a windowed median or sigma-clipped stack.')
+	parser.add_argument('-c', '--combine', type=str, default="sum", choices=["sum", "mean", "median", "sigmaclip"], help='How to combine the stack that is displayed and searched for sources.')
+	parser.add_argument('--exactstretch', action="store_true", help='Use exact percentiles to scale the display instead of the faster estimate.')
+	parser.add_argument('--stats', action="store_true", help='Compute and print the median, min and max of every frame.')
+	parser.add_argument('--register', action="store_true", help='Measure the drift of each frame and move it onto the first frame before stacking.')
+	parser.add_argument('--driftlog', type=str, help='Write the measured drift of each frame to this file (with --register).')
+	parser.add_argument('--maxdrift', type=float, help='Largest drift (pixels) to look for when registering.')
+	parser.add_argument('--minsignificance', type=float, default=20, help='Leave out frames that match the first frame less well than this when registering (0 to keep them all).')
+	parser.add_argument('--photometry', action="store_true", help='Measure the sources in every frame and write a differential light curve to the reduction directory.')
+	parser.add_argument('--apertures', type=float, nargs='+', default=[3, 5, 7], help='Aperture radii (pixels) for the photometry.')
+	parser.add_argument('--annulus', type=float, nargs=2, default=[10, 15], help='Inner and outer radius (pixels) of the sky annulus.')
+	parser.add_argument('--target', type=int, help='Number of the target star (as printed when the sources are found). Default is the star nearest the centre.')
+	parser.add_argument('--comparisons', type=int, nargs='+', help='Numbers of the comparison stars. Default is the three brightest others.')
+	parser.add_argument('--redetect', type=int, default=10, help='Search the stack for new sources every this many frames (0 to only search the first frame).')
+	parser.add_argument('--redetecttime', type=float, help='Also search the stack for new sources at least every this many seconds.')
+	parser.add_argument('--matchradius', type=float, default=2.0, help='Sources found again within this many pixels of a known source are taken to be the same star.')
+	parser.add_argument('--maxsources', type=int, default=500, help='Most sources to measure in the photometry, including ones found later in the run.')
+	parser.add_argument('--framelog', action="store_true", help='Keep the statistics of every frame in a column store in the reduction directory.')
+	parser.add_argument('--catchup', action="store_true", help='Reduce the frames already in the folder in parallel (without drawing them) before going live.')
+	parser.add_argument('--processes', type=int, help='Number of processes for --catchup. Default is one per CPU.')
+	parser.add_argument('--headless', action="store_true", help='Reduce without displaying anything (does not need ppgplot or X).')
+	parser.add_argument('--queuesize', type=int, default=4, help='Most frames to hold between each stage of the reduction.')
+	parser.add_argument('--poll', action="store_true", help='Poll the search folder instead of using inotify to watch it.')
 	parser.add_argument('--save', action="store_true", help='Write the input parameters to the config file as default values.')
 	args = parser.parse_args()
 	print args
+	if args.combine in ["median", "sigmaclip"] and args.window < 1:
+		parser.error("A %s combine needs a window of frames, set it with --window"%args.combine)
+	if ppgplot is None and not args.headless:
+		parser.error("ppgplot is not installed, use --headless to reduce without the display")
 	
 	config = configHelper.configClass("liveSAFTReduce")
 	configDefaults  = {
@@ -89,6 +173,8 @@ if __name__ == "__main__":
 		flatFrame.initFromFile(flatFrameFilename)
 		flatFrame.frameType = "flat"
 		print flatFrame.__str__(long=True)
+	
+	calibrator = calibration.calibrationStage(biasFrame if useBias else None, flatFrame if useFlat else None)
 		
 	
 	targetString = args.targetstring
@@ -99,11 +185,13 @@ if __name__ == "__main__":
 	
 	
 	run_re = re.compile(r'%s-[0-9]{3,}.fits'%targetString)
+	try:
+		watcher = fileWatcher.directoryWatcher(searchPath, run_re, usePolling = args.poll)
+	except OSError:
+		print "Could not find the directory %s. Exiting."%searchPath
+		sys.exit(-1)
 	
-	fileList = []
-	fileList = checkForNewFiles()	
-			
-	fileList = sorted(fileList, key=lambda object: object, reverse = False)
+	fileList = checkForNewFiles()
 	numFrames = len(fileList)
 	print "Found %d files matching the targetString"%(numFrames)
 	if numFrames == 0: sys.exit()
@@ -114,84 +202,120 @@ if __name__ == "__main__":
 	
 	frameCounter = 0
 	
-	frame = saftClasses.frameObject()
-	frame.initFromFile(frameFilename)
-	if useBias: frame.subtractFrame(biasFrame)
-	if useFlat: frame.divideFrame(flatFrame)
+	frame = frameWorker.loadFrame(0, frameFilename)
+	if not calibrator.apply(frame):
+		print "The first frame %s does not match the bias and flat frames. Exiting."%frameFilename
+		sys.exit(-1)
 	
-	stackedFrame = copy.deepcopy(frame)
+	registrar = None
+	if args.register: registrar = registration.frameRegistration(frame.imageData, maxShift = args.maxdrift, minSignificance = args.minsignificance or None)
+	stacker = frameStacker.frameStacker(windowSize = args.window)
+	stacker.addFrame(frame)
+	stackedFrame = stacker.asFrame(args.combine)
 	frameCounter+=1
 	
 	(height, width) = numpy.shape(frame.imageData)
 	
-	""" Set up the PGPLOT windows """
-	imagePlot = {}
-	imagePlot['pgplotHandle'] = ppgplot.pgopen('/xs')
-	ppgplot.pgpap(8, 1)
-	ppgplot.pgenv(0., width,0., height, 1, -2)
-	imagePlot['pgPlotTransform'] = [0, 1, 0, 0, 0, 1]
+	if args.exactstretch: stretcher = None
+	else: stretcher = saftClasses.fastStretch()
 	
+	if not args.headless:
+		""" Set up the PGPLOT windows """
+		imagePlot = {}
+		imagePlot['pgplotHandle'] = ppgplot.pgopen('/xs')
+		ppgplot.pgpap(8, 1)
+		ppgplot.pgenv(0., width,0., height, 1, -2)
+		imagePlot['pgPlotTransform'] = [0, 1, 0, 0, 0, 1]
+		
+		
+		stackedImagePlot = {}
+		stackedImagePlot['pgplotHandle'] = ppgplot.pgopen('/xs')
+		ppgplot.pgpap(6, 1)
+		ppgplot.pgenv(0., width,0., height, 1, -2)
+		stackedImagePlot['pgPlotTransform'] = [0, 1, 0, 0, 0, 1]
+		
+		""" Draw the latest frame """
+		ppgplot.pgslct(imagePlot['pgplotHandle'])
+		ppgplot.pggray(frame.boostedImage(stretcher = stretcher), 0, width-1, 0, height-1, 0, 255, imagePlot['pgPlotTransform'])
+		
+		""" Draw the stacked image """
+		ppgplot.pgslct(stackedImagePlot['pgplotHandle'])
+		ppgplot.pggray(stackedFrame.boostedImage(stretcher = stretcher), 0, width-1, 0, height-1, 0, 255, imagePlot['pgPlotTransform'])
 	
-	stackedImagePlot = {}
-	stackedImagePlot['pgplotHandle'] = ppgplot.pgopen('/xs')
-	ppgplot.pgpap(6, 1)
-	ppgplot.pgenv(0., width,0., height, 1, -2)
-	stackedImagePlot['pgPlotTransform'] = [0, 1, 0, 0, 0, 1]
+	""" Look for sources in the stacked image """	
+	sources = findSources(stackedFrame.imageData)
+	catalogue = sourceCatalogue.sourceCatalogue(matchRadius = args.matchradius)
+	catalogue.updateFromTable(sources)
+	if not args.headless: plotSources(catalogue)
+	for number, s in enumerate(sources):
+		print number, s
 	
-	""" Draw the latest frame """
-	ppgplot.pgslct(imagePlot['pgplotHandle'])
-	ppgplot.pggray(frame.boostedImage(), 0, width-1, 0, height-1, 0, 255, imagePlot['pgPlotTransform'])
+	""" Search the deepening stack again from time to time, in the background """
+	redetector = None
+	if args.redetect > 0 or args.redetecttime is not None:
+		redetector = sourceCatalogue.redetector(catalogue, findSources, args.redetect, args.redetecttime)
+		redetector.lastFrames = stacker.count
 	
-	""" Draw the stacked image """
-	ppgplot.pgslct(stackedImagePlot['pgplotHandle'])
-	ppgplot.pggray(stackedFrame.boostedImage(), 0, width-1, 0, height-1, 0, 255, imagePlot['pgPlotTransform'])
+	frameStore = None
+	if args.framelog:
+		frameStoreFolder = os.path.join(reductionDir, targetString + "-frames")
+		print "Writing the frame statistics to %s"%frameStoreFolder
+		frameStore = columnStore.columnStore(frameStoreFolder, columnStore.frameColumns(), rowGroupSize = 32)
+		frameStore.append(columnStore.frameRow(targetString, frame))
 	
-	""" Look for sources in the stacked image """	
-	bkg_sigma = 1.48 * mad(stackedFrame.imageData)
-	sources = daofind(stackedFrame.imageData, fwhm=4.0, threshold=3*bkg_sigma)   
-	plotSources(sources)
-	for s in sources:
-		print s
+	photometer = None
+	x, y, flux, sharpness, sourcesVersion = catalogue.snapshot()
+	if args.photometry:
+		target, comparisons = photometry.chooseStars(x, y, flux, width, height)
+		if args.target is not None: target = args.target
+		if args.comparisons is not None: comparisons = args.comparisons
+		lightCurveFolder = os.path.join(reductionDir, targetString + "-lightcurve")
+		print "Target star %d, comparison stars %s. Writing the light curve to %s"%(target, comparisons, lightCurveFolder)
+		# Small row groups, so that a crash loses at most a few measured frames and a plot of the light curve keeps up
+		photometer = photometry.lightCurveEngine(x, y, target, comparisons, args.apertures, args.annulus, lightCurveFolder, capacity = args.maxsources, rowGroupSize = 4)
+		photometer.measure(frame)
 	
 	if numFrames == 1: sys.exit()
 	
-	# Catch up on all frames found so far
-	for index in range(1, numFrames):
-		frame = saftClasses.frameObject(index = frameCounter)
-		frame.initFromFile(fileList[index])
-		frame.frameType = 'science'
-		if useBias: frame.subtractFrame(biasFrame)
-		if useFlat: frame.divideFrame(flatFrame)
-		stackedFrame.addFrame(frame)
-		
-		frameCounter+=1	
-		ppgplot.pgslct(imagePlot['pgplotHandle'])	
-		ppgplot.pggray(frame.boostedImage(), 0, width-1, 0, height-1, 0, 255, imagePlot['pgPlotTransform'])
-		plotSources(sources)
-		print frame.__str__(long=True)
+	""" The rest of the reduction runs as a pipeline: one thread reads the files, one calibrates them and one stacks and
+		measures them, with a few frames queued between each. The main thread draws the newest reduced frame, so a slow
+		display only means that some frames are not drawn. """
+	backlog = fileList[1:]
+	if args.catchup and len(backlog) > 0:
+		""" Reduce the frames that are already here in parallel, draw the stack once and then go live """
+		catcher = backlogReducer.backlogReducer(stacker, calibrator, registrar, photometer, processes = args.processes, frameStore = frameStore, target = targetString)
+		catcher.reduce([(frameCounter + i, filename) for i, filename in enumerate(backlog)])
+		frameCounter+= len(backlog)
+		backlog = []
+		updateSources()
+		if not args.headless:
+			ppgplot.pgslct(stackedImagePlot['pgplotHandle'])
+			ppgplot.pggray(stacker.asFrame(args.combine).boostedImage(stretcher = stretcher), 0, width-1, 0, height-1, 0, 255, stackedImagePlot['pgPlotTransform'])
+	
+	reducer = reductionPipeline.pipeline([("load", loadFrame), ("calibrate", calibrateFrame), ("reduce", reduceFrame)], queueSize = args.queuesize)
+	stopping = threading.Event()
+	feeder = threading.Thread(target = feedFiles, args = (backlog, frameCounter))
+	feeder.daemon = True
+	feeder.start()
 	
-	# Now continue processing new frames as they arrive...
 	try:
 		while True:
-			time.sleep(updateInterval)
-			newFiles = checkForNewFiles()
-			for f in newFiles:
-				fileList.append(f)
-				hdulist = fits.open(f)
-				frame = saftClasses.frameObject(index = frameCounter)
-				frame.initFromFITS(hdulist)
-				frame.frameType = 'science'
-				if useBias: frame.subtractFrame(biasFrame)
-				if useFlat: frame.divideFrame(flatFrame)
-				print frame.__str__(long=True)
-				frameCounter+=1		
-				hdulist.close()
-			
-				ppgplot.pggray(frame.boostedImage(), 0, width-1, 0, height-1, 0, 255, imagePlot['pgPlotTransform'])
-				plotSources(sources)
+			result = reducer.output.get(timeout = updateInterval)
+			if result is not None and not args.headless: renderFrame(*result)
 
 	except KeyboardInterrupt:
-		ppgplot.pgclos()
+		stopping.set()
+		feeder.join()
+		watcher.close()
+		reducer.close()
+		print reducer.statistics()
+		if redetector is not None: redetector.close()
+		if photometer is not None: photometer.close()
+		if frameStore is not None: frameStore.close()
+		if registrar is not None and args.driftlog is not None:
+			registrar.writeDriftLog(args.driftlog)
+			print "Wrote the drift of %d frames to %s"%(len(registrar.driftLog), args.driftlog)
+		if not args.headless: ppgplot.pgclos()
 	
 	
 	
@@ -0,0 +1,156 @@
+""" A plate-solving backend that runs a local astrometry.net 'solve-field' instead of uploading to nova.astrometry.net.
+	LocalClient has the same upload, status, wait and WCS-fetching methods as astrometryClient.Client, so the two can be
+	swapped. Each upload starts solve-field in the background straight away and the submission id doubles as the job id.
+"""
+
+import os, time, math, shutil, tempfile, threading, subprocess, itertools
+from astropy.io import fits
+from astropy.wcs import WCS
+from astropy.wcs.utils import proj_plane_pixel_scales
+import astrometryClient
+
+
+def calibrationFromWCS(header):
+	""" Works out the centre, pixel scale, orientation, radius and parity of a solution, as nova.astrometry.net reports them """
+	wcs = WCS(header)
+	width, height = header.get("IMAGEW"), header.get("IMAGEH")
+	ra, dec = wcs.all_pix2world([[width / 2. + 0.5, height / 2. + 0.5]], 1)[0]
+	pixscale = float(proj_plane_pixel_scales(wcs)[0]) * 3600.
+	cd = wcs.pixel_scale_matrix
+	determinant = cd[0][0] * cd[1][1] - cd[0][1] * cd[1][0]
+	orientation = math.degrees(math.atan2(cd[0][1], cd[1][1]))
+	return { "ra": float(ra), "dec": float(dec), "pixscale": pixscale, "orientation": orientation,
+		"radius": pixscale * math.hypot(width, height) / 2. / 3600., "parity": 1.0 if determinant < 0 else -1.0 }
+
+
+class LocalClient(object):
+	""" Drives solve-field with the same interface as astrometryClient.Client """
+
+	def __init__(self, solveField = "solve-field", configFile = None, workDirectory = None, cpuLimit = 30, verbose = True):
+		self.solveField = solveField
+		self.configFile = configFile
+		self.workDirectory = workDirectory
+		self.cpuLimit = cpuLimit
+		self.verbose = verbose
+		self.session = "local"
+		self.jobs = {}
+		self._ids = itertools.count(1)
+		self._lock = threading.Lock()
+
+	def login(self, apikey = None):
+		""" Nothing to log in to, this only checks that solve-field can be found """
+		if shutil.which(self.solveField) is None and not os.path.exists(self.solveField):
+			raise astrometryClient.RequestError("could not find %s"%self.solveField)
+
+	def solveFieldCommand(self, filename, outputBase, workDirectory, **kwargs):
+		""" Translates the astrometryClient upload arguments into solve-field options """
+		command = [self.solveField, "--no-plots", "--overwrite", "--dir", workDirectory, "--out", outputBase,
+			"--new-fits", os.path.join(workDirectory, outputBase + ".new"), "--cpulimit", str(self.cpuLimit),
+			"--axy", "none", "--rdls", "none", "--match", "none", "--corr", "none", "--index-xyls", "none"]
+		if self.configFile is not None: command+= ["--config", self.configFile]
+		if kwargs.get("scale_units") is not None: command+= ["--scale-units", str(kwargs["scale_units"])]
+		if kwargs.get("scale_lower") is not None: command+= ["--scale-low", str(kwargs["scale_lower"])]
+		if kwargs.get("scale_upper") is not None: command+= ["--scale-high", str(kwargs["scale_upper"])]
+		if kwargs.get("scale_est") is not None and kwargs.get("scale_err") is not None:
+			low = kwargs["scale_est"] * (1 - kwargs["scale_err"] / 100.)
+			high = kwargs["scale_est"] * (1 + kwargs["scale_err"] / 100.)
+			command+= ["--scale-low", str(low), "--scale-high", str(high)]
+		if kwargs.get("center_ra") is not None and kwargs.get("center_dec") is not None:
+			command+= ["--ra", str(kwargs["center_ra"]), "--dec", str(kwargs["center_dec"])]
+			command+= ["--radius", str(kwargs.get("radius", 1.0))]
+		if kwargs.get("downsample_factor") is not None: command+= ["--downsample", str(kwargs["downsample_factor"])]
+		if kwargs.get("tweak_order") is not None: command+= ["--tweak-order", str(kwargs["tweak_order"])]
+		if kwargs.get("parity") is not None: command+= ["--parity", ["pos", "neg"][int(kwargs["parity"])]]
+		if kwargs.get("crpix_center"): command+= ["--crpix-center"]
+		if kwargs.get("image_width") is not None:
+			# An x,y source list rather than an image
+			command+= ["--width", str(kwargs["image_width"]), "--height", str(kwargs["image_height"]), "--x-column", "X", "--y-column", "Y"]
+		command.append(filename)
+		return command
+
+	def upload(self, fn, **kwargs):
+		if not os.path.exists(fn):
+			print('File %s does not exist' % fn)
+			raise IOError(fn)
+		jobid = next(self._ids)
+		workDirectory = tempfile.mkdtemp(prefix="localsolve-%d-"%jobid, dir=self.workDirectory)
+		outputBase = "solution"
+		command = self.solveFieldCommand(os.path.abspath(fn), outputBase, workDirectory, **kwargs)
+		if self.verbose: print("Running: " + " ".join(command))
+		log = open(os.path.join(workDirectory, "solve-field.log"), "wb")
+		process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+		log.close()
+		with self._lock:
+			self.jobs[jobid] = { "process": process, "directory": workDirectory, "base": os.path.join(workDirectory, outputBase),
+				"started": time.time(), "filename": fn }
+		return { "status": "success", "subid": jobid }
+
+	def upload_sources(self, fn, max_sources = 100, **kwargs):
+		""" Finds the stars locally and solves from the brightest of them, which is much quicker than solving the image """
+		import sourceList
+		handle, xylistFilename = tempfile.mkstemp(suffix=".xyls", dir=self.workDirectory)
+		os.close(handle)
+		xylistFilename, width, height = sourceList.makeSourceList(fn, max_sources, outputFilename = xylistFilename)
+		kwargs.update(image_width=width, image_height=height)
+		result = self.upload(xylistFilename, **kwargs)
+		self.jobs[result["subid"]]["sourceList"] = xylistFilename
+		return result
+
+	def url_upload(self, url, **kwargs):
+		raise astrometryClient.RequestError("the local solver can only solve files")
+
+	def sub_status(self, sub_id, justdict = False):
+		if int(sub_id) not in self.jobs: raise astrometryClient.RequestError("no such submission %s"%sub_id)
+		result = { "jobs": [int(sub_id)] }
+		if justdict: return result
+		return "success"
+
+	def _status(self, job_id):
+		job = self.jobs.get(int(job_id))
+		if job is None: raise astrometryClient.RequestError("no such job %s"%job_id)
+		if job["process"].poll() is None: return "solving"
+		if os.path.exists(job["base"] + ".solved") and os.path.exists(job["base"] + ".wcs"): return "success"
+		return "failure"
+
+	def job_status(self, job_id, justdict = False):
+		status = self._status(job_id)
+		if justdict: return { "status": status }
+		if status == "success": print("Calibration:", self.job_results(job_id)["calibration"])
+		return status
+
+	def job_results(self, job_id):
+		""" The same calibration summary as nova.astrometry.net, worked out from the WCS solution """
+		calibration = calibrationFromWCS(fits.getheader(self.jobs[int(job_id)]["base"] + ".wcs"))
+		return { "calibration": calibration, "info": { "status": "success", "calibration": calibration } }
+
+	def wait_for_job_id(self, sub_id, timeout = None, backoff = None):
+		return self.sub_status(sub_id, justdict=True)["jobs"][0]
+
+	def wait_for_job(self, job_id, timeout = None, backoff = None):
+		job = self.jobs[int(job_id)]
+		try:
+			job["process"].wait(timeout)
+		except subprocess.TimeoutExpired:
+			raise astrometryClient.RequestError("timed out waiting for job %s"%job_id)
+		return { "status": self._status(job_id) }
+
+	def wcs_file(self, job_id):
+		return open(self.jobs[int(job_id)]["base"] + ".wcs", "rb").read()
+
+	def new_fits_file(self, job_id):
+		if "sourceList" in self.jobs[int(job_id)]:
+			raise astrometryClient.RequestError("there is no new FITS image when solving from a source list")
+		return open(self.jobs[int(job_id)]["base"] + ".new", "rb").read()
+
+	def kml_file(self, job_id):
+		raise astrometryClient.RequestError("the local solver does not make KMZ files")
+
+	def cleanup(self, job_id):
+		job = self.jobs.pop(int(job_id))
+		shutil.rmtree(job["directory"], ignore_errors=True)
+		if "sourceList" in job: os.remove(job["sourceList"])
+
+	def close(self):
+		for job_id in list(self.jobs.keys()):
+			if self.jobs[job_id]["process"].poll() is None: self.jobs[job_id]["process"].kill()
+			self.cleanup(job_id)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+""" Builds master bias, dark and flat frames from sequences of raw calibration frames. The frames are combined a block of
+	rows at a time, so the memory needed depends on the tile size and not on the number of frames, and the tiles can be
+	shared out across several processes.
+"""
+
+import argparse, sys, os
+import multiprocessing
+import numpy
+from astropy.io import fits
+import configHelper, saftClasses, frameStacker
+
+
+def readRows(filename, rowStart, rowEnd):
+	""" Reads a block of rows from the primary image of a FITS file without loading the rest of it """
+	# Sections read just the requested rows from disk, and unlike memory maps they work with scaled (BZERO) data
+	hdulist = fits.open(filename, memmap=False)
+	rows = numpy.array(hdulist[0].section[rowStart:rowEnd, :], dtype=numpy.float32)
+	hdulist.close()
+	return rows
+
+def combineTile(job):
+	""" Combines rows rowStart:rowEnd of all the frames. 'bias' is the matching tile of the master bias (or None) and 'scales'
+		holds the value each frame is divided by (its median for flats) or None.
+	"""
+	filenames, rowStart, rowEnd, method, bias, scales, sigma = job
+	cube = None
+	for index, filename in enumerate(filenames):
+		rows = readRows(filename, rowStart, rowEnd)
+		if cube is None: cube = numpy.empty((len(filenames),) + rows.shape, dtype=numpy.float32)
+		if bias is not None: rows-= bias
+		if scales is not None: rows/= scales[index]
+		cube[index] = rows
+	if method == "sigmaclip": return rowStart, frameStacker.sigmaClippedMean(cube, sigma).astype(numpy.float32)
+	return rowStart, numpy.median(cube, axis=0).astype(numpy.float32)
+
+
+def buildMaster(filenames, frameType, method = "median", biasFrame = None, memoryLimit = 256, processes = 1, sigma = 3.0):
+	""" Combines the raw frames in 'filenames' into a master frame and returns it as a frameObject.
+		'memoryLimit' is the approximate number of megabytes each process may use to hold a tile of the frame stack.
+	"""
+	frames = []
+	for index, filename in enumerate(filenames):
+		frame = saftClasses.frameObject(index = index, lazy = True)
+		frame.initFromFile(filename)
+		frame.frameType = frameType
+		if frames and ((frame.xBinning != frames[0].xBinning) or (frame.yBinning != frames[0].yBinning) or (frame.xSize, frame.ySize) != (frames[0].xSize, frames[0].ySize)):
+			print("WARNING: Skipping %s, its binning or size is different from %s"%(filename, frames[0].filename))
+			continue
+		frames.append(frame)
+	if not frames: raise ValueError("No frames to combine")
+	height, width = frames[0].xSize, frames[0].ySize
+
+	bias = None
+	if biasFrame is not None:
+		bias = numpy.array(biasFrame.imageData, dtype=numpy.float32)
+
+	scales = None
+	if frameType in ["flat", "balance"]:
+		# Each flat is normalised by its own median before combining, reading one frame at a time
+		scales = []
+		for frame in frames:
+			data = numpy.array(frame.imageData, dtype=numpy.float32)
+			if bias is not None: data-= bias
+			scales.append(float(numpy.median(data)))
+			frame.releaseData()
+			print("%s: median %.1f"%(frame.filename, scales[-1]))
+
+	tileRows = max(1, min(height, int(memoryLimit * 1024 * 1024 / (len(frames) * width * 4 * 2))))
+	print("Combining %d %s frames (%dx%d) with a %s in tiles of %d rows"%(len(frames), frameType, width, height, method, tileRows))
+	names = [frame.filename for frame in frames]
+	jobs = []
+	for rowStart in range(0, height, tileRows):
+		rowEnd = min(rowStart + tileRows, height)
+		jobs.append((names, rowStart, rowEnd, method, bias[rowStart:rowEnd] if bias is not None else None, scales, sigma))
+
+	masterData = numpy.empty((height, width), dtype=numpy.float32)
+	if processes > 1:
+		pool = multiprocessing.Pool(processes)
+		results = pool.imap_unordered(combineTile, jobs)
+	else:
+		pool = None
+		results = map(combineTile, jobs)
+	for rowStart, tile in results:
+		masterData[rowStart:rowStart + tile.shape[0]] = tile
+	if pool is not None:
+		pool.close()
+		pool.join()
+
+	master = saftClasses.frameObject(lazy = True)
+	master.setMetadata(dict((frames[0].metadata[key], getattr(frames[0], key)) for key in frames[0].metadata.keys()))
+	master.frameType = frameType
+	master.imageData = masterData
+	master.xSize, master.ySize = height, width
+	master.sourceFiles = names
+	master.combineMethod = method
+	return master
+
+def writeMaster(master, filename):
+	header = fits.Header()
+	for key in master.metadata.keys():
+		value = getattr(master, key)
+		if value is not None: header[master.metadata[key]] = value
+	header['FRAMTYPE'] = (master.frameType, 'Type of master calibration frame')
+	header['NCOMBINE'] = (len(master.sourceFiles), 'Number of raw frames combined')
+	header['COMBINE'] = (master.combineMethod, 'Combine method')
+	print("Writing %s master to %s"%(master.frameType, filename))
+	fits.writeto(filename, master.imageData, header, overwrite=True)
+
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser(description='Combines raw bias, dark or flat frames into a master frame for liveSAFTReduce.')
+	parser.add_argument('frametype', type=str, choices=['bias', 'dark', 'flat', 'balance'], help='The type of frames being combined.')
+	parser.add_argument('files', type=str, nargs='*', help='The raw frames.')
+	parser.add_argument('-l', '--list', type=str, help='A text file listing the raw frames, one per line.')
+	parser.add_argument('-o', '--output', type=str, required=True, help='Filename for the master frame.')
+	parser.add_argument('-m', '--method', type=str, choices=['median', 'sigmaclip'], help='How to combine the frames.')
+	parser.add_argument('-b', '--bias', type=str, help='Subtract this master bias from each frame first (for darks and flats).')
+	parser.add_argument('-j', '--processes', type=int, help='Number of processes to combine tiles with.')
+	parser.add_argument('--memory', type=float, help='Approximate memory (MB) each process may use for its tile of the stack.')
+	parser.add_argument('--sigma', type=float, default=3.0, help='Rejection threshold for the sigma-clipped combine.')
+	parser.add_argument('--save', action="store_true", help='Write the input parameters to the config file as default values.')
+	args = parser.parse_args()
+	print(args)
+
+	config = configHelper.configClass("makeMasterFrame")
+	configDefaults  = {
+		"CombineMethod": "median",
+		"Processes": 1,
+		"MemoryLimit": 256
+	}
+	config.setDefaults(configDefaults)
+	method = config.assertProperty("CombineMethod", args.method)
+	processes = config.assertProperty("Processes", args.processes)
+	memoryLimit = config.assertProperty("MemoryLimit", args.memory)
+	if args.save:
+		config.save()
+
+	filenames = list(args.files)
+	if args.list is not None:
+		listFile = open(args.list, 'rt')
+		for line in listFile:
+			if line.strip() != "": filenames.append(line.strip())
+		listFile.close()
+	if len(filenames) == 0:
+		print("No frames were specified.")
+		sys.exit(-1)
+
+	biasFrame = None
+	if args.bias is not None:
+		biasFrame = saftClasses.frameObject()
+		biasFrame.initFromFile(args.bias)
+		biasFrame.frameType = "bias"
+
+	master = buildMaster(filenames, args.frametype, method, biasFrame, memoryLimit, processes, args.sigma)
+	writeMaster(master, args.output)
+	print(master.__str__(long=True))
@@ -0,0 +1,252 @@
+""" An index of the frames taken of each target during a night. It is updated incrementally as new files arrive so that
+	the cost of each autoLogger iteration depends on the number of new files rather than on the size of the night. The
+	headers of every frame are kept in a frameTable, from which the timing of each target (airmass curve, dead time
+	between frames, cadence and interruptions) is worked out with numpy.
+"""
+
+import os, math, datetime
+import numpy
+import fitsHeaderCache, frameTable
+
+
+def convertDMStoRadians(dmsStr):
+	""" Format for input 'DD:MM:SS.dd' """
+
+	pieces = dmsStr.split(':')
+
+	degrees = int(pieces[0])
+	minutes = int(pieces[1])
+	seconds = float(pieces[2])
+
+	return (degrees + minutes/60.0 + seconds / 3600.0)/180.*math.pi
+
+def airmassFromElevation(elevationString):
+	return 1.0/math.cos(math.pi/2.0 - convertDMStoRadians(elevationString))
+
+def jsonNumber(value, digits = None):
+	""" A float for the night's JSON file, with None for NaN (which JavaScript cannot parse) """
+	value = float(value)
+	if math.isnan(value) or math.isinf(value): return None
+	return value if digits is None else round(value, digits)
+
+def timingAnalysis(frameNumbers, MJD, exposureTime, airmass, interruptionFactor = 3.0, curvePoints = 100):
+	""" Works out the timing of a sequence of frames (in frame order) from their start MJDs and exposure times. A gap
+		between frames of more than 'interruptionFactor' times the usual cadence is counted as an interruption and left out
+		of the dead time and jitter figures. The airmass curve is thinned to at most 'curvePoints' points.
+	"""
+	MJD, exposureTime, airmass = numpy.asarray(MJD), numpy.asarray(exposureTime, dtype=numpy.float64), numpy.asarray(airmass, dtype=numpy.float64)
+	timing = {}
+	totalExposureTime = numpy.nansum(exposureTime)
+	elapsedTime = (MJD[-1] - MJD[0]) * 86400. + (exposureTime[-1] if numpy.isfinite(exposureTime[-1]) else 0)
+	timing['totalExposureTime'] = jsonNumber(totalExposureTime)
+	timing['elapsedTime'] = jsonNumber(elapsedTime)
+	timing['efficiency'] = jsonNumber(totalExposureTime / elapsedTime) if elapsedTime > 0 else None
+	samples = numpy.unique(numpy.linspace(0, len(MJD) - 1, min(len(MJD), curvePoints)).round().astype(int))
+	timing['airmassCurve'] = [[jsonNumber(MJD[i]), jsonNumber(airmass[i], 4)] for i in samples]
+	finiteAirmass = airmass[numpy.isfinite(airmass)]
+	timing['minAirmass'] = jsonNumber(finiteAirmass.min(), 4) if len(finiteAirmass) > 0 else None
+	timing['maxAirmass'] = jsonNumber(finiteAirmass.max(), 4) if len(finiteAirmass) > 0 else None
+	timing['interruptions'] = []
+	if len(MJD) < 2: return timing
+
+	gaps = numpy.diff(MJD) * 86400.         # Start to start, in seconds
+	deadTimes = gaps - exposureTime[:-1]
+	cadence = numpy.median(gaps)
+	interrupted = gaps > interruptionFactor * cadence
+	regularGaps, regularDeadTimes = gaps[~interrupted], deadTimes[~interrupted]
+	timing['cadence'] = jsonNumber(cadence)
+	timing['cadenceJitter'] = jsonNumber(1.4826 * numpy.median(numpy.abs(regularGaps - cadence)))
+	timing['medianDeadTime'] = jsonNumber(numpy.nanmedian(regularDeadTimes))
+	timing['meanDeadTime'] = jsonNumber(numpy.nanmean(regularDeadTimes))
+	timing['maxDeadTime'] = jsonNumber(numpy.nanmax(regularDeadTimes))
+	timing['interruptedTime'] = jsonNumber(numpy.nansum(deadTimes[interrupted]))
+	for i in numpy.flatnonzero(interrupted):
+		timing['interruptions'].append({ 'afterFrame': int(frameNumbers[i]), 'startMJD': jsonNumber(MJD[i] + exposureTime[i] / 86400.),
+			'duration': jsonNumber(deadTimes[i]) })
+	return timing
+
+def readHeaderSummary(filename, cache = None):
+	""" Looks up the primary header of a FITS file in the header cache (the shared one by default) and returns the cards
+		that the night log needs
+	"""
+	if cache is None: cache = fitsHeaderCache.getDefaultCache()
+	headers = cache.getHeader(filename)
+	summary = {}
+	summary['xbin'] = int(headers['XBINNING'])
+	summary['ybin'] = int(headers['YBINNING'])
+	summary['telescope'] = headers['TELESCOP']
+	summary['targetRA'] = headers['OBJRA']
+	summary['targetDEC'] = headers['OBJDEC']
+	summary['telescopeRA'] = headers['RA']
+	summary['telescopeDEC'] = headers['DEC']
+	summary['filter'] = headers['FILTER']
+	summary['elevation'] = headers['ELEVATIO']
+	summary['exposureTime'] = float(headers['EXPTIME'])
+	summary['MJD'] = float(headers['MJD-OBS'])
+	summary['focusPosition'] = headers['FOCUSPOS']
+	summary['xpixels'] = int(headers['NAXIS1'])
+	summary['ypixels'] = int(headers['NAXIS2'])
+	summary['obsDateTime'] = headers['DATE-OBS']
+	return summary
+
+
+class targetEntry:
+	""" Everything the catalogue knows about one target. Headers are only re-read when the first or last frame changes. """
+
+	def __init__(self, name):
+		self.name = name
+		self.files = {}
+		self.startFrame = None
+		self.endFrame = None
+		self.firstHeaders = None
+		self.lastHeaders = None
+		self.changed = True
+
+	def addFrame(self, frameNumber, filename):
+		if frameNumber in self.files: return
+		self.files[frameNumber] = filename
+		if self.startFrame is None or frameNumber < self.startFrame:
+			self.startFrame = frameNumber
+			self.firstHeaders = None
+		if self.endFrame is None or frameNumber > self.endFrame:
+			self.endFrame = frameNumber
+			self.lastHeaders = None
+		self.changed = True
+
+	@property
+	def numFrames(self):
+		return len(self.files)
+
+	@property
+	def firstFile(self):
+		return self.files[self.startFrame]
+
+	@property
+	def lastFile(self):
+		return self.files[self.endFrame]
+
+	def updateHeaders(self, path, cache = None):
+		if self.firstHeaders is None:
+			print("%s: Looking at the FITS headers in %s"%(self.name, path + '/' + self.firstFile))
+			self.firstHeaders = readHeaderSummary(path + '/' + self.firstFile, cache)
+		if self.lastHeaders is None:
+			print("%s: Looking at the FITS headers in %s"%(self.name, path + '/' + self.lastFile))
+			self.lastHeaders = readHeaderSummary(path + '/' + self.lastFile, cache)
+
+	def summary(self):
+		""" Returns the target description that is written to the night's JSON file """
+		first = self.firstHeaders
+		last = self.lastHeaders
+		t = {}
+		t['name'] = self.name
+		t['startFrame'] = self.startFrame
+		t['endFrame'] = self.endFrame
+		t['numFrames'] = self.numFrames
+		t['xbin'] = first['xbin']
+		t['ybin'] = first['ybin']
+		t['telescope'] = first['telescope']
+		t['targetRA'] = first['targetRA']
+		t['targetDEC'] = first['targetDEC']
+		t['telescopeRA'] = first['telescopeRA']
+		t['telescopeDEC'] = first['telescopeDEC']
+		t['filter'] = first['filter']
+		t['startElevation'] = first['elevation']
+		t['startAirmass'] = airmassFromElevation(t['startElevation'])
+		t['exposureTime'] = first['exposureTime']
+		t['startMJD'] = first['MJD']
+		t['focusPosition'] = first['focusPosition']
+		if t['filter'] == '': t['filter'] = '--unknown--'
+		if t['telescope'] == '': t['telescope'] = '--unknown--'
+		t['xpixels'] = first['xpixels']
+		t['ypixels'] = first['ypixels']
+		obsDateTime = datetime.datetime.strptime(first['obsDateTime'], "%Y-%m-%dT%H:%M:%S.%f")
+		t['startObservationUTC'] = obsDateTime.strftime("%H:%M:%S")
+
+		t['endElevation'] = last['elevation']
+		t['endAirmass'] = airmassFromElevation(t['endElevation'])
+		t['endMJD'] = last['MJD']
+		t['obsDateTime'] = last['obsDateTime']
+		obsDateTime = datetime.datetime.strptime(t['obsDateTime'], "%Y-%m-%dT%H:%M:%S.%f")
+		t['endObservationUTC'] = obsDateTime.strftime("%H:%M:%S")
+
+		t['durationMinutes'] = (t['endMJD'] - t['startMJD']) * 24.*60.
+		totalExposureTime = t['exposureTime'] * t['numFrames']
+		t['deadTime'] = t['durationMinutes'] * 60. - totalExposureTime
+		t['estimatedReadoutTime'] = t['deadTime'] / t['numFrames']
+		return t
+
+
+class nightCatalogue:
+	""" Per-target index of a night's frames, keyed by target name """
+
+	def __init__(self, path, headerCache = None):
+		self.path = path
+		self.targets = {}
+		self.frames = frameTable.frameTable()
+		self.headerCache = headerCache
+		self._summaries = {}
+		self._timingFrames = {}
+		self._unread = []
+
+	def addFiles(self, filenames):
+		""" Adds new files to the index. Each file costs one regular expression match and a dictionary update. """
+		for filename in filenames:
+			parsed = frameTable.parseFrameFilename(filename)
+			if parsed is None: continue
+			targetName, frameNumber = parsed
+			target = self.targets.get(targetName)
+			if target is None:
+				target = targetEntry(targetName)
+				self.targets[targetName] = target
+			if frameNumber not in target.files: self._unread.append(filename)
+			target.addFrame(frameNumber, filename)
+
+	def targetNames(self):
+		return list(self.targets.keys())
+
+	def readNewHeaders(self):
+		""" Adds the headers of the files added since the last call to the frame table (through the header cache). Files
+			that cannot be read yet, such as one still being written, are tried again next time.
+		"""
+		if len(self._unread) == 0: return
+		filenames = [os.path.join(self.path, f) for f in self._unread]
+		try:
+			self.frames.addFiles(filenames, self.headerCache)
+			self._unread = []
+		except (IOError, OSError):
+			unread = []
+			for filename, path in zip(self._unread, filenames):
+				try:
+					self.frames.addFiles([path], self.headerCache)
+				except (IOError, OSError):
+					unread.append(filename)
+			self._unread = unread
+
+	def targetTiming(self, name):
+		""" The timingAnalysis of all the frames of a target that have been read so far """
+		rows = self.frames.rows[self.frames.targetRows(name)]
+		if len(rows) == 0: return None
+		return timingAnalysis(rows["frame"], rows["MJD"], rows["exposureTime"], rows["airmass"])
+
+	def getTargetList(self):
+		""" Returns the summaries of all targets, re-reading headers only for targets that have new first or last frames. The
+			timing of a target is worked out again whenever more of its frames' headers have been read.
+		"""
+		self.readNewHeaders()
+		framesRead = numpy.bincount(self.frames.rows["target"], minlength = len(self.frames.targets))
+		targetList = []
+		for name in self.targets.keys():
+			target = self.targets[name]
+			if target.changed:
+				target.updateHeaders(self.path, self.headerCache)
+				self._summaries[name] = target.summary()
+				target.changed = False
+				t = self._summaries[name]
+				print(t['name'], t['startFrame'], t['endFrame'], t['numFrames'])
+			number = self.frames.targetNumber(name)
+			read = framesRead[number] if number >= 0 else 0
+			if self._timingFrames.get(name) != read or 'timing' not in self._summaries[name]:
+				self._summaries[name]['timing'] = self.targetTiming(name)
+				self._timingFrames[name] = read
+			targetList.append(self._summaries[name])
+		return targetList
@@ -0,0 +1,121 @@
+""" Aperture photometry for the live reducer. All the sources and all the aperture radii are measured at once with numpy:
+	a stamp is cut around every source, and each aperture is a weight mask over the stamps, so a frame is measured with a
+	handful of array operations however many stars there are. The sky is the median of an annulus around each star.
+	Differential light curves (target over the sum of the comparison stars) are appended to a columnStore on disk.
+"""
+
+import os, json
+import numpy
+import columnStore
+
+
+def aperturePhotometry(imageData, x, y, radii, annulus = (10, 15)):
+	""" Measures sources at (x, y) (zero-based pixel arrays) through circular apertures of each radius in 'radii'.
+		Returns a dictionary of 'flux' and 'area' (len(radii), nSources) with the sky subtracted from the flux, and 'sky'
+		(per pixel) and 'skySigma' (nSources). Pixels partly inside an aperture are weighted by the fraction inside.
+	"""
+	data = numpy.asarray(imageData, dtype=numpy.float32)
+	x, y = numpy.asarray(x, dtype=numpy.float64), numpy.asarray(y, dtype=numpy.float64)
+	radii = numpy.asarray(radii, dtype=numpy.float64)
+	halfSize = int(numpy.ceil(max(annulus[1], radii.max()))) + 1
+	size = 2 * halfSize + 1
+	padded = numpy.pad(data, halfSize, mode='constant', constant_values=numpy.nan)
+
+	# Stamps around each source: (nSources, size, size)
+	xi, yi = numpy.round(x).astype(numpy.int64), numpy.round(y).astype(numpy.int64)
+	inside = (xi >= 0) & (xi < data.shape[1]) & (yi >= 0) & (yi < data.shape[0])
+	xi, yi = numpy.clip(xi, 0, data.shape[1] - 1), numpy.clip(yi, 0, data.shape[0] - 1)
+	offsets = numpy.arange(size)
+	stamps = padded[(yi[:, None] + offsets[None, :])[:, :, None], (xi[:, None] + offsets[None, :])[:, None, :]]
+
+	# Distance of every stamp pixel from its source's centre
+	dx = offsets[None, None, :] - halfSize - (x - xi)[:, None, None]
+	dy = offsets[None, :, None] - halfSize - (y - yi)[:, None, None]
+	distance = numpy.hypot(dx, dy)
+
+	annulusMask = (distance >= annulus[0]) & (distance <= annulus[1])
+	skyPixels = numpy.where(annulusMask, stamps, numpy.nan).reshape(len(x), -1)
+	sky = numpy.nanmedian(skyPixels, axis=1)
+	skySigma = 1.4826 * numpy.nanmedian(numpy.abs(skyPixels - sky[:, None]), axis=1)
+
+	# Aperture weights: 1 inside, 0 outside and a linear ramp across the edge pixel, (nRadii, nSources, size, size)
+	weights = numpy.clip(radii[:, None, None, None] + 0.5 - distance[None, :, :, :], 0, 1)
+	valid = numpy.isfinite(stamps)
+	skySubtracted = numpy.where(valid, stamps - sky[:, None, None], 0)
+	flux = numpy.einsum('rnij,nij->rn', weights, skySubtracted)
+	area = numpy.einsum('rnij,nij->rn', weights, valid.astype(numpy.float64))
+	flux[:, ~inside] = numpy.nan
+	return { "flux": flux, "area": area, "sky": sky, "skySigma": skySigma }
+
+def differentialFlux(flux, target, comparisons):
+	""" The flux of the target star divided by the summed flux of the comparison stars, for every aperture. NaN if there are
+		no comparison stars.
+	"""
+	if len(comparisons) == 0: return numpy.full(numpy.shape(flux)[0], numpy.nan)
+	return flux[:, target] / numpy.sum(flux[:, comparisons], axis=1)
+
+def chooseStars(x, y, flux, width, height, numComparisons = 3, margin = 20):
+	""" Picks the source nearest the centre of the frame as the target and the brightest others (away from the edges)
+		as comparison stars. Returns (target, [comparisons]).
+	"""
+	x, y, flux = numpy.asarray(x), numpy.asarray(y), numpy.asarray(flux)
+	target = int(numpy.argmin(numpy.hypot(x - width / 2., y - height / 2.)))
+	usable = (x > margin) & (x < width - margin) & (y > margin) & (y < height - margin)
+	usable[target] = False
+	candidates = numpy.flatnonzero(usable)
+	comparisons = candidates[numpy.argsort(flux[candidates])[::-1][:numComparisons]]
+	return target, [int(c) for c in comparisons]
+
+
+class lightCurveEngine(object):
+	""" Measures a list of sources in each new frame (following the drift) and appends the raw and differential photometry
+		to a new columnStore (replacing one left in the folder by an earlier run). Source positions are in the coordinates
+		of the reference (first) frame. Sources found later can be added with setSources, up to 'capacity' of them; the flux
+		and sky columns have room for 'capacity' sources and hold NaN for the ones not yet found.
+	"""
+
+	def __init__(self, x, y, target, comparisons, radii = (3, 5, 7), annulus = (10, 15), folder = None, capacity = None, rowGroupSize = 32):
+		self.target = target
+		self.comparisons = list(comparisons)
+		self.radii = list(radii)
+		self.annulus = annulus
+		self.folder = folder
+		self.capacity = len(x) if capacity is None else max(capacity, len(x))
+		nRadii = len(self.radii)
+		columns = [("frame", "i8", ()), ("MJD", "f8", ()), ("dx", "f8", ()), ("dy", "f8", ()), ("differential", "f8", (nRadii,)),
+			("flux", "f8", (nRadii, self.capacity)), ("sky", "f8", (self.capacity,))]
+		self.store = None
+		if folder is not None: self.store = columnStore.columnStore(folder, columns, rowGroupSize, replace = True)
+		if len(self.comparisons) == 0: print("WARNING: There are no comparison stars, the differential flux will be NaN")
+		self.setSources(x, y)
+
+	def setSources(self, x, y):
+		""" Replaces the source positions. The first sources must be the same stars as before, in the same order, so that
+			their columns in the light curve carry on. Sources beyond the capacity are ignored.
+		"""
+		self.x = numpy.asarray(x, dtype=numpy.float64)[:self.capacity]
+		self.y = numpy.asarray(y, dtype=numpy.float64)[:self.capacity]
+		if self.folder is not None:
+			json.dump({ "x": list(self.x), "y": list(self.y), "target": self.target, "comparisons": self.comparisons,
+				"radii": self.radii, "annulus": list(self.annulus) }, open(os.path.join(self.folder, "sources.json"), "wt"), indent = 4)
+
+	def measure(self, frame, drift = (0, 0)):
+		""" Measures a frameObject. Returns the differential flux of the target through each aperture. """
+		result = aperturePhotometry(frame.imageData, self.x + drift[0], self.y + drift[1], self.radii, self.annulus)
+		return self.record(frame.index, frame.MJD, drift, result["flux"], result["sky"])
+
+	def record(self, index, MJD, drift, flux, sky):
+		""" Appends the photometry of a frame that has already been measured (for the current sources) to the light curve.
+			Returns the differential flux of the target through each aperture.
+		"""
+		differential = differentialFlux(flux, self.target, self.comparisons)
+		if self.store is not None:
+			paddedFlux = numpy.full((len(self.radii), self.capacity), numpy.nan)
+			paddedSky = numpy.full(self.capacity, numpy.nan)
+			paddedFlux[:, :numpy.shape(flux)[1]], paddedSky[:len(sky)] = flux, sky
+			self.store.append({ "frame": index, "MJD": MJD if MJD is not None else numpy.nan, "dx": drift[0], "dy": drift[1],
+				"differential": differential, "flux": paddedFlux, "sky": paddedSky })
+		return differential
+
+	def close(self):
+		if self.store is not None: self.store.close()
@@ -0,0 +1,100 @@
+""" A small producer/consumer pipeline for the live reducer. Each stage runs in its own thread and takes its work from a
+	bounded queue, so a slow stage holds up the stages before it (rather than letting frames pile up in memory) but never
+	the ones after it. The last stage's output goes to a latestOnly slot: whatever reads it (the display) only ever sees the
+	newest result, and results it was too slow to pick up are dropped.
+"""
+
+import threading, time
+try:
+	import queue
+except ImportError:
+	import Queue as queue
+
+
+class latestOnly(object):
+	""" A one-item mailbox. Putting an item replaces any item that has not been collected yet, which is counted as dropped. """
+
+	def __init__(self):
+		self._item = None
+		self._full = False
+		self._condition = threading.Condition()
+		self.dropped = 0
+
+	def put(self, item):
+		with self._condition:
+			if self._full: self.dropped+= 1
+			self._item, self._full = item, True
+			self._condition.notify()
+
+	def get(self, timeout = None):
+		""" Returns the newest item, or None if there was none within 'timeout' seconds """
+		with self._condition:
+			if not self._full: self._condition.wait(timeout)
+			if not self._full: return None
+			item, self._item, self._full = self._item, None, False
+			return item
+
+
+class stage(threading.Thread):
+	""" Applies 'function' to each item from 'inbox' and puts the result (unless it is None) in 'outbox'. None in the inbox
+		stops the stage, and is passed on to a queue outbox so that the stages after it stop too.
+	"""
+
+	def __init__(self, name, function, inbox, outbox = None):
+		threading.Thread.__init__(self, name = name)
+		self.daemon = True
+		self.function = function
+		self.inbox = inbox
+		self.outbox = outbox
+		self.count = 0
+		self.busyTime = 0.0
+
+	def run(self):
+		while True:
+			item = self.inbox.get()
+			if item is None: break
+			startTime = time.time()
+			try:
+				result = self.function(item)
+			except Exception as e:
+				print("WARNING: The %s stage failed: %s"%(self.name, str(e)))
+				result = None
+			self.busyTime+= time.time() - startTime
+			self.count+= 1
+			if result is not None and self.outbox is not None: self.outbox.put(result)
+		if isinstance(self.outbox, queue.Queue): self.outbox.put(None)
+
+
+class pipeline(object):
+	""" Chains stages given as a list of (name, function). Items put into the pipeline go through each function in turn,
+		one thread per stage, with queues of at most 'queueSize' items between them. The results end up in 'output', a
+		latestOnly slot by default.
+	"""
+
+	def __init__(self, stages, queueSize = 4, output = None):
+		self.output = latestOnly() if output is None else output
+		self.stages = []
+		inbox = queue.Queue(maxsize = queueSize)
+		self.input = inbox
+		for index, (name, function) in enumerate(stages):
+			outbox = queue.Queue(maxsize = queueSize) if index < len(stages) - 1 else self.output
+			self.stages.append(stage(name, function, inbox, outbox))
+			inbox = outbox
+		for s in self.stages: s.start()
+
+	def put(self, item):
+		""" Adds an item to the first stage, waiting while its queue is full """
+		self.input.put(item)
+
+	def close(self, timeout = None):
+		""" Lets the items already in the pipeline finish, then stops the stages """
+		self.input.put(None)
+		for s in self.stages: s.join(timeout)
+
+	def statistics(self):
+		""" A line for each stage with the number of items done and the average time spent on each """
+		lines = []
+		for s in self.stages:
+			lines.append("%-10s %5d items  %7.1f ms each"%(s.name, s.count, 1000. * s.busyTime / max(s.count, 1)))
+		if isinstance(self.output, latestOnly): lines.append("%-10s %5d results dropped"%("output", self.output.dropped))
+		return "\n".join(lines)
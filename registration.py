@@ -0,0 +1,127 @@
+""" Frame registration by FFT phase correlation. The Fourier transform of the (windowed) reference frame is computed once, so
+	measuring the shift of a new frame costs one forward and one inverse real FFT. Frames are binned 2x2 before the FFTs,
+	which makes them four times quicker, and the shift is refined to a fraction of a pixel by fitting a Gaussian through the
+	correlation peak. Frames are moved onto the reference by bilinear interpolation before they are stacked. Every measured
+	shift is kept in a drift log. A frame whose correlation peak is not significant (a cloudy or blank frame, where the peak
+	is just the highest of the noise) is rejected rather than shifted by a random amount.
+"""
+
+import numpy
+
+
+def gaussianPeak(below, peak, above):
+	""" The offset (-0.5 to 0.5) of the top of the Gaussian through three equally spaced values """
+	below, peak, above = [numpy.log(max(value, 1e-12)) for value in (below, peak, above)]
+	curvature = below - 2 * peak + above
+	if curvature >= 0: return 0.0
+	return 0.5 * (below - above) / curvature
+
+def shiftImage(imageData, dx, dy, out = None):
+	""" Moves an image by (dx, dy) pixels with bilinear interpolation. Pixels shifted in from outside the frame are zero. """
+	data = numpy.asarray(imageData, dtype=numpy.float32)
+	if out is None: out = numpy.zeros(data.shape, dtype=numpy.float32)
+	else: out[...] = 0
+	height, width = data.shape
+	ix, iy = int(numpy.floor(dx)), int(numpy.floor(dy))
+	fx, fy = dx - ix, dy - iy
+	# Each of the four neighbouring integer shifts contributes according to its bilinear weight
+	for sx, sy, weight in [(ix, iy, (1 - fx) * (1 - fy)), (ix + 1, iy, fx * (1 - fy)), (ix, iy + 1, (1 - fx) * fy), (ix + 1, iy + 1, fx * fy)]:
+		if weight == 0 or abs(sx) >= width or abs(sy) >= height: continue
+		target = out[max(sy, 0):height + min(sy, 0), max(sx, 0):width + min(sx, 0)]
+		source = data[max(-sy, 0):height + min(-sy, 0), max(-sx, 0):width + min(-sx, 0)]
+		target+= numpy.float32(weight) * source
+	return out
+
+
+class frameRegistration(object):
+	""" Measures the x, y shift of frames against a reference frame and logs the drift. Frames whose correlation peak is
+		less than 'minSignificance' standard deviations high are rejected (noise alone gives about 10, a good match 100s).
+	"""
+
+	def __init__(self, referenceData = None, maxShift = None, binning = 2, minSignificance = None):
+		self.maxShift = maxShift
+		self.binning = binning
+		self.minSignificance = minSignificance
+		self.referenceFFT = None
+		self.window = None
+		self.driftLog = []
+		self.rejected = []
+		if referenceData is not None: self.setReference(referenceData)
+
+	def _prepare(self, imageData):
+		""" Removes the background and tapers the edges, so that the frame edges and the sky do not dominate the correlation """
+		data = numpy.asarray(imageData, dtype=numpy.float32)
+		b = self.binning
+		if b > 1:
+			height, width = (data.shape[0] // b) * b, (data.shape[1] // b) * b
+			data = data[:height, :width].reshape(height // b, b, width // b, b).sum(axis=(1, 3))
+		else:
+			data = data.copy()
+		data-= numpy.median(data[::4, ::4])
+		numpy.clip(data, 0, None, out=data)
+		data*= self.window
+		return data
+
+	def setReference(self, referenceData):
+		self.shape = numpy.shape(referenceData)
+		height, width = self.shape[0] // self.binning, self.shape[1] // self.binning
+		self.window = numpy.outer(numpy.hanning(height), numpy.hanning(width)).astype(numpy.float32)
+		self.referenceFFT = numpy.conj(numpy.fft.rfft2(self._prepare(referenceData)))
+
+	def measureShift(self, imageData):
+		""" Returns (dx, dy, significance): the shift of 'imageData' relative to the reference in pixels, and the height of
+			the correlation peak in standard deviations of the correlation (large for a good match, a few for no match).
+		"""
+		if numpy.shape(imageData) != self.shape: raise ValueError("The frame is not the same size as the reference")
+		crossPower = numpy.fft.rfft2(self._prepare(imageData)) * self.referenceFFT
+		# Dividing by the square root of the amplitude (rather than all of it) leaves a smoother peak that can be fitted well
+		crossPower/= numpy.sqrt(numpy.abs(crossPower)) + 1e-12
+		height, width = self.window.shape
+		correlation = numpy.fft.irfft2(crossPower, s=(height, width))
+		if self.maxShift is not None:
+			# Only look for the peak within maxShift pixels of no shift
+			limit = int(self.maxShift // self.binning) + 1
+			rows = numpy.r_[0:limit + 1, height - limit:height]
+			columns = numpy.r_[0:limit + 1, width - limit:width]
+			search = correlation[numpy.ix_(rows, columns)]
+			r, c = numpy.unravel_index(numpy.argmax(search), search.shape)
+			y, x = rows[r], columns[c]
+		else:
+			y, x = numpy.unravel_index(numpy.argmax(correlation), correlation.shape)
+		peak = correlation[y, x]
+		dy = y + gaussianPeak(correlation[(y - 1) % height, x], peak, correlation[(y + 1) % height, x])
+		dx = x + gaussianPeak(correlation[y, (x - 1) % width], peak, correlation[y, (x + 1) % width])
+		if dy > height / 2: dy-= height
+		if dx > width / 2: dx-= width
+		significance = (peak - correlation.mean()) / (correlation.std() + 1e-12)
+		return float(dx * self.binning), float(dy * self.binning), float(significance)
+
+	def acceptable(self, significance):
+		""" Whether a shift measured with this significance can be trusted """
+		return self.minSignificance is None or significance >= self.minSignificance
+
+	def reject(self, index, MJD, dx, dy, significance):
+		""" Logs a frame whose shift could not be trusted """
+		print("WARNING: Frame %d does not match the reference (significance %.1f), so it is left out"%(index, significance))
+		self.rejected.append((index, MJD, dx, dy, significance))
+
+	def register(self, frame):
+		""" Measures the shift of a frameObject, adds it to the drift log and returns (dx, dy). Returns None (and logs the
+			frame as rejected) if the shift is not significant enough to be trusted.
+		"""
+		dx, dy, significance = self.measureShift(frame.imageData)
+		if not self.acceptable(significance):
+			self.reject(frame.index, frame.MJD, dx, dy, significance)
+			return None
+		self.driftLog.append((frame.index, frame.MJD, dx, dy, significance))
+		return dx, dy
+
+	def writeDriftLog(self, filename):
+		""" Writes the drift of each frame registered, followed by the rejected frames as comments """
+		outputFile = open(filename, "wt")
+		outputFile.write("# frame, MJD, dx, dy, significance\n")
+		for index, MJD, dx, dy, significance in self.driftLog:
+			outputFile.write("%d, %s, %.3f, %.3f, %.1f\n"%(index, MJD, dx, dy, significance))
+		for index, MJD, dx, dy, significance in self.rejected:
+			outputFile.write("# rejected: %d, %s, %.3f, %.3f, %.1f\n"%(index, MJD, dx, dy, significance))
+		outputFile.close()
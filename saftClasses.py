@@ -1,5 +1,6 @@
-import numpy, os
+import numpy, os, tempfile
 from astropy.io import fits
+import fitsHeaderCache
 from PIL import Image,ImageDraw,ImageFont
 
 
@@ -17,28 +18,125 @@ def percentiles(data, lo, hi):
     data/=scale
     return data
 	
+def binIndices(values, lo, hi, bins):
+	""" The index of the histogram bin each value falls in, for 'bins' equal bins spanning lo to hi """
+	indices = ((values - lo) * (bins / (hi - lo))).astype(numpy.intp)
+	numpy.minimum(indices, bins - 1, out=indices)
+	return indices
+
+def histogramCuts(dataArray, ranks, tolerance, bins = None):
+	""" Estimates the values at fractional 'ranks' (0-1) of a flat array from one fine histogram shared by all the ranks.
+		If the bin holding a rank has more than 'tolerance' percent of the pixels, just those pixels are histogrammed again.
+	"""
+	n = dataArray.size
+	if bins is None: bins = min(65536, max(256, n // 16))
+	maxCount = max(1, tolerance / 100. * n)
+	isInteger = dataArray.dtype.kind in "iu"
+	lo, hi = float(dataArray.min()), float(dataArray.max())
+	if hi <= lo: return [lo for rank in ranks]
+	counts = numpy.bincount(binIndices(dataArray, lo, hi, bins), minlength=bins)
+	cuts = []
+	for rank in ranks:
+		target = rank * (n - 1)
+		values, binCounts, binLo, binHi, below = dataArray, counts, lo, hi, 0
+		cut = None
+		for depth in range(4):
+			width = (binHi - binLo) / bins
+			cumulative = below + numpy.cumsum(binCounts)
+			i = min(int(numpy.searchsorted(cumulative, target, side='right')), bins - 1)
+			start = cumulative[i] - binCounts[i]
+			if binCounts[i] <= maxCount or (isInteger and width <= 1): break
+			subset = values[binIndices(values, binLo, binHi, bins) == i]
+			subsetLo, subsetHi = float(subset.min()), float(subset.max())
+			if subsetHi <= subsetLo:
+				cut = subsetLo      # Every pixel in this bin has the same value
+				break
+			values, binLo, binHi, below = subset, subsetLo, subsetHi, start
+			binCounts = numpy.bincount(binIndices(values, binLo, binHi, bins), minlength=bins)
+		edge = binLo + i * width
+		if cut is None and isInteger and width <= 1: cut = numpy.ceil(edge)
+		if cut is None:
+			fraction = min(max((target - start + 0.5) / max(binCounts[i], 1), 0.0), 1.0)
+			cut = edge + fraction * width
+		cuts.append(cut)
+	return cuts
+
+def subsampledCuts(dataArray, ranks, tolerance):
+	""" Estimates the values at fractional 'ranks' (0-1) from a strided subsample of a flat array. The sample is large enough
+		that the standard error of each percentile is about 'tolerance' percent.
+	"""
+	required = max(int(max(r * (1 - r) for r in ranks) * 1e4 / (tolerance * tolerance)), 1000)
+	stride = max(1, dataArray.size // required)
+	return numpy.percentile(dataArray[::stride], [100. * r for r in ranks])
+
+
+class fastStretch(object):
+	""" A quicker version of 'percentiles' for display. Both cut levels are estimated together, from a histogram or from a
+		subsample, to within 'tolerance' percent, and the scaled image is written into a uint8 buffer that is reused for
+		every frame of the same size.
+	"""
+	
+	def __init__(self, method = "histogram", tolerance = 0.5):
+		if method not in ["histogram", "subsample"]: raise ValueError("Unknown stretch method: %s"%method)
+		self.method = method
+		self.tolerance = tolerance
+		self.output = None
+		self._work = None
+		
+	def cutLevels(self, data, lo, hi):
+		dataArray = numpy.ravel(data)
+		if self.method == "histogram": return histogramCuts(dataArray, [lo / 100., hi / 100.], self.tolerance)
+		return subsampledCuts(dataArray, [lo / 100., hi / 100.], self.tolerance)
+		
+	def stretch(self, data, lo, hi):
+		""" Returns a uint8 image where lo percent of the pixels are 0 and hi percent of the pixels are 255. The array
+			returned is overwritten by the next call.
+		"""
+		pLo, pHi = self.cutLevels(data, lo, hi)
+		if self.output is None or self.output.shape != numpy.shape(data):
+			self.output = numpy.empty(numpy.shape(data), dtype=numpy.uint8)
+			self._work = numpy.empty(numpy.shape(data), dtype=numpy.float32)
+		scale = 255. / (pHi - pLo) if pHi > pLo else 1.0
+		numpy.subtract(data, pLo, out=self._work, casting='unsafe')
+		numpy.multiply(self._work, scale, out=self._work)
+		numpy.clip(self._work, 0, 255, out=self._work)
+		numpy.copyto(self.output, self._work, casting='unsafe')
+		return self.output
+		
 def changeExtension(filename, extension):
 	return os.path.splitext(filename)[0] + "." + extension 
 	
-def writePNG(imageArray, filename):
-	""" Writes to a PNG file using the PIL library. Adds a .png extension if it isn't already there in 'filename' """
-	imgData = numpy.rot90(imageArray, 3)
-	imgSize = numpy.shape(imgData)
-	imgLength = imgSize[0] * imgSize[1]
-	testData = numpy.reshape(imgData, imgLength, order="F")
-	img = Image.new("L", imgSize)
-	palette = []
-	for i in range(256):
-		palette.extend((i, i, i)) # grey scale
-		img.putpalette(palette)
-	img.putdata(testData)
+def writePNG(imageArray, filename, maxSize=None, atomic=False):
+	""" Writes to a PNG file using the PIL library. Adds a .png extension if it isn't already there in 'filename'.
+		'imageArray' should already be scaled to 0-255. If 'maxSize' is given the image is shrunk so that neither side is
+		larger than it, and if 'atomic' is set the PNG is written to a temporary file that is then renamed into place, so
+		that a web server never sees a half written image.
+	"""
+	imgData = numpy.flipud(imageArray)      # FITS images start at the bottom row
+	if imgData.dtype != numpy.uint8:
+		imgData = numpy.clip(imgData, 0, 255).astype(numpy.uint8)
+	img = Image.fromarray(numpy.ascontiguousarray(imgData))
+	if maxSize is not None and max(img.size) > maxSize:
+		img.thumbnail((maxSize, maxSize), Image.BILINEAR)
 	outputFilename = changeExtension(filename, "png")
 	print ("Writing PNG file: " + outputFilename) 
-	img.save(outputFilename, "PNG", clobber=True)
+	if not atomic:
+		img.save(outputFilename, "PNG")
+		return
+	handle, temporaryFilename = tempfile.mkstemp(suffix=".png", dir=os.path.dirname(os.path.abspath(outputFilename)))
+	try:
+		with os.fdopen(handle, "wb") as temporaryFile:
+			img.save(temporaryFile, "PNG")
+		os.chmod(temporaryFilename, 0o644)
+		os.rename(temporaryFilename, outputFilename)
+	except:
+		if os.path.exists(temporaryFilename): os.remove(temporaryFilename)
+		raise
 	
 
-class frameObject:
-	""" This is a class of an individual frame
+class frameObject(object):
+	""" This is a class of an individual frame. In 'lazy' mode only the headers are read by initFromFile, the pixels are
+		memory-mapped the first time imageData is used and the statistics (median, min, max) are computed when asked for.
 	"""
 	
 	metadata = {
@@ -51,28 +149,87 @@ class frameObject:
 		"decString"			: "DEC"
 	}
 	
-	def __init__(self, index = 0):
+	def __init__(self, index = 0, lazy = False):
 		self.filename = None
 		self.index = index
+		self.lazy = lazy
 		self.frameType = "undefined"     # Should be bias/flat/dark/science/balance
+		self._imageData = None
+		self._statistics = {}
+		
+	@property
+	def imageData(self):
+		if self._imageData is None and self.lazy and self.filename is not None:
+			# Astropy can only map the file directly when there is no BZERO/BSCALE scaling to apply
+			hdulist = fits.open(self.filename, memmap=True)
+			try:
+				self._imageData = hdulist[0].data
+			except ValueError:
+				hdulist.close()
+				hdulist = fits.open(self.filename, memmap=False)
+				self._imageData = hdulist[0].data
+			hdulist.close()
+		return self._imageData
 		
-	def boostedImage(self, lower=20, upper=99):
+	@imageData.setter
+	def imageData(self, data):
+		self._imageData = data
+		self._statistics = {}
+		
+	def releaseData(self):
+		""" Drops the reference to the pixels of a lazy frame, they will be mapped again from the file if needed """
+		if self.lazy and self.filename is not None: self.imageData = None
+		
+	def _statistic(self, name, function):
+		if name not in self._statistics: self._statistics[name] = function(self.imageData)
+		return self._statistics[name]
+		
+	@property
+	def median(self):
+		return self._statistic("median", numpy.median)
+		
+	@property
+	def min(self):
+		return self._statistic("min", numpy.min)
+		
+	@property
+	def max(self):
+		return self._statistic("max", numpy.max)
+		
+	def _imageChanged(self):
+		if not self.lazy: self.computeMedian()
+		
+	def boostedImage(self, lower=20, upper=99, stretcher=None):
+		""" Returns the image scaled for display. Pass a fastStretch object as 'stretcher' to use the faster estimate. """
+		if stretcher is not None: return stretcher.stretch(self.imageData, lower, upper)
 		return percentiles(self.imageData, lower, upper)
 
 	def initFromFile(self, filename):
+		self.filename = filename
+		if self.lazy:
+			self.initHeaderFromFile(filename)
+			return
 		hdulist = fits.open(filename)
 		self.initFromFITS(hdulist)
 		hdulist.close()
 		
-	def saveAsPNG(self, filename):
-		imageArray = self.boostedImage()
-		writePNG(imageArray, filename)
+	def initHeaderFromFile(self, filename):
+		""" Fills in the metadata from the shared FITS header cache without reading the pixel data """
+		self.filename = filename
+		header = fitsHeaderCache.getHeader(filename)
+		self.setMetadata(header)
+		self.xSize, self.ySize = header.get("NAXIS2"), header.get("NAXIS1")
+		self.imageData = None
+		
+	def saveAsPNG(self, filename, stretcher=None, maxSize=None, atomic=False):
+		imageArray = self.boostedImage(stretcher=stretcher)
+		writePNG(imageArray, filename, maxSize, atomic)
 		
 		
 	def computeMedian(self):
-		self.median = numpy.median(self.imageData)
-		self.min = numpy.min(self.imageData)
-		self.max = numpy.max(self.imageData)
+		self._statistics["median"] = numpy.median(self.imageData)
+		self._statistics["min"] = numpy.min(self.imageData)
+		self._statistics["max"] = numpy.max(self.imageData)
 		return self.median
 		
 	def subtractFrame(self, otherFrame):
@@ -80,36 +237,37 @@ class frameObject:
 			print("WARNING: Unable to subtract a frame with different binning!")
 			return
 		self.imageData = numpy.subtract(self.imageData, otherFrame.imageData)
-		self.computeMedian()
+		self._imageChanged()
 		
 	def addFrame(self, otherFrame):
 		if (self.xBinning != otherFrame.xBinning) or (self.yBinning != otherFrame.yBinning):
 			print("WARNING: Unable to subtract a frame with different binning!")
 			return
 		self.imageData = numpy.add(self.imageData, otherFrame.imageData)
-		self.computeMedian()	
+		self._imageChanged()	
 		
 	def divideFrame(self, otherFrame):
 		if (self.xBinning != otherFrame.xBinning) or (self.yBinning != otherFrame.yBinning):
 			print ("WARNING: Unable to subtract a frame with different binning!")
 			return
 		self.imageData = numpy.divide(self.imageData, otherFrame.imageData)
-		self.computeMedian()
+		self._imageChanged()
 		
-	def initFromFITS(self, hdulist):
-		card = hdulist[0]
-	
+	def setMetadata(self, header):
 		# Search for valuable metadata in the FITS headers
 		for desiredParameter in self.metadata.keys():
 			try:
-				value = card.header[self.metadata[desiredParameter]]
+				value = header[self.metadata[desiredParameter]]
 			except KeyError:
 				print("WARNING: Could not find the FITS header you were looking for: %s FITS: %s"%(desiredParameter, self.metadata[desiredParameter]))
 				value = None
 			setattr(self, desiredParameter, value)
+		
+	def initFromFITS(self, hdulist):
+		self.setMetadata(hdulist[0].header)
 		self.imageData = hdulist[0].data
 		self.xSize, self.ySize = numpy.shape(self.imageData)
-		self.computeMedian()
+		self._imageChanged()
 
 	def __str__(self, long = False):
 		printout = "Frame number: %d \tMJD: %f"%(self.index, self.MJD)
@@ -4,7 +4,7 @@ import argparse, sys
 import datetime, time
 import numpy
 import ppgplot
-import generalUtils, configHelper
+import generalUtils, configHelper, saftClasses
 from astropy.io import fits
 
 if __name__ == "__main__":
@@ -64,8 +64,9 @@ if __name__ == "__main__":
 		ppgplot.pgpap(8, 1)
 		ppgplot.pgenv(0., width,0., height, 1, -2)
 		imagePlot['pgPlotTransform'] = [0, 1, 0, 0, 0, 1]
+		stretcher = saftClasses.fastStretch()
 		
-		boostedImage = generalUtils.percentiles(imageData, 20, 99)
+		boostedImage = stretcher.stretch(imageData, 20, 99)
 		ppgplot.pggray(boostedImage, 0, width-1, 0, height-1, 0, 255, imagePlot['pgPlotTransform'])
 		
 
@@ -74,7 +75,7 @@ if __name__ == "__main__":
 		pathlessFilename = frameFilename.split('/')[-1]
 		imageData =  hdulist[0].data
 		if args.plot:
-			boostedImage = generalUtils.percentiles(imageData, 20, 99)
+			boostedImage = stretcher.stretch(imageData, 20, 99)
 			ppgplot.pggray(boostedImage, 0, width-1, 0, height-1, 0, 255, imagePlot['pgPlotTransform'])
 		outputFilename = outputDir + "/" + pathlessFilename
 		hdulist.writeto(outputFilename, clobber=True)
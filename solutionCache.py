@@ -0,0 +1,167 @@
+""" A cache of plate solutions stored in SQLite, so that a field that has been solved before can be solved again at once.
+	Each solution is stored with the hash of the acquisition file, the positions of its brightest stars, the pointing, the
+	binning and the region of the chip that was read out. A frame matching the file, or whose stars match the stored ones
+	(within a tolerance, after a shift) near the same pointing, gets the cached WCS back (shifted to the new star
+	positions), and a frame that only matches the pointing gets the cached solution as a tight hint for the solver.
+"""
+
+import os, io, json, time, hashlib, sqlite3, threading
+import numpy
+from astropy.io import fits
+import configHelper
+
+
+def fileHash(filename):
+	""" SHA1 of the file contents """
+	digest = hashlib.sha1()
+	with open(filename, "rb") as f:
+		for chunk in iter(lambda: f.read(1024 * 1024), b""):
+			digest.update(chunk)
+	return digest.hexdigest()
+
+def measureShift(x, y, referenceX, referenceY, tolerance = 2.0, minimumVotes = None):
+	""" The (dx, dy) that moves the reference stars onto the new ones. Every pairing of a new star with a reference star
+		votes for a shift, and the shift with the most votes within 'tolerance' pixels wins. Returns None if it gets fewer
+		than 'minimumVotes' votes, by default a third of the stars in the shorter list (and at least 4), so that a chance
+		alignment of a few stars in a crowded field is not taken for a match.
+	"""
+	if minimumVotes is None: minimumVotes = max(4, min(len(x), len(referenceX)) // 3)
+	dx = (numpy.asarray(x)[:, None] - numpy.asarray(referenceX)[None, :]).ravel()
+	dy = (numpy.asarray(y)[:, None] - numpy.asarray(referenceY)[None, :]).ravel()
+	if len(dx) == 0: return None
+	cells = numpy.round(dx / tolerance).astype(numpy.int64) * 1000003 + numpy.round(dy / tolerance).astype(numpy.int64)
+	values, counts = numpy.unique(cells, return_counts=True)
+	inCell = cells == values[numpy.argmax(counts)]
+	# The shift may lie near the edge of a cell, so count every vote within 'tolerance' of the cell's mean, not just
+	# those that rounded into the same cell
+	votes = numpy.hypot(dx - numpy.mean(dx[inCell]), dy - numpy.mean(dy[inCell])) <= tolerance
+	if numpy.count_nonzero(votes) < minimumVotes: return None
+	return float(numpy.mean(dx[votes])), float(numpy.mean(dy[votes]))
+
+def shiftWCS(wcsData, dx, dy):
+	""" Returns the WCS file 'wcsData' with its reference pixel moved by dx, dy """
+	hdulist = fits.open(io.BytesIO(wcsData))
+	header = hdulist[0].header
+	header['CRPIX1'] = header['CRPIX1'] + dx
+	header['CRPIX2'] = header['CRPIX2'] + dy
+	header['HISTORY'] = 'Cached solution shifted by %.2f, %.2f pixels'%(dx, dy)
+	output = io.BytesIO()
+	hdulist.writeto(output)
+	return output.getvalue()
+
+def angularSeparation(ra1, dec1, ra2, dec2):
+	""" Separation in degrees, works on numpy arrays """
+	ra1, dec1, ra2, dec2 = [numpy.radians(a) for a in (ra1, dec1, ra2, dec2)]
+	cosine = numpy.sin(dec1) * numpy.sin(dec2) + numpy.cos(dec1) * numpy.cos(dec2) * numpy.cos(ra1 - ra2)
+	return numpy.degrees(numpy.arccos(numpy.clip(cosine, -1, 1)))
+
+
+class solutionCache:
+	""" Plate solutions stored in SQLite with hit, hint and miss counters. Old and excess entries are removed by evict(). """
+
+	def __init__(self, filename = None, maxAge = 180, maxEntries = 5000, maxBytes = 200 * 1024 * 1024):
+		if filename is None:
+			folder = configHelper.getUserHome() + "/.config/solutionCache"
+			if not os.path.exists(folder): os.makedirs(folder)
+			filename = folder + "/solutions.db"
+		self.filename = filename
+		self.maxAge = maxAge
+		self.maxEntries = maxEntries
+		self.maxBytes = maxBytes
+		self.hits = 0
+		self.hints = 0
+		self.misses = 0
+		self._lock = threading.Lock()
+		self._db = sqlite3.connect(filename, timeout = 30, check_same_thread = False)
+		self._db.execute("PRAGMA journal_mode=WAL")
+		self._db.execute("CREATE TABLE IF NOT EXISTS solutions (id INTEGER PRIMARY KEY, fileHash TEXT, "
+			"ra REAL, dec REAL, xBinning INTEGER, yBinning INTEGER, region TEXT, stars TEXT, calibration TEXT, wcs BLOB, "
+			"size INTEGER, created REAL, lastUsed REAL)")
+		self._db.execute("CREATE INDEX IF NOT EXISTS solutionsByFile ON solutions (fileHash)")
+		self._db.execute("CREATE INDEX IF NOT EXISTS solutionsBySetup ON solutions (xBinning, yBinning, region, dec)")
+		self._db.commit()
+
+	def store(self, wcsData, calibration, ra, dec, xBinning, yBinning, region, fileHash = None, stars = None):
+		""" Adds a solution. 'calibration' is the dictionary reported by the solver, 'stars' the (x, y) lists of the brightest stars. """
+		now = time.time()
+		if stars is not None: stars = json.dumps([list(map(float, stars[0])), list(map(float, stars[1]))])
+		with self._lock:
+			self._db.execute("INSERT INTO solutions (fileHash, ra, dec, xBinning, yBinning, region, stars, calibration, wcs, size, created, lastUsed) "
+				"VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (fileHash, ra, dec, xBinning, yBinning, region, stars,
+				json.dumps(calibration), sqlite3.Binary(wcsData), len(wcsData), now, now))
+			self._db.commit()
+
+	def _candidates(self, ra, dec, xBinning, yBinning, region, radius):
+		rows = self._db.execute("SELECT id, fileHash, ra, dec, stars, calibration, wcs FROM solutions "
+			"WHERE xBinning=? AND yBinning=? AND region=? AND dec BETWEEN ? AND ? AND created > ?",
+			(xBinning, yBinning, region, dec - radius, dec + radius, time.time() - self.maxAge * 86400)).fetchall()
+		if not rows: return []
+		separations = angularSeparation(ra, dec, numpy.array([r[2] for r in rows]), numpy.array([r[3] for r in rows]))
+		order = numpy.argsort(separations)
+		return [rows[i] for i in order if separations[i] <= radius]
+
+	def lookup(self, ra, dec, xBinning, yBinning, region, radius = 1.0, fileHash = None, stars = None):
+		""" Looks for a solution of a frame taken at 'ra', 'dec' (the intended pointing) with the same binning and region.
+			'stars' is the (x, y) lists of the frame's brightest stars. Returns ("hit", wcsData, calibration) when the file or
+			the stars match, ("hint", None, calibration) when only the pointing does, and ("miss", None, None) otherwise.
+		"""
+		with self._lock:
+			candidates = self._candidates(ra, dec, xBinning, yBinning, region, radius)
+			for row in candidates:
+				wcsData = bytes(row[6])
+				if fileHash is not None and row[1] == fileHash:
+					return self._found("hit", row[0], wcsData, row[5])
+				if row[4] is None or stars is None: continue
+				reference = json.loads(row[4])
+				shift = measureShift(stars[0], stars[1], reference[0], reference[1])
+				if shift is None: continue
+				return self._found("hit", row[0], shiftWCS(wcsData, shift[0], shift[1]), row[5])
+			if candidates:
+				return self._found("hint", candidates[0][0], None, candidates[0][5])
+			self.misses+= 1
+			return "miss", None, None
+
+	def _found(self, kind, rowid, wcsData, calibration):
+		if kind == "hit": self.hits+= 1
+		else: self.hints+= 1
+		self._db.execute("UPDATE solutions SET lastUsed=? WHERE id=?", (time.time(), rowid))
+		self._db.commit()
+		return kind, wcsData, json.loads(calibration)
+
+	def evict(self):
+		""" Removes entries older than 'maxAge' days, then the least recently used ones until the cache is within
+			'maxEntries' entries and 'maxBytes' bytes of WCS data. Returns the number removed.
+		"""
+		with self._lock:
+			removed = self._db.execute("DELETE FROM solutions WHERE created < ?", (time.time() - self.maxAge * 86400,)).rowcount
+			rows = self._db.execute("SELECT id, size FROM solutions ORDER BY lastUsed DESC").fetchall()
+			sizes = numpy.cumsum([r[1] for r in rows])
+			excess = [r[0] for i, r in enumerate(rows) if i >= self.maxEntries or sizes[i] > self.maxBytes]
+			if excess:
+				self._db.executemany("DELETE FROM solutions WHERE id=?", [(rowid,) for rowid in excess])
+				removed+= len(excess)
+			self._db.commit()
+		return removed
+
+	def statistics(self):
+		with self._lock:
+			entries, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM solutions").fetchone()
+		return { "entries": entries, "bytes": size, "hits": self.hits, "hints": self.hints, "misses": self.misses }
+
+	def close(self):
+		with self._lock:
+			self._db.close()
+
+
+if __name__ == "__main__":
+	import argparse
+
+	parser = argparse.ArgumentParser(description='Shows the plate solution cache used by acquireTarget, and trims it.')
+	parser.add_argument('--evict', action="store_true", help='Remove old and excess entries.')
+	parser.add_argument('--maxage', type=float, default=180, help='Age (days) beyond which entries are removed.')
+	parser.add_argument('--maxentries', type=int, default=5000, help='Number of entries to keep.')
+	args = parser.parse_args()
+
+	cache = solutionCache(maxAge = args.maxage, maxEntries = args.maxentries)
+	if args.evict: print("Removed %d entries"%cache.evict())
+	print(cache.statistics())
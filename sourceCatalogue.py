@@ -0,0 +1,119 @@
+""" The list of sources found on the live stack. The stack is searched again from time to time (every so many frames or
+	seconds) in a background thread, so that faint stars are picked up as the stack gets deeper without holding up the
+	display. New detections are cross-matched against the known sources with a KD-tree, so a star keeps the same number
+	(its index in the catalogue) for the whole run and the photometry columns stay put.
+"""
+
+import threading, time
+try:
+	import queue
+except ImportError:
+	import Queue as queue
+import numpy
+from scipy.spatial import cKDTree
+
+
+class sourceCatalogue(object):
+	""" Source positions, fluxes and sharpnesses. A source's index never changes once it has been added. """
+
+	def __init__(self, matchRadius = 2.0):
+		self.matchRadius = matchRadius
+		self.x = numpy.zeros(0)
+		self.y = numpy.zeros(0)
+		self.flux = numpy.zeros(0)
+		self.sharpness = numpy.zeros(0)
+		self.version = 0
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return len(self.x)
+
+	def update(self, x, y, flux, sharpness = None):
+		""" Merges a new list of detections. Detections within 'matchRadius' pixels of a known source update its position and
+			flux, and the rest are added as new sources. Returns the indices of the new sources.
+		"""
+		x, y, flux = numpy.asarray(x, dtype=numpy.float64), numpy.asarray(y, dtype=numpy.float64), numpy.asarray(flux, dtype=numpy.float64)
+		sharpness = numpy.zeros(len(x)) if sharpness is None else numpy.asarray(sharpness, dtype=numpy.float64)
+		with self._lock:
+			matched = numpy.zeros(len(x), dtype=bool)
+			if len(self.x) > 0 and len(x) > 0:
+				tree = cKDTree(numpy.column_stack((self.x, self.y)))
+				distance, index = tree.query(numpy.column_stack((x, y)), distance_upper_bound = self.matchRadius)
+				matched = numpy.isfinite(distance)
+				# If two detections match the same source, only the nearer one updates it and the other is dropped
+				order = numpy.argsort(distance[matched])
+				detections = numpy.flatnonzero(matched)[order]
+				sources, first = numpy.unique(index[detections], return_index = True)
+				detections = detections[first]
+				self.x[sources], self.y[sources] = x[detections], y[detections]
+				self.flux[sources], self.sharpness[sources] = flux[detections], sharpness[detections]
+			new = numpy.flatnonzero(~matched)
+			newIndices = numpy.arange(len(self.x), len(self.x) + len(new))
+			self.x = numpy.concatenate((self.x, x[new]))
+			self.y = numpy.concatenate((self.y, y[new]))
+			self.flux = numpy.concatenate((self.flux, flux[new]))
+			self.sharpness = numpy.concatenate((self.sharpness, sharpness[new]))
+			self.version+= 1
+		return newIndices
+
+	def updateFromTable(self, sources):
+		""" Merges the table of sources returned by daofind """
+		if sources is None or len(sources) == 0: return numpy.zeros(0, dtype=int)
+		return self.update(sources['xcentroid'], sources['ycentroid'], sources['flux'], sources['sharpness'])
+
+	def snapshot(self):
+		""" Returns copies of (x, y, flux, sharpness) and the version number, which goes up with every update """
+		with self._lock:
+			return self.x.copy(), self.y.copy(), self.flux.copy(), self.sharpness.copy(), self.version
+
+
+class redetector(object):
+	""" Searches copies of the stack for sources in a background thread, every 'everyFrames' frames or 'everySeconds'
+		seconds, whichever comes first. 'detect' is a function taking an image and returning a daofind table. A search
+		is not due while the last one is still running, so the caller never waits for the worker.
+	"""
+
+	def __init__(self, catalogue, detect, everyFrames = 10, everySeconds = None):
+		self.catalogue = catalogue
+		self.detect = detect
+		self.everyFrames = everyFrames
+		self.everySeconds = everySeconds
+		self.lastFrames = 0
+		self.lastTime = time.time()
+		self.searches = 0
+		self.busy = False
+		self._jobs = queue.Queue()
+		self._thread = threading.Thread(target = self._run)
+		self._thread.daemon = True
+		self._thread.start()
+
+	def due(self, frameCount):
+		if self.busy: return False
+		if self.everyFrames and frameCount - self.lastFrames >= self.everyFrames: return True
+		if self.everySeconds and time.time() - self.lastTime >= self.everySeconds: return True
+		return False
+
+	def frameAdded(self, stackData, frameCount):
+		""" Call after each frame is stacked. Starts a search of a copy of 'stackData' if one is due. Returns True if it did. """
+		if not self.due(frameCount): return False
+		self.lastFrames, self.lastTime = frameCount, time.time()
+		self.busy = True
+		self._jobs.put((numpy.array(stackData, dtype=numpy.float32), frameCount))
+		return True
+
+	def _run(self):
+		while True:
+			job = self._jobs.get()
+			if job is None: return
+			stackData, frameCount = job
+			try:
+				newIndices = self.catalogue.updateFromTable(self.detect(stackData))
+				self.searches+= 1
+				if len(newIndices) > 0:
+					print("Found %d new sources in the stack of %d frames (%d in total)"%(len(newIndices), frameCount, len(self.catalogue)))
+			except Exception as e:
+				print("WARNING: Source detection failed: %s"%str(e))
+			self.busy = False
+
+	def close(self):
+		self._jobs.put(None)
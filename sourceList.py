@@ -0,0 +1,66 @@
+""" Builds compact source lists (xylists) for plate solving. The stars are found with daofind, as in liveSAFTReduce, and
+	only the brightest are kept and written as a small FITS table, so a solve uploads a few kilobytes instead of the image.
+"""
+
+import io
+import numpy
+from astropy.io import fits
+from astropy.stats import median_absolute_deviation as mad
+import saftClasses
+
+try:
+	from photutils import daofind
+except ImportError:
+	# Newer versions of photutils replaced the daofind function with the DAOStarFinder class
+	from photutils.detection import DAOStarFinder
+	def daofind(data, fwhm, threshold):
+		return DAOStarFinder(threshold, fwhm)(data)
+
+
+def findSources(imageData, fwhm = 4.0, nSigma = 3.0, maxSources = 100):
+	""" Returns the x, y (zero-based) and flux of the 'maxSources' brightest stars, brightest first """
+	data = numpy.asarray(imageData, dtype=numpy.float32)
+	background = numpy.median(data)
+	bkg_sigma = 1.48 * mad(data)
+	sources = daofind(data - background, fwhm=fwhm, threshold=nSigma*bkg_sigma)
+	if sources is None or len(sources) == 0:
+		return numpy.zeros(0), numpy.zeros(0), numpy.zeros(0)
+	x = numpy.array(sources['xcentroid'], dtype=numpy.float64)
+	y = numpy.array(sources['ycentroid'], dtype=numpy.float64)
+	flux = numpy.array(sources['flux'], dtype=numpy.float64)
+	brightest = numpy.argsort(flux)[::-1][:maxSources]
+	return x[brightest], y[brightest], flux[brightest]
+
+def sourceListHDU(x, y, flux, width, height):
+	""" The xylist table as astrometry.net expects it: one-based X and Y columns, brightest first """
+	columns = fits.ColDefs([
+		fits.Column(name='X', format='E', array=x + 1),
+		fits.Column(name='Y', format='E', array=y + 1),
+		fits.Column(name='FLUX', format='E', array=flux)
+	])
+	table = fits.BinTableHDU.from_columns(columns)
+	table.header['IMAGEW'] = (width, 'Width of the image the sources came from')
+	table.header['IMAGEH'] = (height, 'Height of the image the sources came from')
+	return fits.HDUList([fits.PrimaryHDU(), table])
+
+def sourcesFromFile(filename, maxSources = 100, fwhm = 4.0, nSigma = 3.0):
+	""" Finds the stars in a FITS image. Returns x, y, flux (brightest first) and the width and height of the image. """
+	frame = saftClasses.frameObject(lazy = True)
+	frame.initFromFile(filename)
+	height, width = numpy.shape(frame.imageData)
+	x, y, flux = findSources(frame.imageData, fwhm, nSigma, maxSources)
+	frame.releaseData()
+	return x, y, flux, width, height
+
+def makeSourceList(filename, maxSources = 100, fwhm = 4.0, nSigma = 3.0, outputFilename = None):
+	""" Finds the stars in a FITS image and returns (xylist, width, height). The xylist is returned as bytes, or
+		written to 'outputFilename' if one is given.
+	"""
+	x, y, flux, width, height = sourcesFromFile(filename, maxSources, fwhm, nSigma)
+	hdulist = sourceListHDU(x, y, flux, width, height)
+	if outputFilename is not None:
+		hdulist.writeto(outputFilename, overwrite=True)
+		return outputFilename, width, height
+	buffer = io.BytesIO()
+	hdulist.writeto(buffer)
+	return buffer.getvalue(), width, height
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+""" Collects telemetry (the weather station, and later other sensors) in the background. Each sensor is sampled by its own
+	asyncio task on its own schedule, and a sample that takes longer than the sensor's timeout is abandoned (the command is
+	killed) rather than holding anything up. The recent samples are kept in memory in a ring buffer, averages over longer
+	intervals are appended to a history file for each day, and the latest values can be read at any time without waiting.
+"""
+
+import argparse, os, json, time, datetime, threading, collections, signal
+import asyncio
+
+
+def parseWeatherData(data):
+	weatherObject = {}
+	
+	lines = data.split("\n")
+	for line in lines:
+		# print("Line:", line)
+		if "Data received" in line:
+			datetimeString = line[len("Data received")+1:-2]
+			weatherDateTime = datetime.datetime.strptime(datetimeString, "%Y-%m-%dT%H:%M:%S")
+			weatherObject['date'] = weatherDateTime.strftime("%Y-%m-%d")
+			weatherObject['time'] = weatherDateTime.strftime("%H:%M:%S")
+		try:
+			# print("parts:", line.split(':'))
+			valueString = (line.split(':')[1]).split(' ')[1]
+		except IndexError:
+			continue
+		# print("ValueString:",valueString)
+		if "Wind Direction" in line:
+			weatherObject['WindDirection'] = float(valueString)
+		if "Wind Speed" in line:
+			weatherObject['WindSpeed'] = float(valueString)
+		if "Temperature" in line:
+			weatherObject['Temperature'] = float(valueString)
+		if "Rel. Humidity" in line:
+			weatherObject['RelativeHumidity'] = float(valueString)
+		if "Pressure" in line:
+			weatherObject['Pressure'] = float(valueString)
+		if "Accum. Rain" in line:
+			weatherObject['AccumulatedRain'] = float(valueString)
+		if "Heater Temp." in line:
+			weatherObject['HeaterTemperature'] = float(valueString)
+		if "Heater Voltage" in line:
+			weatherObject['HeaterVoltage'] = float(valueString)
+
+	return weatherObject
+
+
+class commandSensor:
+	""" A sensor read by running a shell command and parsing what it prints into a dictionary of values """
+
+	def __init__(self, name, command, parse, interval = 60, timeout = 20):
+		self.name = name
+		self.command = command
+		self.parse = parse
+		self.interval = interval
+		self.timeout = timeout
+
+	async def sample(self):
+		""" Runs the command and returns the parsed values. Raises asyncio.TimeoutError if it takes too long. """
+		# In a session of its own, so that the shell and anything it started can all be killed together
+		starting = asyncio.ensure_future(asyncio.create_subprocess_shell(self.command, stdout = asyncio.subprocess.PIPE,
+			stderr = asyncio.subprocess.DEVNULL, start_new_session = True))
+		try:
+			process = await asyncio.shield(starting)
+		except asyncio.CancelledError:
+			# Cancelling the start itself would wait for the command to finish, so let it start and then kill it
+			await self._kill(await starting)
+			raise
+		try:
+			output, errors = await asyncio.wait_for(process.communicate(), self.timeout)
+		except (asyncio.TimeoutError, asyncio.CancelledError):
+			await self._kill(process)
+			raise
+		if process.returncode != 0: raise RuntimeError("'%s' exited with status %d"%(self.command, process.returncode))
+		return self.parse(output.decode('utf-8'))
+
+	async def _kill(self, process):
+		try:
+			os.killpg(process.pid, signal.SIGKILL)
+		except ProcessLookupError:
+			pass
+		await process.wait()
+
+
+class sensorRecord:
+	""" The samples of one sensor: a ring buffer of (time, values) and the running sums of the current history interval """
+
+	def __init__(self, sensor, bufferLength, historyInterval):
+		self.sensor = sensor
+		self.samples = collections.deque(maxlen = bufferLength)
+		self.historyInterval = historyInterval
+		self.lastSample = None
+		self.lastError = None
+		self.failures = 0
+		self.binStart = None
+		self.binSums = {}
+
+	def add(self, sampleTime, values):
+		""" Adds a sample. Returns the averages of the last history interval when this sample starts a new one, else None. """
+		self.samples.append((sampleTime, values))
+		self.lastSample = (sampleTime, values)
+		binStart = sampleTime - sampleTime % self.historyInterval
+		finished = None
+		if self.binStart is not None and binStart != self.binStart: finished = self.averages()
+		if binStart != self.binStart: self.binStart, self.binSums = binStart, {}
+		for key, value in values.items():
+			if isinstance(value, (int, float)) and not isinstance(value, bool):
+				total, count = self.binSums.get(key, (0.0, 0))
+				self.binSums[key] = (total + value, count + 1)
+		return finished
+
+	def averages(self):
+		if self.binStart is None or len(self.binSums) == 0: return None
+		averages = dict((key, total / count) for key, (total, count) in self.binSums.items())
+		averages['time'] = self.binStart + self.historyInterval / 2.
+		averages['samples'] = max(count for total, count in self.binSums.values())
+		return averages
+
+
+class telemetryService:
+	""" Samples a set of sensors in a background thread running an asyncio event loop """
+
+	def __init__(self, historyFolder = None, bufferLength = 1440, historyInterval = 300):
+		self.historyFolder = historyFolder
+		self.bufferLength = bufferLength
+		self.historyInterval = historyInterval
+		self.records = {}
+		self._lock = threading.Lock()
+		self._thread = None
+		self._loop = None
+		self._stopping = None
+		self._ready = threading.Event()
+		if historyFolder is not None and not os.path.exists(historyFolder): os.makedirs(historyFolder)
+
+	def addSensor(self, sensor):
+		self.records[sensor.name] = sensorRecord(sensor, self.bufferLength, self.historyInterval)
+
+	def start(self):
+		""" Starts sampling. Returns once the event loop is running, so that stop() can always reach it. """
+		self._thread = threading.Thread(target = self._run, name = "telemetry")
+		self._thread.daemon = True
+		self._thread.start()
+		self._ready.wait()
+
+	def stop(self, timeout = 10):
+		""" Stops sampling and writes out the averages of the history intervals that are still open """
+		if self._loop is not None: self._loop.call_soon_threadsafe(self._stopping.set)
+		if self._thread is not None: self._thread.join(timeout)
+		with self._lock:
+			for name, record in self.records.items():
+				averages = record.averages()
+				if averages is not None: self._writeHistory(name, averages)
+				record.binStart, record.binSums = None, {}
+
+	def _run(self):
+		asyncio.run(self._main())
+
+	async def _main(self):
+		self._loop = asyncio.get_running_loop()
+		self._stopping = asyncio.Event()
+		self._ready.set()
+		tasks = [asyncio.ensure_future(self._poll(record)) for record in self.records.values()]
+		await self._stopping.wait()
+		for task in tasks: task.cancel()
+		await asyncio.gather(*tasks, return_exceptions = True)
+
+	async def _poll(self, record):
+		""" Samples one sensor every 'interval' seconds (from the start of one sample to the start of the next) """
+		sensor = record.sensor
+		nextTime = time.time()
+		while True:
+			try:
+				values = await sensor.sample()
+				finished = None
+				with self._lock:
+					finished = record.add(time.time(), values)
+					record.lastError = None
+				if finished is not None: self._writeHistory(sensor.name, finished)
+			except asyncio.CancelledError:
+				raise
+			except asyncio.TimeoutError:
+				self._failed(record, "no reply within %g s"%sensor.timeout)
+			except Exception as e:
+				self._failed(record, str(e))
+			# A sample that overran its interval is followed straight away by the next, rather than by a burst to catch up
+			nextTime = max(nextTime + sensor.interval, time.time())
+			await asyncio.sleep(max(0, nextTime - time.time()))
+
+	def _failed(self, record, message):
+		with self._lock:
+			record.failures+= 1
+			record.lastError = message
+		print("WARNING: Could not read the %s sensor: %s"%(record.sensor.name, message))
+
+	def _writeHistory(self, name, averages):
+		""" Appends a line of averages to the sensor's history file for the (UTC) day """
+		if self.historyFolder is None: return
+		day = datetime.datetime.utcfromtimestamp(averages['time']).strftime("%Y-%m-%d")
+		historyFile = open(os.path.join(self.historyFolder, "%s-%s.jsonl"%(name, day)), "at")
+		historyFile.write(json.dumps(averages) + "\n")
+		historyFile.close()
+
+	def latest(self, name):
+		""" Returns (time, values) of the sensor's most recent sample, or None if there has not been one. Never waits for
+			the sensor.
+		"""
+		with self._lock:
+			return self.records[name].lastSample
+
+	def recent(self, name, seconds = None):
+		""" The samples in the ring buffer, oldest first, optionally only those from the last 'seconds' seconds """
+		with self._lock:
+			samples = list(self.records[name].samples)
+		if seconds is not None: samples = [s for s in samples if s[0] >= time.time() - seconds]
+		return samples
+
+	def status(self, name):
+		with self._lock:
+			record = self.records[name]
+			return { "samples": len(record.samples), "failures": record.failures, "lastError": record.lastError,
+				"age": time.time() - record.lastSample[0] if record.lastSample is not None else None }
+
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser(description='Samples the weather station in the background and prints the latest values.')
+	parser.add_argument('-c', '--command', type=str, default="vaisala", help='Command that prints the weather station data.')
+	parser.add_argument('-i', '--interval', type=float, default=10, help='Seconds between samples.')
+	parser.add_argument('-t', '--timeout', type=float, default=5, help='Seconds to wait for the command.')
+	parser.add_argument('-o', '--history', type=str, help='Folder for the history files.')
+	parser.add_argument('--historyinterval', type=float, default=60, help='Seconds each line of the history averages over.')
+	parser.add_argument('-n', '--iterations', type=int, default=6, help='Number of times to print the latest values.')
+	args = parser.parse_args()
+
+	service = telemetryService(args.history, historyInterval = args.historyinterval)
+	service.addSensor(commandSensor("weather", args.command, parseWeatherData, args.interval, args.timeout))
+	service.start()
+	for iteration in range(args.iterations):
+		time.sleep(args.interval)
+		print(service.latest("weather"), service.status("weather"))
+	service.stop()